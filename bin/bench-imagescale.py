@@ -0,0 +1,99 @@
+#! /usr/bin/env python
+import argparse
+import io
+import threading
+import time
+
+from PIL import Image
+
+from coreapis.imagescale import ImageScaler
+
+DESCRIPTION = """Measure how long image scaling stalls the other threads of a worker.
+
+A ticker thread stands in for the requests served alongside the
+scaling. It sleeps for --tick seconds at a time, and the stall is how
+much later than that it wakes up. Images are scaled by --threads
+request threads, either in the threads themselves or through
+ImageScaler."""
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=DESCRIPTION)
+    parser.add_argument('--images', type=int, default=100, help="images to scale")
+    parser.add_argument('--threads', type=int, default=4, help="request threads scaling images")
+    parser.add_argument('--processes', type=int, default=2, help="ImageScaler processes")
+    parser.add_argument('--width', type=int, default=2400, help="source image width")
+    parser.add_argument('--height', type=int, default=3200, help="source image height")
+    parser.add_argument('--tick', type=float, default=0.005, help="ticker interval")
+    return parser.parse_args()
+
+
+def make_photo(width, height):
+    image = Image.effect_noise((width, height), 64).convert('RGB')
+    output = io.BytesIO()
+    image.save(output, format='JPEG', quality=90)
+    return output.getvalue()
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[int(fraction * (len(values) - 1))]
+
+
+def run(scaler, data, args):
+    stalls = []
+    done = threading.Event()
+
+    def ticker():
+        while not done.is_set():
+            t0 = time.perf_counter()
+            time.sleep(args.tick)
+            stalls.append(time.perf_counter() - t0 - args.tick)
+
+    remaining = list(range(args.images))
+    lock = threading.Lock()
+
+    def worker():
+        while True:
+            with lock:
+                if not remaining:
+                    return
+                remaining.pop()
+            scaler.scale(data, (128, 128), 'JPEG')
+
+    tick_thread = threading.Thread(target=ticker)
+    tick_thread.start()
+    t0 = time.perf_counter()
+    workers = [threading.Thread(target=worker) for _ in range(args.threads)]
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    elapsed = time.perf_counter() - t0
+    done.set()
+    tick_thread.join()
+    return elapsed, stalls
+
+
+def main():
+    args = parse_args()
+    data = make_photo(args.width, args.height)
+    pool = ImageScaler(args.processes, args.images)
+    pool.scale(data, (128, 128), 'JPEG')  # Start the pool outside the measurement
+    variants = [
+        ('in thread', ImageScaler(0, 0)),
+        ('pool x{}'.format(args.processes), pool),
+    ]
+    print('{} images of {}x{}, {} KiB'.format(args.images, args.width, args.height,
+                                              len(data) // 1024))
+    print('{:<12} {:>8} {:>10} {:>10} {:>10}'.format('', 'img/s', 'p50 stall', 'p99 stall',
+                                                     'max stall'))
+    for name, scaler in variants:
+        elapsed, stalls = run(scaler, data, args)
+        print('{:<12} {:8.1f} {:8.1f}ms {:8.1f}ms {:8.1f}ms'.format(
+            name, args.images / elapsed, percentile(stalls, 0.5) * 1000,
+            percentile(stalls, 0.99) * 1000, max(stalls) * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+#! /usr/bin/env python
+import argparse
+import logging
+import timeit
+import uuid
+
+from coreapis.utils import LogWrapper, LogMessage, log_token
+
+DESCRIPTION = "Measure the cost of debug logging through LogWrapper when debug is disabled"
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=DESCRIPTION)
+    parser.add_argument('--calls', type=int, default=200000, help="calls per measurement")
+    parser.add_argument('--repeat', type=int, default=5, help="measurements per variant")
+    parser.add_argument('--per-request', type=int, default=4,
+                        help="debug calls on the hot path of one request")
+    return parser.parse_args()
+
+
+def measure(func, args):
+    ncalls = args.calls
+
+    def run():
+        for _ in range(ncalls):
+            func()
+
+    return min(timeit.repeat(run, number=1, repeat=args.repeat)) / ncalls * 1e9
+
+
+def main():
+    args = parse_args()
+    logging.basicConfig(level=logging.WARNING)
+    LogWrapper.add_defaults(docker_host='bench', docker_instance='1')
+    log = LogWrapper('dataporten.auth')
+    token = str(uuid.uuid4())
+    user = {'userid': uuid.uuid4()}
+    client = {'id': uuid.uuid4()}
+    scopes = ['userinfo', 'groups']
+
+    def eager():
+        # What LogWrapper.debug did before checking the level
+        base = LogWrapper.clsbase.copy()
+        base.update(log._base)  # pylint: disable=protected-access
+        log.logger.debug(LogMessage('successfully looked up token', base,
+                                    userid=user['userid'], clientid=client['id'],
+                                    scopes=scopes, accesstoken=log_token(token)))
+
+    def lazy():
+        log.debug('successfully looked up token', userid=user['userid'], clientid=client['id'],
+                  scopes=scopes, accesstoken=log_token(token))
+
+    def lazy_noargs():
+        log.debug('check_rate')
+
+    results = [
+        ('eager', measure(eager, args)),
+        ('lazy', measure(lazy, args)),
+        ('lazy, no args', measure(lazy_noargs, args)),
+    ]
+    for name, cost in results:
+        print('{:<14} {:8.0f} ns/call {:8.0f} ns/request'.format(name, cost,
+                                                                 cost * args.per_request))
+    saved = (results[0][1] - results[1][1]) * args.per_request
+    print('saved per request: {:.0f} ns'.format(saved))
+
+
+if __name__ == '__main__':
+    main()
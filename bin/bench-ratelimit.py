@@ -0,0 +1,49 @@
+#! /usr/bin/env python
+import argparse
+import os
+import tempfile
+import timeit
+
+from coreapis.ratelimit import RateLimiter, SharedMemoryBucketStore
+
+DESCRIPTION = "Measure the per call cost of RateLimiter.check_rate"
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=DESCRIPTION)
+    parser.add_argument('--calls', type=int, default=200000, help="calls per measurement")
+    parser.add_argument('--clients', type=int, default=1000, help="distinct client addresses")
+    parser.add_argument('--repeat', type=int, default=5, help="measurements per store")
+    parser.add_argument('--max-share', type=float, default=0.01)
+    parser.add_argument('--max-rate', type=float, default=100.)
+    parser.add_argument('--max-burst-size', type=int, default=50)
+    return parser.parse_args()
+
+
+def measure(name, limiter, args):
+    addresses = ['10.0.{}.{}'.format(i // 256, i % 256) for i in range(args.clients)]
+    ncalls = args.calls
+
+    def run():
+        check_rate = limiter.check_rate
+        for i in range(ncalls):
+            check_rate(addresses[i % args.clients])
+
+    best = min(timeit.repeat(run, number=1, repeat=args.repeat))
+    print('{:<8} {:8.0f} ns/call'.format(name, best / ncalls * 1e9))
+
+
+def main():
+    args = parse_args()
+    limiter_args = (args.max_share, args.max_burst_size, args.max_rate)
+    measure('local', RateLimiter(*limiter_args), args)
+    fd, path = tempfile.mkstemp(dir='/dev/shm' if os.path.isdir('/dev/shm') else None)
+    os.close(fd)
+    try:
+        measure('shared', RateLimiter(*limiter_args, store=SharedMemoryBucketStore(path)), args)
+    finally:
+        os.unlink(path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,114 @@
+#! /usr/bin/env python
+import argparse
+from configparser import SafeConfigParser
+import time
+
+from cassandra.concurrent import execute_concurrent_with_args
+
+from coreapis.cassandra_client import Client, LOOKUP_TABLES, lookup_keys, lookup_table_ddl
+from coreapis.utils import get_cassandra_authz
+
+DESCRIPTION = """Check the client and API gatekeeper lookup tables against the
+tables they index.
+
+Reports entries missing from each lookup table and entries pointing to
+rows that no longer have the key. With --create the lookup tables are
+created first. With --fix missing entries are inserted and stale ones
+deleted, after reading their row again in case it changed meanwhile.
+It is safe to run more than once.
+
+Roll the tables out in three steps: run this with --create, set
+lookup_tables_rollout to write on all workers, run this with --fix to
+backfill, and then set lookup_tables_rollout to read."""
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=DESCRIPTION)
+    parser.add_argument('--config', default="production.ini",
+                        help="Config file to use")
+    parser.add_argument('-p', '--cassandra-password',
+                        help='Cassandra password')
+    parser.add_argument('--concurrency', type=int, default=50,
+                        help="Concurrent writes")
+    parser.add_argument('--create', action='store_true',
+                        help="Create missing lookup tables")
+    parser.add_argument('--fix', action='store_true',
+                        help="Insert missing and delete stale lookup entries")
+    return parser.parse_args()
+
+
+def parse_config(filename):
+    parser = SafeConfigParser()
+    parser.read(filename)
+    return {
+        'contact_points': parser['DEFAULT']['cassandra_contact_points'].split(', '),
+        'keyspace': parser['DEFAULT']['cassandra_keyspace'],
+        'cassandra_cacerts': parser['DEFAULT'].get('cassandra_cacerts', None),
+        'cassandra_username': parser['DEFAULT'].get('cassandra_username', None),
+        'cassandra_password': parser['DEFAULT'].get('cassandra_password', None),
+    }
+
+
+def run_concurrent(session, statement, rows, concurrency):
+    for success, result in execute_concurrent_with_args(session, statement, rows,
+                                                        concurrency=concurrency,
+                                                        raise_on_first_error=False):
+        if not success:
+            print('Failed: {}'.format(result))
+
+
+def check_table(session, name, args):
+    table, column, _, _ = LOOKUP_TABLES[name]
+    expected = {(key, row['id'])
+                for row in session.execute('SELECT id, {} FROM {}'.format(column, table))
+                for key in lookup_keys(row, column)}
+    actual = {(row[column], row['id'])
+              for row in session.execute('SELECT {}, id FROM {}'.format(column, name))}
+    missing = sorted(expected - actual, key=str)
+    stale = sorted(actual - expected, key=str)
+    print('{}: {} entries, {} missing, {} stale'.format(name, len(actual), len(missing),
+                                                        len(stale)))
+    if args.fix:
+        insert = session.prepare('INSERT INTO {} ({}, id) VALUES (?, ?)'.format(name, column))
+        run_concurrent(session, insert, missing, args.concurrency)
+        delete = session.prepare('DELETE FROM {} USING TIMESTAMP ? WHERE {} = ? AND id = ?'.format(
+            name, column))
+        run_concurrent(session, delete, recheck_stale(session, table, column, stale),
+                       args.concurrency)
+    return len(missing) + len(stale)
+
+
+def recheck_stale(session, table, column, stale):
+    """Returns the stale entries that are still stale when their row is
+    read again, as delete parameters. Rows may have been written since
+    the table scan. Lookup entries have no writetime of their own, as
+    they are all key, so each is deleted as of just before its row was
+    read again. An entry a worker writes after that is kept."""
+    select = session.prepare('SELECT id, {} FROM {} WHERE id = ?'.format(column, table))
+    result = []
+    for key, itemid in stale:
+        timestamp = int(time.time() * 1000000)
+        rows = list(session.execute(select.bind([itemid])))
+        if rows and key in lookup_keys(rows[0], column):
+            continue
+        result.append([timestamp, key, itemid])
+    return result
+
+
+def main():
+    args = parse_args()
+    config = parse_config(args.config)
+    if args.cassandra_password:
+        config['cassandra_password'] = args.cassandra_password
+    authz = get_cassandra_authz(config)
+    client = Client(config['contact_points'], config['keyspace'], authz=authz)
+    if args.create:
+        for statement in lookup_table_ddl():
+            client.session.execute(statement)
+    problems = sum(check_table(client.session, name, args) for name in sorted(LOOKUP_TABLES))
+    if problems and not args.fix:
+        exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,129 @@
+#! /usr/bin/env python
+import argparse
+from configparser import SafeConfigParser
+import time
+
+from cassandra.concurrent import execute_concurrent_with_args
+
+from coreapis.cassandra_client import Client, GROUP_MEMBERS_BY_USER_DDL
+from coreapis.utils import get_cassandra_authz
+
+DESCRIPTION = """Create group_members_by_user and fill it from group_members.
+
+Roll it out in three steps: run this with --create-only, set
+group_members_by_user_rollout to write on all workers, run this again to
+backfill, and then set group_members_by_user_rollout to read.
+
+Each column is copied with the write time it has in group_members, so
+a copy never overwrites a newer change written by the workers. Rows in
+group_members_by_user that are not in group_members are then deleted,
+in case members were removed while copying. Each is checked again with
+a point read first, and deleted with its own write time, so members
+added meanwhile are kept. It is safe to run more than once."""
+KEY_COLUMNS = ['groupid', 'userid']
+VALUE_COLUMNS = ['type', 'status', 'added_by']
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=DESCRIPTION)
+    parser.add_argument('--config', default="production.ini",
+                        help="Config file to use")
+    parser.add_argument('-p', '--cassandra-password',
+                        help='Cassandra password')
+    parser.add_argument('--concurrency', type=int, default=50,
+                        help="Concurrent writes")
+    parser.add_argument('--dry-run', action='store_true',
+                        help="Only count the rows that would be changed")
+    parser.add_argument('--create-only', action='store_true',
+                        help="Only create the table")
+    return parser.parse_args()
+
+
+def parse_config(filename):
+    parser = SafeConfigParser()
+    parser.read(filename)
+    return {
+        'contact_points': parser['DEFAULT']['cassandra_contact_points'].split(', '),
+        'keyspace': parser['DEFAULT']['cassandra_keyspace'],
+        'cassandra_cacerts': parser['DEFAULT'].get('cassandra_cacerts', None),
+        'cassandra_username': parser['DEFAULT'].get('cassandra_username', None),
+        'cassandra_password': parser['DEFAULT'].get('cassandra_password', None),
+    }
+
+
+def run_concurrent(session, statement, rows, concurrency):
+    for success, result in execute_concurrent_with_args(session, statement, rows,
+                                                        concurrency=concurrency,
+                                                        raise_on_first_error=False):
+        if not success:
+            print('Failed: {}'.format(result))
+
+
+def writetimes(columns):
+    return ','.join('writetime({})'.format(col) for col in columns)
+
+
+def copy_rows(client, args):
+    session = client.session
+    inserts = {col: session.prepare(
+        'INSERT INTO group_members_by_user (groupid, userid, {}) VALUES (?, ?, ?) '
+        'USING TIMESTAMP ?'.format(col)) for col in VALUE_COLUMNS}
+    values = {col: [] for col in VALUE_COLUMNS}
+    count = 0
+    query = 'SELECT {}, {}, {} FROM group_members'.format(
+        ','.join(KEY_COLUMNS), ','.join(VALUE_COLUMNS), writetimes(VALUE_COLUMNS))
+    for row in session.execute(query):
+        count += 1
+        for col in VALUE_COLUMNS:
+            written = row['writetime({})'.format(col)]
+            if written is not None:
+                values[col].append([row['groupid'], row['userid'], row[col], written])
+    print('Copying {} memberships'.format(count))
+    if not args.dry_run:
+        for col in VALUE_COLUMNS:
+            run_concurrent(session, inserts[col], values[col], args.concurrency)
+
+
+def prune_rows(client, args):
+    session = client.session
+    members = {(row['groupid'], row['userid'])
+               for row in session.execute('SELECT groupid, userid FROM group_members')}
+    query = 'SELECT userid, groupid, {} FROM group_members_by_user'.format(
+        writetimes(VALUE_COLUMNS))
+    candidates = [row for row in session.execute(query)
+                  if (row['groupid'], row['userid']) not in members]
+    # Members may have been added since group_members was read
+    check = session.prepare('SELECT userid FROM group_members WHERE groupid = ? AND userid = ?')
+    orphans = []
+    for row in candidates:
+        if list(session.execute(check.bind([row['groupid'], row['userid']]))):
+            continue
+        written = [row['writetime({})'.format(col)] for col in VALUE_COLUMNS]
+        written = [value for value in written if value is not None]
+        # Deleting as of the last write keeps a member added after the check
+        timestamp = max(written) if written else int(time.time() * 1000000)
+        orphans.append([timestamp, row['userid'], row['groupid']])
+    print('Deleting {} memberships no longer in group_members'.format(len(orphans)))
+    if not args.dry_run:
+        delete = session.prepare('DELETE FROM group_members_by_user USING TIMESTAMP ? '
+                                 'WHERE userid = ? AND groupid = ?')
+        run_concurrent(session, delete, orphans, args.concurrency)
+
+
+def main():
+    args = parse_args()
+    config = parse_config(args.config)
+    if args.cassandra_password:
+        config['cassandra_password'] = args.cassandra_password
+    authz = get_cassandra_authz(config)
+    client = Client(config['contact_points'], config['keyspace'], authz=authz)
+    if not args.dry_run:
+        client.session.execute(GROUP_MEMBERS_BY_USER_DDL)
+    if args.create_only:
+        return
+    copy_rows(client, args)
+    prune_rows(client, args)
+
+
+if __name__ == '__main__':
+    main()
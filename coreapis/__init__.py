@@ -12,8 +12,11 @@ import cassandra.util
 import statsd
 
 import coreapis.utils
+from . import cassandra_client
+from .assets import get_default_assets
 from .aaa import TokenAuthenticationPolicy, TokenAuthorizationPolicy
-from .utils import Timer, format_datetime, ResourcePool, LogWrapper, get_cassandra_authz
+from .utils import (Timer, format_datetime, ResourcePool, LogWrapper, get_cassandra_authz,
+                    run_warm_up, NDJSONRenderer)
 
 
 def options(request):
@@ -21,6 +24,15 @@ def options(request):
     return resp
 
 
+def make_json_renderer(**kw):
+    json_renderer = pyramid.renderers.JSON(**kw)
+    json_renderer.add_adapter(datetime.datetime, lambda x, y: format_datetime(x))
+    json_renderer.add_adapter(blist.sortedset, lambda x, y: list(x))
+    json_renderer.add_adapter(uuid.UUID, lambda x, y: str(x))
+    json_renderer.add_adapter(cassandra.util.SortedSet, lambda x, y: list(x))
+    return json_renderer
+
+
 def make_statsd_hostid():
     if 'DOCKER_HOST' in os.environ and 'DOCKER_INSTANCE' in os.environ:
         return '{}.{}'.format(os.environ['DOCKER_HOST'].replace('.', '_'),
@@ -61,11 +73,16 @@ def main(global_config, **settings):
     statsd_port = int(global_config['statsd_port'])
     statsd_prefix = global_config['statsd_prefix']
     timer = Timer(statsd_server, statsd_port,
-                  statsd_prefix, log_timings, pool)
+                  statsd_prefix, log_timings, pool,
+                  float(global_config.get('statsd_flush_interval', '1')),
+                  int(global_config.get('statsd_max_pending', '1000')))
     config.add_settings(statsd_factory=lambda: statsd.StatsClient(statsd_server, statsd_port,
                                                                   prefix=statsd_prefix))
     config.add_renderer('logo', 'coreapis.utils.LogoRenderer')
     contact_points = global_config['cassandra_contact_points'].split(', ')
+    for table in cassandra_client.ROLLOUT:
+        cassandra_client.set_rollout_stage(table, global_config.get('{}_rollout'.format(table),
+                                                                    'off'))
     config.add_settings(cassandra_contact_points=contact_points)
     config.add_settings(cassandra_keyspace=global_config['cassandra_keyspace'])
     config.add_settings(cassandra_authz=get_cassandra_authz(global_config))
@@ -76,6 +93,8 @@ def main(global_config, **settings):
     config.add_settings(statsd_host_factory=lambda: statsd.StatsClient(statsd_server, statsd_port,
                                                                        prefix=statsd_host_prefix))
     config.add_settings(status_data=dict(), status_methods=dict())
+    config.add_settings(warm_up_methods={'cassandra': cassandra_client.warm_up_shared_sessions})
+    get_default_assets(config.get_settings())
 
     config.add_route('pre_flight', pattern='/*path', request_method='OPTIONS')
     config.add_view(options, route_name='pre_flight')
@@ -101,13 +120,11 @@ def main(global_config, **settings):
     config.scan('coreapis.error_views')
     config.add_settings(realm=global_config['oauth_realm'])
     config.add_tween('coreapis.utils.RequestTimingTween')
-    json_renderer = pyramid.renderers.JSON(indent=4)
-    json_renderer.add_adapter(datetime.datetime, lambda x, y: format_datetime(x))
-    json_renderer.add_adapter(blist.sortedset, lambda x, y: list(x))
-    json_renderer.add_adapter(uuid.UUID, lambda x, y: str(x))
-    json_renderer.add_adapter(cassandra.util.SortedSet, lambda x, y: list(x))
-    config.add_renderer('json', json_renderer)
+    config.add_renderer('json', make_json_renderer(indent=4))
+    config.add_renderer('ndjson', NDJSONRenderer(make_json_renderer()))
     status_data = config.get_settings()['status_data']
     set_status_data_docker(status_data)
     set_status_data_build(status_data)
+    run_warm_up(config.get_settings()['warm_up_methods'],
+                global_config.get('warm_up', 'background'), status_data)
     return config.make_wsgi_app()
@@ -5,6 +5,7 @@ import valideer as V
 
 from coreapis import cassandra_client
 from coreapis.crud_base import CrudControllerBase
+from coreapis.imagescale import get_image_scaler
 from coreapis.utils import (LogWrapper, timestamp_adapter, ValidationError, public_userinfo,
                             ResourceError, get_platform_admins, userinfo_for_log,
                             valid_name, valid_description)
@@ -56,6 +57,7 @@ class AdHocGroupAdmController(CrudControllerBase):
         ps_controller = settings.get('ps_controller')
         max_add_members = int(settings.get('adhocgroupadm_max_add_members', '50'))
         super(AdHocGroupAdmController, self).__init__(maxrows)
+        self.image_scaler = get_image_scaler(settings)
         self.session = cassandra_client.Client(contact_points, keyspace, authz=authz)
         platformadmins_file = settings.get('platformadmins_file')
         self.platformadmins = get_platform_admins(platformadmins_file)
@@ -7,6 +7,7 @@ import valideer as V
 
 from coreapis import cassandra_client
 from coreapis.crud_base import CrudControllerBase
+from coreapis.imagescale import get_image_scaler
 from coreapis.clientadm.controller import ClientAdmController
 from coreapis.scopes.manager import ScopesManager
 from coreapis.authproviders import AUTHPROVMGR, REGISTER_APIGK
@@ -70,6 +71,7 @@ class APIGKAdmController(CrudControllerBase):
         authz = settings.get('cassandra_authz')
         maxrows = int(settings.get('apigkadm_maxrows') or 300)
         super(APIGKAdmController, self).__init__(maxrows)
+        self.image_scaler = get_image_scaler(settings)
         self.session = cassandra_client.Client(contact_points, keyspace, authz=authz)
         platformadmins_file = settings.get('platformadmins_file')
         self.platformadmins = get_platform_admins(platformadmins_file)
@@ -0,0 +1,83 @@
+import datetime
+import hashlib
+import os
+import threading
+
+from PIL import Image
+import pytz
+
+from coreapis.imagescale import scale_image
+from coreapis.utils import LogWrapper
+
+DEFAULT_ASSETS_DIR = 'data'
+DEFAULT_ASSET_PREFIX = 'default-'
+# Default images are served as logos and profile thumbnails of this size
+DEFAULT_ASSET_SIZE = 128, 128
+CONTENT_TYPES = {
+    'JPEG': 'image/jpeg',
+    'PNG': 'image/png',
+}
+
+
+class StaticAsset(object):
+    """An image file as served: its bytes, ETag and Last-Modified"""
+    __slots__ = ('data', 'etag', 'last_modified', 'content_type')
+
+    def __init__(self, data, etag, last_modified, content_type):
+        self.data = data
+        self.etag = etag
+        self.last_modified = last_modified
+        self.content_type = content_type
+
+
+def load_asset(path, size):
+    with open(path, 'rb') as fh:
+        data = fh.read()
+    modified = datetime.datetime.fromtimestamp(int(os.path.getmtime(path)), tz=pytz.UTC)
+    with Image.open(path) as image:
+        fmt = image.format
+        too_large = image.size[0] > size[0] or image.size[1] > size[1]
+    if too_large:
+        data = scale_image(data, size, fmt)
+    return StaticAsset(data, hashlib.md5(data).hexdigest(), modified,
+                       CONTENT_TYPES.get(fmt, 'application/octet-stream'))
+
+
+class AssetRegistry(object):
+    """The default images served for objects without one of their own,
+    by path. Each file is read, scaled down to size if needed and hashed
+    once, and then served from memory."""
+    def __init__(self, directory=DEFAULT_ASSETS_DIR, size=DEFAULT_ASSET_SIZE):
+        self.log = LogWrapper('coreapis.AssetRegistry')
+        self.directory = directory
+        self.size = size
+        self.assets = {}
+        self.lock = threading.Lock()
+
+    def get(self, path):
+        asset = self.assets.get(path)
+        if asset is None:
+            with self.lock:
+                asset = self.assets.get(path)
+                if asset is None:
+                    asset = load_asset(path, self.size)
+                    self.assets[path] = asset
+        return asset
+
+    def preload(self):
+        for name in sorted(os.listdir(self.directory)):
+            if name.startswith(DEFAULT_ASSET_PREFIX):
+                self.get(os.path.join(self.directory, name))
+        self.log.info('loaded default assets', count=len(self.assets))
+
+
+def get_default_assets(settings):
+    """Returns the AssetRegistry kept in settings, creating it on first
+    use. It is loaded during warm up."""
+    assets = settings.get('default_assets')
+    if assets is None:
+        assets = AssetRegistry()
+        settings['default_assets'] = assets
+        if 'warm_up_methods' in settings:
+            settings['warm_up_methods']['default_assets'] = assets.preload
+    return assets
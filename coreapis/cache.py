@@ -1,26 +1,252 @@
+from collections import OrderedDict
+import threading
 import time
-from coreapis.utils import LogWrapper
+
+import eventlet
+import eventlet.semaphore
+
+from coreapis.utils import LogWrapper, log_token
+
+
+class _Flight(object):
+    """A fetch in progress. The lock is held by the fetching caller until
+    the result is in, so other callers wait for it by acquiring the lock."""
+    __slots__ = ('lock', 'value', 'error')
+
+    def __init__(self, lock):
+        self.lock = lock
+        self.value = None
+        self.error = None
 
 
 class Cache(object):
-    def __init__(self, expiry, logname):
+    """LRU cache where entries expire after expiry seconds.
+
+    The cache holds at most maxsize entries, or entries with sizes adding
+    up to maxsize if entry_size is overridden. Concurrent misses on a key
+    are coalesced, so only one caller runs the getter and the others wait
+    for its result. If stale is set, an expired entry is served for up to
+    stale seconds more while the value is refreshed in the background.
+    Set use_eventlets when the callers are greenthreads that are not
+    monkey patched. Hit, miss, stale and eviction counts and the cache
+    size are sent to statsd if a timer is given.
+    """
+    def __init__(self, expiry, logname, maxsize=1000, stale=0, timer=None,
+                 counter_prefix=None, use_eventlets=False):
         self.log = LogWrapper(logname)
-        self.data = dict()
         self.expiry = expiry
+        self.maxsize = maxsize
+        self.stale = stale
+        self.timer = timer
+        self.counter_prefix = counter_prefix or logname
+        self.use_eventlets = use_eventlets
+        self.data = OrderedDict()
+        self.used = 0
+        self.lock = self._make_lock()
+        self.inflight = {}
+        self.epoch = 0
 
-    def _set(self, key, value):
-        self.data[key] = (time.time(), value)
-        return value
+    def _make_lock(self):
+        if self.use_eventlets:
+            return eventlet.semaphore.Semaphore()
+        return threading.Lock()
+
+    def _spawn(self, func, *args):
+        if self.use_eventlets:
+            eventlet.spawn_n(func, *args)
+        else:
+            threading.Thread(target=func, args=args, daemon=True).start()
+
+    def _count(self, name):
+        if self.timer:
+            self.timer.incr('{}.{}'.format(self.counter_prefix, name))
 
-    def _update(self, key, getter):
-        return self._set(key, getter())
+    def entry_expiry(self, value):  # pylint: disable=unused-argument
+        """Returns the number of seconds value should be cached"""
+        return self.expiry
+
+    def entry_size(self, value):  # pylint: disable=unused-argument
+        """Returns how much of maxsize value takes up"""
+        return 1
+
+    def _lookup(self, key):
+        """Returns (fresh, value) for key, or None if there is no usable entry"""
+        with self.lock:
+            entry = self.data.get(key)
+            if entry is None:
+                return None
+            expires, value, size = entry
+            age = time.time() - expires
+            if age >= self.stale:
+                del self.data[key]
+                self.used -= size
+                return None
+            self.data.move_to_end(key)
+            return age < 0, value
+
+    def _store(self, key, epoch, value):
+        expires = time.time() + self.entry_expiry(value)
+        size = self.entry_size(value)
+        evicted = 0
+        with self.lock:
+            if epoch != self.epoch:
+                # Entry was invalidated while we were fetching it
+                return
+            old = self.data.pop(key, None)
+            if old is not None:
+                self.used -= old[2]
+            self.data[key] = (expires, value, size)
+            self.used += size
+            while self.used > self.maxsize and self.data:
+                _, (_, _, oldsize) = self.data.popitem(last=False)
+                self.used -= oldsize
+                evicted += 1
+            used = self.used
+        if evicted:
+            self._count('eviction')
+        if self.timer:
+            self.timer.gauge('{}.size'.format(self.counter_prefix), used)
+
+    def _fetch(self, key, getter):
+        with self.lock:
+            flight = self.inflight.get(key)
+            leader = flight is None
+            if leader:
+                flight = _Flight(self._make_lock())
+                flight.lock.acquire()
+                self.inflight[key] = flight
+            epoch = self.epoch
+        if not leader:
+            with flight.lock:
+                pass
+            if flight.error is not None:
+                raise flight.error
+            return flight.value
+        try:
+            flight.value = getter()
+            self._store(key, epoch, flight.value)
+            return flight.value
+        except Exception as ex:
+            flight.error = ex
+            raise
+        finally:
+            with self.lock:
+                del self.inflight[key]
+            flight.lock.release()
+
+    def _refresh(self, key, getter):
+        try:
+            self._fetch(key, getter)
+        except Exception as ex:  # pylint: disable=broad-except
+            self.log.warn('cache refresh failed', key=key, exception=str(ex))
 
     def get(self, key, getter):
-        if key not in self.data:
+        cached = self._lookup(key)
+        if cached is None:
+            self._count('miss')
             self.log.debug('cache miss', key=key)
-            return self._update(key, getter)
-        ts, cached = self.data.get(key)
-        if ts + self.expiry < time.time():
-            self.log.debug('cache expired', key=key)
-            return self._update(key, getter)
-        return cached
+            return self._fetch(key, getter)
+        fresh, value = cached
+        if fresh:
+            self._count('hit')
+            return value
+        self._count('stale')
+        self.log.debug('cache stale', key=key)
+        if key not in self.inflight:
+            self._spawn(self._refresh, key, getter)
+        return value
+
+    def peek(self, key):
+        """Returns the value for key if it is cached and fresh, or None"""
+        cached = self._lookup(key)
+        if cached is None or not cached[0]:
+            return None
+        return cached[1]
+
+    def set(self, key, value):
+        """Stores value for key, replacing any entry"""
+        with self.lock:
+            epoch = self.epoch
+        self._store(key, epoch, value)
+
+    def invalidate(self, key):
+        with self.lock:
+            self.epoch += 1
+            entry = self.data.pop(key, None)
+            if entry is None:
+                return False
+            self.used -= entry[2]
+            return True
+
+    def invalidate_matching(self, predicate):
+        """Drops the entries for which predicate(key, value) is true, and
+        returns how many were dropped"""
+        with self.lock:
+            self.epoch += 1
+            keys = [key for key, (_, value, _) in self.data.items() if predicate(key, value)]
+            for key in keys:
+                self.used -= self.data.pop(key)[2]
+            return len(keys)
+
+    def clear(self):
+        with self.lock:
+            self.epoch += 1
+            self.data.clear()
+            self.used = 0
+
+
+def token_expiry(ttl, token):
+    """Returns the number of seconds token may be cached: ttl, but never
+    past its validuntil"""
+    validuntil = token.get('validuntil')
+    if validuntil is None:
+        return ttl
+    return min(ttl, validuntil.timestamp() - time.time())
+
+
+class TokenCache(Cache):
+    """Bounded LRU cache of token lookups, keyed by token uuid.
+
+    Cached lookups never outlive the token's validuntil. Lookups failing
+    with KeyError are remembered for negative_ttl seconds, so unknown or
+    invalid tokens do not reach the database on every request.
+
+    Entries are only invalidated when the token is deleted in this same
+    process. A token revoked or deleted elsewhere, by another worker or
+    another app, stays valid here for up to ttl seconds, so ttl bounds
+    how long revocation takes.
+    """
+    def __init__(self, maxsize, ttl, negative_ttl, timer, counter_prefix='auth.token_cache'):
+        super(TokenCache, self).__init__(ttl, 'coreapis.TokenCache', maxsize, 0, timer,
+                                         counter_prefix)
+        self.negative_ttl = negative_ttl
+
+    def entry_expiry(self, value):
+        missing, lookup = value
+        if missing:
+            return self.negative_ttl
+        return token_expiry(self.expiry, lookup[0])
+
+    def get(self, key, getter):
+        """Returns getter() for key, which must return a (token, client, user) tuple"""
+        def fetch():
+            try:
+                return False, getter()
+            except KeyError as ex:
+                return True, ex.args
+
+        missing, value = super(TokenCache, self).get(key, fetch)
+        if missing:
+            raise KeyError(*value)
+        return value
+
+    def invalidate(self, key):
+        if super(TokenCache, self).invalidate(key):
+            self.log.debug('token invalidated', accesstoken=log_token(key))
+
+
+class SubtokenCache(Cache):
+    """Bounded LRU cache of token rows, keyed by token uuid. Cached rows
+    never outlive the token's validuntil."""
+    def entry_expiry(self, value):
+        return token_expiry(self.expiry, value)
@@ -1,16 +1,228 @@
 #! /usr/bin/env python
+from collections import defaultdict
+import concurrent.futures
 import contextlib
 import datetime
 import json
+import re
+import threading
+import uuid
 
 from cassandra.cluster import Cluster  # pylint: disable=no-name-in-module
 import cassandra
 import cassandra.concurrent
-from cassandra.query import dict_factory  # pylint: disable=no-name-in-module
+from cassandra.query import (  # pylint: disable=no-name-in-module
+    dict_factory, BatchStatement, BatchType)
 import pytz
 
 from coreapis.utils import LogWrapper, now, translatable, get_cassandra_cluster_args
 
+NULL_USER = uuid.UUID('00000000-0000-0000-0000-000000000000')
+CHANGE_LISTENERS = defaultdict(list)
+CLUSTERS = {}
+SESSIONS = {}
+SESSIONS_LOCK = threading.Lock()
+WARM_UP_PARALLELISM = 10
+
+# How far each denormalized table has been rolled out, set with
+# set_rollout_stage. 'off': neither written nor read. 'write': written
+# together with its source table, which is still read. 'read': written
+# and read. Tables must be created before 'write' and backfilled before
+# 'read'.
+ROLLOUT_STAGES = ('off', 'write', 'read')
+ROLLOUT = {
+    'group_members_by_user': 'off',
+    'lookup_tables': 'off',
+}
+
+# group_members partitioned by user, so a user's memberships are read
+# from a single partition. Written together with group_members in
+# logged batches; bin/migrate-group-members-by-user.py creates and
+# backfills it.
+GROUP_MEMBERS_BY_USER_DDL = '''CREATE TABLE IF NOT EXISTS group_members_by_user (
+    userid uuid,
+    groupid uuid,
+    type text,
+    status text,
+    added_by uuid,
+    PRIMARY KEY (userid, groupid)
+)'''
+
+# Lookup tables replacing secondary index and ALLOW FILTERING queries, as
+# name: (table, column, column type, id type). Each maps the value of
+# column, or each element for set columns, to the ids of the rows having
+# it. They are written in the same logged batch as the row once rolled
+# out, and bin/check-lookup-tables.py creates, backfills and repairs them.
+LOOKUP_TABLES = {
+    'clients_by_owner': ('clients', 'owner', 'uuid', 'uuid'),
+    'clients_by_organization': ('clients', 'organization', 'text', 'uuid'),
+    'clients_by_admin': ('clients', 'admins', 'text', 'uuid'),
+    'clients_by_scope': ('clients', 'scopes', 'text', 'uuid'),
+    'clients_by_scope_requested': ('clients', 'scopes_requested', 'text', 'uuid'),
+    'apigk_by_owner': ('apigk', 'owner', 'uuid', 'text'),
+    'apigk_by_organization': ('apigk', 'organization', 'text', 'text'),
+    'apigk_by_admin': ('apigk', 'admins', 'text', 'text'),
+}
+LOOKUP_TABLE_DDL = 'CREATE TABLE IF NOT EXISTS {} ({} {}, id {}, PRIMARY KEY ({}, id))'
+SELECTOR = re.compile(r'^(\w+) (=|contains) \?$', re.IGNORECASE)
+
+# The user columns needed by utils.public_userinfo
+PUBLIC_USER_COLUMNS = ['userid', 'name', 'selectedsource', 'userid_sec']
+
+# Primary key lookups on hot request paths, as (table, columns, idcolumns).
+# columns None means the table's default columns.
+CATALOGUE_LOOKUPS = [
+    ('oauth_tokens', ['*'], ['access_token']),
+    ('clients', None, ['id']),
+    ('users', None, ['userid']),
+    ('users', PUBLIC_USER_COLUMNS, ['userid']),
+    ('userid_sec', ['userid'], ['userid_sec']),
+    ('apigk', None, ['id']),
+    ('groups', None, ['id']),
+    ('group_members', ['*'], ['groupid', 'userid']),
+    ('organizations', None, ['id']),
+    ('organizations', None, ['realm']),
+    ('clients_counters', None, ['id']),
+]
+
+# Lookup table reads used on hot request paths
+LOOKUP_CATALOGUE_QUERIES = [
+    'SELECT id FROM clients_by_owner WHERE owner = ?',
+    'SELECT id FROM clients_by_admin WHERE admins = ?',
+    'SELECT id FROM apigk_by_owner WHERE owner = ?',
+    'SELECT id FROM apigk_by_admin WHERE admins = ?',
+]
+
+# Other statements used on hot request paths
+CATALOGUE_QUERIES = [
+    'SELECT * FROM oauth_authorizations WHERE userid = ?',
+    'SELECT * FROM group_members WHERE groupid=?',
+    'SELECT role from orgroles where identity = ? AND orgid = ?',
+    'SELECT clientid from mandatory_clients where realm = ?',
+    'SELECT dn from remote_apigatekeepers WHERE dn = ?',
+]
+
+
+class SharedSession(object):
+    def __init__(self, session):
+        self.session = session
+        self.prepared = {}
+        self.catalogue = set()
+        self.log = LogWrapper('coreapis.cassandraclient')
+
+    def _try_prepare(self, query):
+        try:
+            return self.session.prepare(query)
+        except Exception as ex:  # pylint: disable=broad-except
+            self.log.warn('Failed to prepare statement', query=query, exception=str(ex))
+            return None
+
+    def warm_up(self, max_parallel=WARM_UP_PARALLELISM):
+        """Prepares all statements in the catalogue that are not prepared
+        yet, max_parallel at a time. Returns the number of statements
+        prepared."""
+        todo = [query for query in sorted(self.catalogue) if query not in self.prepared]
+        if not todo:
+            return 0
+        with concurrent.futures.ThreadPoolExecutor(max_parallel) as executor:
+            results = list(executor.map(self._try_prepare, todo))
+        count = 0
+        for query, prep in zip(todo, results):
+            if prep is not None:
+                self.prepared.setdefault(query, prep)
+                count += 1
+        return count
+
+
+def _authz_key(authz):
+    if not authz:
+        return None
+    return tuple(sorted(authz.items()))
+
+
+def get_shared_session(contact_points, keyspace, connection_class=None, authz=None):
+    """Returns the process-wide SharedSession for keyspace, connecting on
+    first use. One Cluster is kept per contact points, connection class
+    and credentials, and one session per keyspace on that cluster, so
+    all Clients in a worker share sockets and prepared statements."""
+    cluster_key = (tuple(contact_points), connection_class, _authz_key(authz))
+    session_key = cluster_key + (keyspace,)
+    with SESSIONS_LOCK:
+        if session_key not in SESSIONS:
+            if cluster_key not in CLUSTERS:
+                cluster_args = get_cassandra_cluster_args(contact_points, connection_class,
+                                                          authz)
+                CLUSTERS[cluster_key] = Cluster(**cluster_args)
+            session = CLUSTERS[cluster_key].connect(keyspace)
+            session.row_factory = datetime_hack_dict_factory
+            session.default_consistency_level = cassandra.ConsistencyLevel.LOCAL_QUORUM
+            SESSIONS[session_key] = SharedSession(session)
+        return SESSIONS[session_key]
+
+
+def shutdown_shared_sessions():
+    with SESSIONS_LOCK:
+        for cluster in CLUSTERS.values():
+            cluster.shutdown()
+        CLUSTERS.clear()
+        SESSIONS.clear()
+
+
+def warm_up_shared_sessions(max_parallel=WARM_UP_PARALLELISM):
+    """Prepares the statement catalogues of all shared sessions in this
+    process"""
+    with SESSIONS_LOCK:
+        sessions = list(SESSIONS.values())
+    return sum(shared.warm_up(max_parallel) for shared in sessions)
+
+
+def set_rollout_stage(name, stage):
+    if stage not in ROLLOUT_STAGES:
+        raise ValueError('Unknown rollout stage for {}: {}'.format(name, stage))
+    ROLLOUT[name] = stage
+
+
+def rollout_writes(name):
+    return ROLLOUT[name] != 'off'
+
+
+def rollout_reads(name):
+    return ROLLOUT[name] == 'read'
+
+
+def add_change_listener(table, callback):
+    """Registers callback(key) to be called whenever a Client in this
+    process changes or deletes the row identified by key in table.
+    Used to invalidate in-process caches."""
+    CHANGE_LISTENERS[table].append(callback)
+
+
+def notify_change(table, key):
+    for callback in CHANGE_LISTENERS[table]:
+        callback(key)
+
+
+def lookup_tables(table):
+    """Returns the lookup tables of table, as {column: lookup table}"""
+    return {column: name for name, (base, column, _, _) in LOOKUP_TABLES.items()
+            if base == table}
+
+
+def lookup_table_ddl():
+    return [LOOKUP_TABLE_DDL.format(name, column, ctype, idtype, column)
+            for name, (_, column, ctype, idtype) in sorted(LOOKUP_TABLES.items())]
+
+
+def lookup_keys(row, column):
+    """Returns the keys under which row is found in column's lookup table.
+    Empty strings are left out, as Cassandra does not allow empty keys."""
+    value = row.get(column) if row else None
+    if value is None:
+        return set()
+    if isinstance(value, (str, uuid.UUID)):
+        value = [value]
+    return {key for key in value if key != ''}
+
 
 def parse_apigk(obj):
     for key in ('scopedef', 'trust'):
@@ -45,9 +257,9 @@ class Client(object):
             from cassandra.io.eventletreactor import EventletConnection
             connection_class = EventletConnection
             self.log.info("Using eventlet based cassandra connection")
-        cluster_args = get_cassandra_cluster_args(contact_points, connection_class, authz)
-        cluster = Cluster(**cluster_args)
-        self.prepared = {}
+        shared = get_shared_session(contact_points, keyspace, connection_class, authz)
+        self.session = shared.session
+        self.prepared = shared.prepared
         self.default_columns = {
             'clients': [
                 'owner', 'name', 'type', 'status', 'scopes_requested',
@@ -65,6 +277,7 @@ class Client(object):
                 'id', 'created', 'descr', 'name', 'owner', 'public', 'updated',
                 'invitation_token'],
             'group_members': ['userid', 'groupid', 'status', 'type', 'added_by'],
+            'group_members_by_user': ['userid', 'groupid', 'status', 'type', 'added_by'],
             'organizations': [
                 'organization_number', 'type', 'realm', 'id', 'name', 'fs_groups', 'services',
                 'uiinfo'],
@@ -80,10 +293,20 @@ class Client(object):
             'organizations': ['uiinfo'],
             'orgroles': []
         }
-        self.session = cluster.connect(keyspace)
-        self.session.row_factory = datetime_hack_dict_factory
-        self.session.default_consistency_level = cassandra.ConsistencyLevel.LOCAL_QUORUM
         self.timer = DummyTimer()
+        self.shared = shared
+        shared.catalogue.update(self.statement_catalogue())
+
+    def statement_catalogue(self):
+        """Statements to prepare when the shared session is warmed up"""
+        queries = [self._get_query(table, columns, idcolumns)
+                   for table, columns, idcolumns in CATALOGUE_LOOKUPS] + CATALOGUE_QUERIES
+        if rollout_reads('lookup_tables'):
+            queries += LOOKUP_CATALOGUE_QUERIES
+        return queries
+
+    def warm_up(self, max_parallel=WARM_UP_PARALLELISM):
+        return self.shared.warm_up(max_parallel)
 
     def _prepare(self, query):
         if query in self.prepared:
@@ -92,12 +315,14 @@ class Client(object):
         self.prepared[query] = prep
         return prep
 
-    def _get_statement(self, table, columns=None, idcolumns=('id',)):
+    def _get_query(self, table, columns=None, idcolumns=('id',)):
         if columns is None:
             columns = self.default_columns[table]
         where = ' AND '.join(('{} = ?'.format(col) for col in idcolumns))
-        stmt = 'SELECT {} FROM {} WHERE {}'.format(','.join(columns), table, where)
-        return self._prepare(stmt)
+        return 'SELECT {} FROM {} WHERE {}'.format(','.join(columns), table, where)
+
+    def _get_statement(self, table, columns=None, idcolumns=('id',)):
+        return self._prepare(self._get_query(table, columns, idcolumns))
 
     def _get_compound_pk(self, table, idvs, columns, idcolumns):
         prep = self._get_statement(table, columns, idcolumns)
@@ -110,6 +335,17 @@ class Client(object):
     def _get(self, table, idv, columns=None, idcolumn='id'):
         return self._get_compound_pk(table, [idv], columns, [idcolumn])
 
+    def _get_async(self, table, idv, columns=None, idcolumn='id'):
+        prep = self._get_statement(table, columns, [idcolumn])
+        return self.session.execute_async(prep.bind([idv]))
+
+    @staticmethod
+    def _get_result(table, future):
+        try:
+            return next(iter(future.result()))
+        except StopIteration:
+            raise KeyError('{} entry not found'.format(table))
+
     def _get_concurrent(self, statement, ids):
         output = {}
         if ids and not isinstance(ids[0], tuple):
@@ -139,7 +375,69 @@ class Client(object):
         prep = self._prepare(stmt)
         jsoncols = set(self.json_columns[tablename])
         bindvals = [self.val_to_store(data, colname, jsoncols) for colname in table_columns]
-        self.session.execute(prep.bind(bindvals))
+        if lookup_tables(tablename):
+            self._write_with_lookups(tablename, data['id'], prep, bindvals, data)
+        else:
+            self.session.execute(prep.bind(bindvals))
+
+    def _write_with_lookups(self, table, itemid, prep, values, new):
+        """Executes prep with values, which changes the row itemid of table
+        to new (None when deleting it), in a logged batch with the needed
+        lookup table changes once they are rolled out"""
+        if not rollout_writes('lookup_tables'):
+            self.session.execute(prep.bind(values))
+            return
+        lookups = lookup_tables(table)
+        try:
+            old = self._get(table, itemid, sorted(lookups))
+        except KeyError:
+            old = None
+        batch = BatchStatement(batch_type=BatchType.LOGGED)
+        batch.add(prep, values)
+        for column, name in sorted(lookups.items()):
+            new_keys = lookup_keys(new, column)
+            for key in lookup_keys(old, column) - new_keys:
+                batch.add(self._prepare('DELETE FROM {} WHERE {} = ? AND id = ?'.format(
+                    name, column)), [key, itemid])
+            # Rewritten even if unchanged, to repair lost entries
+            for key in new_keys:
+                batch.add(self._prepare('INSERT INTO {} ({}, id) VALUES (?, ?)'.format(
+                    name, column)), [key, itemid])
+        self.session.execute(batch)
+
+    def _get_by_lookup(self, table, column, key, fallback):
+        """Returns the rows of table with key in column, found through the
+        column's lookup table. Entries the row no longer matches are skipped.
+        Until the lookup tables are rolled out, the fallback query is run
+        with key instead."""
+        if not rollout_reads('lookup_tables'):
+            with self.timer.time('cassandra.get_by_index.{}.{}'.format(table, column)):
+                return self.session.execute(self._prepare(fallback).bind([key]))
+        name = lookup_tables(table)[column]
+        with self.timer.time('cassandra.get_by_lookup.{}'.format(name)):
+            prep = self._prepare('SELECT id FROM {} WHERE {} = ?'.format(name, column))
+            ids = [row['id'] for row in self.session.execute(prep.bind([key]))]
+            rows = self._get_concurrent(self._get_statement(table), ids)
+        return [rows[itemid] for itemid in ids
+                if itemid in rows and key in lookup_keys(rows[itemid], column)]
+
+    def _get_selected(self, table, selectors, values, maxrows):
+        """Like get_generic, but if a selector is on a column with a lookup
+        table, reads the candidate rows through it and applies the other
+        selectors here instead of filtering the whole table"""
+        matches = [SELECTOR.match(selector) for selector in selectors]
+        if (not rollout_reads('lookup_tables') or not selectors or
+                len(selectors) != len(values) or not all(matches)):
+            return self.get_generic(table, selectors, values, maxrows)
+        conditions = [(match.group(1), value) for match, value in zip(matches, values)]
+        lookups = lookup_tables(table)
+        for column, key in conditions:
+            if column in lookups:
+                rows = self._get_by_lookup(table, column, key, None)
+                return [row for row in rows
+                        if all(value in lookup_keys(row, col) for col, value in conditions)
+                        ][:maxrows]
+        return self.get_generic(table, selectors, values, maxrows)
 
     def insert_client(self, client):
         self.insert_generic(client, 'clients')
@@ -166,23 +464,19 @@ class Client(object):
         return res
 
     def get_clients(self, selectors, values, maxrows):
-        return self.get_generic('clients', selectors, values, maxrows)
+        return self._get_selected('clients', selectors, values, maxrows)
 
     def get_clients_by_owner(self, owner):
-        prep = self._prepare('SELECT * from clients WHERE owner = ?')
-        with self.timer.time('cassandra.get_clients_by_owner'):
-            res = self.session.execute(prep.bind([owner]))
-        return res
+        return self._get_by_lookup('clients', 'owner', owner,
+                                   'SELECT * from clients WHERE owner = ?')
 
     def get_clients_by_scope(self, scope):
-        prep = self._prepare('SELECT * from clients WHERE scopes CONTAINS ?')
-        res = self.session.execute(prep.bind([scope]))
-        return res
+        return self._get_by_lookup('clients', 'scopes', scope,
+                                   'SELECT * from clients WHERE scopes CONTAINS ?')
 
     def get_clients_by_scope_requested(self, scope):
-        prep = self._prepare('SELECT * from clients WHERE scopes_requested CONTAINS ?')
-        res = self.session.execute(prep.bind([scope]))
-        return res
+        return self._get_by_lookup('clients', 'scopes_requested', scope,
+                                   'SELECT * from clients WHERE scopes_requested CONTAINS ?')
 
     def add_client_counters(self, clients):
         ids = [c['id'] for c in clients]
@@ -195,7 +489,7 @@ class Client(object):
     def delete_client(self, clientid):
         prep = self._prepare('DELETE FROM clients WHERE id = ?')
         with self.timer.time('cassandra.delete_client'):
-            self.session.execute(prep.bind([clientid]))
+            self._write_with_lookups('clients', clientid, prep, [clientid], None)
             authzq = self._prepare('SELECT userid FROM oauth_authorizations WHERE clientid = ?')
             userids = self.session.execute(authzq.bind([clientid]))
             for row in userids:
@@ -213,6 +507,54 @@ class Client(object):
     def get_token(self, tokenid):
         return self._get('oauth_tokens', tokenid, ['*'], 'access_token')
 
+    def get_client_and_user(self, clientid, userid):
+        client_future = self._get_async('clients', clientid)
+        user_future = None
+        if userid is not None and userid != NULL_USER:
+            user_future = self._get_async('users', userid, None, 'userid')
+        client = self._get_result('clients', client_future)
+        user = None
+        if user_future is not None:
+            user = self._get_result('users', user_future)
+        return client, user
+
+    def get_token_context(self, tokenid, validate=None):
+        """Returns the token with its client and user. The client and user
+        are fetched in parallel once the token is known. user is None for
+        tokens not bound to a user. If validate is given and returns False
+        for the token, KeyError is raised before looking up the rest."""
+        with self.timer.time('cassandra.get_token_context'):
+            token = self._get_valid_token(tokenid, validate)
+            client, user = self.get_client_and_user(token['clientid'], token.get('userid'))
+            return token, client, user
+
+    def get_gk_token_context(self, tokenid, backend, validate=None):
+        """Like get_token_context, but also returns the token's subtoken
+        for the API gatekeeper backend, fetched in parallel with the client
+        and user. subtoken is None if the token has no subtoken for backend
+        or the subtoken is not found."""
+        with self.timer.time('cassandra.get_gk_token_context'):
+            token = self._get_valid_token(tokenid, validate)
+            subtoken_future = None
+            subtokenid = (token.get('subtokens') or {}).get(backend)
+            if subtokenid is not None:
+                subtoken_future = self._get_async('oauth_tokens', subtokenid, ['*'],
+                                                  'access_token')
+            client, user = self.get_client_and_user(token['clientid'], token.get('userid'))
+            subtoken = None
+            if subtoken_future is not None:
+                try:
+                    subtoken = self._get_result('oauth_tokens', subtoken_future)
+                except KeyError:
+                    pass
+            return token, client, user, subtoken
+
+    def _get_valid_token(self, tokenid, validate):
+        token = self.get_token(tokenid)
+        if validate is not None and not validate(token):
+            raise KeyError('Token is invalid')
+        return token
+
     def get_tokens_by_scope(self, scope):
         prep = self._prepare('SELECT * FROM oauth_tokens WHERE scope contains ?')
         return self.session.execute(prep.bind([scope]))
@@ -220,6 +562,7 @@ class Client(object):
     def update_token_scopes(self, access_token, scopes):
         prep = self._prepare('UPDATE oauth_tokens SET scope = ? WHERE access_token = ?')
         self.session.execute(prep.bind([scopes, access_token]))
+        notify_change('oauth_tokens', access_token)
 
     def get_user_by_id(self, userid):
         return self._get('users', userid, None, 'userid')
@@ -228,6 +571,11 @@ class Client(object):
         statement = self._get_statement('users', None, ['userid'])
         return self._get_concurrent(statement, userids)
 
+    def get_public_users(self, userids):
+        """Like get_users, but only fetches the columns needed by public_userinfo"""
+        statement = self._get_statement('users', PUBLIC_USER_COLUMNS, ['userid'])
+        return self._get_concurrent(statement, userids)
+
     def get_user_profilephoto(self, userid):
         userinfo = self._get('users', userid,
                              ['selectedsource', 'profilephoto', 'updated'], 'userid')
@@ -277,14 +625,16 @@ class Client(object):
         return parse_apigk(self._get('apigk', gkid))
 
     def get_apigks(self, selectors, values, maxrows):
-        return [parse_apigk(gk) for gk in self.get_generic('apigk', selectors, values, maxrows)]
+        return [parse_apigk(gk) for gk in self._get_selected('apigk', selectors, values, maxrows)]
 
     def delete_apigk(self, gkid):
         prep = self._prepare('DELETE FROM apigk WHERE id = ?')
-        self.session.execute(prep.bind([gkid]))
+        self._write_with_lookups('apigk', gkid, prep, [gkid], None)
+        notify_change('apigk', gkid)
 
     def insert_apigk(self, apigk):
         self.insert_generic(apigk, 'apigk')
+        notify_change('apigk', apigk['id'])
 
     def _get_logo(self, table, idvalue):
         res = self._get(table, idvalue, ['logo', 'updated'])
@@ -308,6 +658,7 @@ class Client(object):
         prep = self._prepare('DELETE FROM oauth_tokens WHERE access_token = ?')
         prep.consistency_level = cassandra.ConsistencyLevel.ALL
         self.session.execute(prep.bind([token]))
+        notify_change('oauth_tokens', token)
 
     def delete_authorization(self, userid, clientid):
         stmt = 'DELETE FROM oauth_authorizations WHERE userid = ? AND clientid = ?'
@@ -344,6 +695,7 @@ class Client(object):
     def delete_group(self, groupid):
         prep = self._prepare('DELETE FROM groups WHERE id = ?')
         self.session.execute(prep.bind([groupid]))
+        notify_change('groups', groupid)
 
     def insert_group(self, group):
         prep = self._prepare(
@@ -359,6 +711,7 @@ class Client(object):
             group['public'],
             group['invitation_token'],
         ]))
+        notify_change('groups', group['id'])
 
     def get_group_logo(self, groupid):
         return self._get_logo('groups', groupid)
@@ -370,23 +723,33 @@ class Client(object):
         prep = self._prepare('SELECT * FROM group_members WHERE groupid=?')
         return self.session.execute(prep.bind([groupid]))
 
+    def _update_group_member(self, query, values):
+        """Runs query on group_members, and on group_members_by_user in
+        the same logged batch once it is rolled out, so the tables do not
+        drift apart"""
+        batch = BatchStatement(batch_type=BatchType.LOGGED)
+        batch.add(self._prepare(query.format('group_members')), values)
+        if rollout_writes('group_members_by_user'):
+            batch.add(self._prepare(query.format('group_members_by_user')), values)
+        self.session.execute(batch)
+        notify_change('group_members', values[1])
+
     def add_group_member(self, groupid, userid, mtype, status, added_by):
-        prep = self._prepare(
-            'INSERT INTO group_members (groupid, userid, type, status, added_by) ' +
-            'values (?,?,?,?,?)')
-        self.session.execute(prep.bind([groupid, userid, mtype, status, added_by]))
+        self._update_group_member(
+            'INSERT INTO {} (groupid, userid, type, status, added_by) values (?,?,?,?,?)',
+            [groupid, userid, mtype, status, added_by])
 
     def set_group_member_status(self, groupid, userid, status):
-        prep = self._prepare('INSERT INTO group_members (groupid, userid, status) values (?,?,?)')
-        self.session.execute(prep.bind([groupid, userid, status]))
+        self._update_group_member('INSERT INTO {} (groupid, userid, status) values (?,?,?)',
+                                  [groupid, userid, status])
 
     def set_group_member_type(self, groupid, userid, mtype):
-        prep = self._prepare('INSERT INTO group_members (groupid, userid, type) values (?,?,?)')
-        self.session.execute(prep.bind([groupid, userid, mtype]))
+        self._update_group_member('INSERT INTO {} (groupid, userid, type) values (?,?,?)',
+                                  [groupid, userid, mtype])
 
     def del_group_member(self, groupid, userid):
-        prep = self._prepare('DELETE FROM group_members WHERE groupid = ? AND userid = ?')
-        self.session.execute(prep.bind([groupid, userid]))
+        self._update_group_member('DELETE FROM {} WHERE groupid = ? AND userid = ?',
+                                  [groupid, userid])
 
     def get_membership_data(self, groupid, userid):
         return self._get_compound_pk('group_members', [groupid, userid],
@@ -401,6 +764,9 @@ class Client(object):
         if status is not None:
             selectors.append('status = ?')
             values.append(status)
+        if rollout_reads('group_members_by_user'):
+            # Any filtering is within the user's partition
+            return self.get_generic('group_members_by_user', selectors, values, maxrows)
         return self.get_generic('group_members', selectors, values, maxrows)
 
     def insert_grep_code(self, grep):
@@ -412,6 +778,10 @@ class Client(object):
     def get_grep_code(self, grepid):
         return self._get('grep_codes', grepid, ['*'])
 
+    def list_grep_codes(self):
+        prep = self._prepare('SELECT * FROM grep_codes')
+        return self.session.execute(prep)
+
     def get_grep_code_by_code(self, code, greptype):
         prep = self._prepare('SELECT * from grep_codes WHERE code = ? and type = ? ALLOW FILTERING')
         data = list(self.session.execute(prep.bind([code, greptype])))
@@ -451,10 +821,12 @@ class Client(object):
 
     def insert_org(self, org):
         self.insert_generic(org, 'organizations')
+        notify_change('organizations', org['id'])
 
     def delete_org(self, orgid):
         prep = self._prepare('DELETE FROM organizations WHERE id = ?')
         self.session.execute(prep.bind([orgid]))
+        notify_change('organizations', orgid)
 
     def get_org_logo(self, orgid):
         res = self._get('organizations', orgid, ['logo', 'logo_updated'])
@@ -465,14 +837,6 @@ class Client(object):
         prep = self._prepare(stmt)
         self.session.execute(prep.bind([itemid, data, updated]))
 
-    def org_use_fs_groups(self, realm):
-        prep = self._prepare('SELECT id FROM organizations WHERE realm = ?'
-                             ' and services contains \'fsgroups\' ALLOW FILTERING')
-        res = list(self.session.execute(prep.bind([realm])))
-        if not res:
-            return False
-        return True
-
     def is_org_admin(self, identity, orgid):
         prep = self._prepare('SELECT role from orgroles where identity = ? AND orgid = ?')
         res = list(self.session.execute(prep.bind([identity, orgid])))
@@ -497,11 +861,13 @@ class Client(object):
         stmt = 'UPDATE organizations set services = services + ? WHERE id = ?'
         prep = self._prepare(stmt)
         self.session.execute(prep.bind([services, org]))
+        notify_change('organizations', org)
 
     def del_services(self, org, services):
         stmt = 'UPDATE organizations set services = services - ? WHERE id = ?'
         prep = self._prepare(stmt)
         self.session.execute(prep.bind([services, org]))
+        notify_change('organizations', org)
 
     def get_roles(self, selectors, values, maxrows):
         return self.get_generic('orgroles', selectors, values, maxrows)
@@ -0,0 +1,147 @@
+from collections import deque
+import functools
+import time
+
+from coreapis.utils import LogWrapper
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+# Timeouts are this many times the observed p99 latency
+TIMEOUT_P99_FACTOR = 2
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+class CircuitBreaker(object):
+    """Tracks the outcome of recent calls to a dependency, and stops
+    calling it while it is failing.
+
+    A call fails if it raises or takes longer than slow_call seconds.
+    When at least min_calls of the last window calls are recorded and
+    the share of failures reaches failure_rate, the breaker opens and
+    calls are refused for open_time seconds. Then a single probe call
+    is let through: the breaker closes if it succeeds, and opens again
+    if it fails.
+
+    timeout() suggests a timeout for the next call, derived from the
+    p99 latency of recent calls and kept between min_timeout and
+    max_timeout. Calls that time out count with their timeout, so a
+    backend that gets slower gets longer timeouts. Probes get
+    max_timeout. Not thread safe; meant for greenthreads.
+    """
+    def __init__(self, name, max_timeout, min_timeout=0.25, slow_call=None, failure_rate=0.5,
+                 min_calls=20, window=100, open_time=10., clock=time.monotonic):
+        self.log = LogWrapper('coreapis.CircuitBreaker')
+        self.name = name
+        self.max_timeout = max_timeout
+        self.min_timeout = min(min_timeout, max_timeout)
+        self.slow_call = slow_call if slow_call is not None else max_timeout
+        self.failure_rate = failure_rate
+        self.min_calls = min_calls
+        self.calls = deque(maxlen=window)
+        self.open_time = open_time
+        self.clock = clock
+        self.state = CLOSED
+        self.opened = 0.
+        self.probing = False
+        self._timeout = None
+
+    def _open(self):
+        self.state = OPEN
+        self.opened = self.clock()
+        self.probing = False
+        self.log.warn('circuit opened', circuit=self.name,
+                      failure_rate=self.current_failure_rate())
+
+    def _close(self):
+        self.state = CLOSED
+        self.probing = False
+        self.calls.clear()
+        self._timeout = None
+        self.log.info('circuit closed', circuit=self.name)
+
+    def allow(self):
+        """Returns True if a call may be made now. Every allowed call must
+        be followed by a call to record."""
+        if self.state == CLOSED:
+            return True
+        if self.state == OPEN:
+            if self.clock() - self.opened < self.open_time:
+                return False
+            self.state = HALF_OPEN
+        if self.probing:
+            return False
+        self.probing = True
+        return True
+
+    def cancel(self):
+        """Ends an allowed call without recording it, for calls cut short
+        by their caller rather than by the dependency"""
+        if self.state == HALF_OPEN:
+            self.probing = False
+
+    def record(self, success, duration):
+        failed = not success or duration >= self.slow_call
+        if self.state == HALF_OPEN:
+            if failed:
+                self._open()
+            else:
+                self._close()
+                self.calls.append((failed, duration))
+            return
+        self.calls.append((failed, duration))
+        self._timeout = None
+        if (self.state == CLOSED and len(self.calls) >= self.min_calls and
+                self.current_failure_rate() >= self.failure_rate):
+            self._open()
+
+    def current_failure_rate(self):
+        if not self.calls:
+            return 0.
+        return sum(1 for failed, _ in self.calls if failed) / len(self.calls)
+
+    def p99(self):
+        durations = sorted(duration for _, duration in self.calls)
+        if len(durations) < self.min_calls:
+            return None
+        return durations[int(0.99 * (len(durations) - 1))]
+
+    def timeout(self):
+        if self.state != CLOSED:
+            return self.max_timeout
+        if self._timeout is None:
+            p99 = self.p99()
+            if p99 is None:
+                self._timeout = self.max_timeout
+            else:
+                self._timeout = max(self.min_timeout,
+                                    min(self.max_timeout, p99 * TIMEOUT_P99_FACTOR))
+        return self._timeout
+
+    def status(self):
+        return {
+            'state': self.state,
+            'calls': len(self.calls),
+            'failure_rate': round(self.current_failure_rate(), 3),
+            'timeout_ms': int(self.timeout() * 1000),
+        }
+
+
+def breaker_factory(settings, max_timeout):
+    """Returns a function making CircuitBreakers by name, configured by
+    the circuit_breaker_* settings"""
+    kwargs = {
+        'max_timeout': max_timeout,
+        'min_timeout': int(settings.get('circuit_breaker_min_timeout', '250')) / 1000,
+        'failure_rate': float(settings.get('circuit_breaker_failure_rate', '0.5')),
+        'min_calls': int(settings.get('circuit_breaker_min_calls', '20')),
+        'window': int(settings.get('circuit_breaker_window', '100')),
+        'open_time': float(settings.get('circuit_breaker_open_time', '10')),
+    }
+    if 'circuit_breaker_slow_call' in settings:
+        kwargs['slow_call'] = int(settings['circuit_breaker_slow_call']) / 1000
+    return functools.partial(CircuitBreaker, **kwargs)
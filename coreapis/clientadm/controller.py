@@ -11,6 +11,7 @@ import valideer as V
 
 from coreapis import cassandra_client
 from coreapis.crud_base import CrudControllerBase
+from coreapis.imagescale import get_image_scaler
 from coreapis.scopes import is_gkscopename, has_gkscope_match
 from coreapis.scopes.manager import ScopesManager
 from coreapis.authproviders import AUTHPROVMGR, REGISTER_CLIENT
@@ -104,6 +105,7 @@ class ClientAdmController(CrudControllerBase):
         authz = settings.get('cassandra_authz')
         maxrows = settings.get('clientadm_maxrows')
         super(ClientAdmController, self).__init__(maxrows, 'client')
+        self.image_scaler = get_image_scaler(settings)
         self.session = cassandra_client.Client(contact_points, keyspace, authz=authz)
         platformadmins_file = settings.get('platformadmins_file')
         self.platformadmins = get_platform_admins(platformadmins_file)
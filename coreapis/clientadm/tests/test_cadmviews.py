@@ -1204,6 +1204,18 @@ class ClientAdmTests(unittest.TestCase):
         out = res.body
         assert out[1:4] == b'PNG'
 
+    def test_get_client_logo_null_not_modified(self):
+        updated = parse_datetime(date_created)
+        headers = {'Authorization': 'Bearer user_token'}
+        self.session.get_client_logo.return_value = None, updated
+        path = '/clientadm/clients/{}/logo'.format(uuid.UUID(clientid))
+        res = self.testapp.get(path, status=200, headers=headers)
+        headers['If-None-Match'] = res.headers['ETag']
+        self.testapp.get(path, status=304, headers=headers)
+        del headers['If-None-Match']
+        headers['If-Modified-Since'] = res.headers['Last-Modified']
+        self.testapp.get(path, status=304, headers=headers)
+
     def test_get_client_logo_not_modified(self):
         updated = parse_datetime(date_created)
         date_newer = updated + timedelta(minutes=1)
@@ -1219,11 +1231,9 @@ class ClientAdmTests(unittest.TestCase):
         self.testapp.get(path, status=404, headers=headers)
 
     def test_get_client_logo_default_logo_file_not_found(self):
-        m = mock.mock_open()
-        with mock.patch('coreapis.utils.open', m, create=True):
+        with mock.patch('coreapis.assets.AssetRegistry.get', side_effect=FileNotFoundError()):
             updated = parse_datetime(date_created)
             headers = {'Authorization': 'Bearer user_token'}
-            m.side_effect = FileNotFoundError()
             self.session.get_client_logo.return_value = None, updated
             path = '/clientadm/clients/{}/logo'.format(uuid.UUID(clientid))
             self.testapp.get(path, status=500, headers=headers)
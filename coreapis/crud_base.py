@@ -1,17 +1,15 @@
-import io
 import uuid
-import warnings
 
 import requests
 from PIL import Image
 import valideer as V
 
+from coreapis.imagescale import ImageScaler
 from coreapis.utils import (
     now, ValidationError, AlreadyExistsError, LogWrapper, get_feideids, public_userinfo,
     public_orginfo, preferred_email, PRIV_PLATFORM_ADMIN)
 
 LOGO_SIZE = 128, 128
-warnings.simplefilter('error', Image.DecompressionBombWarning)
 
 
 def cache(data, key, fetch):
@@ -37,6 +35,7 @@ class CrudControllerBase(object):
         self.objtype = objtype
         self.groupengine_base_url = None
         self.session = None
+        self.image_scaler = ImageScaler(0, 0)
 
     def allowed_attrs(self, attrs, operation, privileges):
         protected_attrs = list(self.protected_attrs)
@@ -143,19 +142,15 @@ class CrudControllerBase(object):
         raise NotImplementedError
 
     def update_logo(self, itemid, data):
-        fake_file = io.BytesIO(data)
         try:
-            image = Image.open(fake_file)
+            logo = self.image_scaler.scale(data, LOGO_SIZE, 'PNG')
         except OSError:
             raise ValidationError('image format not supported')
         except (Image.DecompressionBombWarning,
                 Image.DecompressionBombError):
             raise ValidationError('Bad image')
-        image.thumbnail(LOGO_SIZE)
-        fake_output = io.BytesIO()
-        image.save(fake_output, format='PNG')
         updated = now()
-        self._save_logo(itemid, fake_output.getbuffer(), updated)
+        self._save_logo(itemid, logo, updated)
 
     def is_platform_admin(self, user):
         if user is None:
@@ -40,62 +40,95 @@ def set_headers_user(headers, user, subtoken):
         headers['userid-sec'] = ",".join(exposed_sec_ids)
 
 
+class Backend(object):
+    """The parts of an API gatekeeper definition used when gatekeeping,
+    with the per call derived values computed once"""
+    __slots__ = ('id', 'endpoints', 'requireuser', 'allow_unauthenticated', 'trust',
+                 'main_scope', 'scope_prefix', '_auth_header')
+
+    def __init__(self, backend_id, apigk):
+        self.id = backend_id  # pylint: disable=invalid-name
+        self.endpoints = tuple(apigk['endpoints'])
+        self.requireuser = apigk['requireuser']
+        self.allow_unauthenticated = apigk.get('allow_unauthenticated', None)
+        self.trust = apigk['trust']
+        self.main_scope = 'gk_{}'.format(self.id)
+        self.scope_prefix = self.main_scope + '_'
+        self._auth_header = None
+
+    @property
+    def auth_header(self):
+        if self._auth_header is None:
+            self._auth_header = auth_header(self.trust)
+        return self._auth_header
+
+
 class GkController(object):
-    def __init__(self, contact_points, keyspace, authz):
+    def __init__(self, contact_points, keyspace, authz, timer=None,
+                 apigk_cache_size=1000, apigk_cache_ttl=60):
         self.session = cassandra_client.Client(contact_points, keyspace, authz=authz)
         self.log = LogWrapper('gk.GkController')
-        self._allowed_dn = Cache(1800, 'gk.GkController.allowed_dn_cache')
+        self._allowed_dn = Cache(1800, 'gk.GkController.allowed_dn_cache', maxsize=1000,
+                                 timer=timer, counter_prefix='gk.allowed_dn_cache')
+        self._backends = Cache(apigk_cache_ttl, 'gk.GkController.apigk_cache',
+                               maxsize=apigk_cache_size, timer=timer,
+                               counter_prefix='gk.apigk_cache')
+        cassandra_client.add_change_listener('apigk', self._backends.invalidate)
 
     def allowed_dn(self, dn):
         return self._allowed_dn.get(dn, lambda: self.session.apigk_allowed_dn(dn))
 
+    def get_backend(self, backend_id):
+        return self._backends.get(backend_id,
+                                  lambda: Backend(backend_id, self.session.get_apigk(backend_id)))
+
     def options(self, backend_id):
-        backend = self.session.get_apigk(backend_id)
+        backend = self.get_backend(backend_id)
         headers = dict()
-        headers['endpoint'] = random.choice(backend['endpoints'])
+        headers['endpoint'] = random.choice(backend.endpoints)
         headers['gatekeeper'] = backend_id
         self.log.debug('Gatekeeping OPTIONS call',
                        gatekeeper=backend_id, endpoint=headers['endpoint'])
         return headers
 
-    def info(self, backend_id, client, user, scopes, subtokens, acr):
-        backend = self.session.get_apigk(backend_id)
+    def info(self, backend_id, client, user, scopes, subtokens, acr, subtoken=None):
+        backend = self.get_backend(backend_id)
         headers = dict()
-        headers['endpoint'] = random.choice(backend['endpoints'])
+        headers['endpoint'] = random.choice(backend.endpoints)
         headers['gatekeeper'] = backend_id
         if acr is None:
             acr = ''
         headers['acr'] = acr
 
-        if backend.get('allow_unauthenticated', None) and client is None:
+        if backend.allow_unauthenticated and client is None:
             self.log.debug('Allowing unauthenticated gatekeeping', gatekeeper=backend_id,
                            endpoint=headers['endpoint'])
             return headers
 
-        main_scope = 'gk_{}'.format(backend_id)
-        if main_scope not in scopes:
+        if backend.main_scope not in scopes:
             self.log.debug('provided token misses scopes to access this api', gatekeeper=backend_id)
             return None
 
-        if backend['requireuser'] and user is None:
+        if backend.requireuser and user is None:
             self.log.warn('user required but not in token', gatekeeper=backend_id,
                           clientid=client['id'])
             return None
 
         if backend_id in subtokens:
-            subtoken = self.session.get_token(subtokens[backend_id])
+            if subtoken is None:
+                subtoken = self.session.get_token(subtokens[backend_id])
             headers['token'] = str(subtoken['access_token'])
 
             if user:
                 set_headers_user(headers, user, subtoken)
-        scope_prefix = main_scope + '_'
+        scope_prefix = backend.scope_prefix
         scope_prefix_len = len(scope_prefix)
         exposed_scopes = [scope[scope_prefix_len:]
                           for scope in scopes if scope.startswith(scope_prefix)]
         headers['scopes'] = ','.join(exposed_scopes)
 
         headers['clientid'] = str(client['id'])
-        header, value = auth_header(backend['trust'])
+        header, value = backend.auth_header
         headers[header] = value
         self.log.debug('Allowing gatekeeping', gatekeeper=backend_id, endpoint=headers['endpoint'],
                        clientid=client['id'])
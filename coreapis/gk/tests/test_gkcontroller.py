@@ -1,6 +1,7 @@
 from unittest import TestCase, mock
 import uuid
 
+from coreapis import cassandra_client
 from coreapis.gk import controller
 
 
@@ -142,6 +143,34 @@ class TestController(TestCase):
         assert 'userid-sec' in headers
         assert headers['userid-sec'] == 'nin:01234567890'
 
+    def test_prefetched_subtoken(self):
+        self.session.get_apigk.return_value = self.basic_backend
+        subtoken = {
+            'access_token': 'my secret',
+            'scope': ['userid'],
+        }
+        headers = self.controller.info('testbackend', self.client, self.user, ['gk_testbackend'],
+                                       {'testbackend': 'my secret'}, None, subtoken)
+        assert headers['token'] == 'my secret'
+        assert headers['userid'] == str(self.user['userid'])
+        assert not self.session.get_token.called
+
+    def test_backend_cached(self):
+        self.session.get_apigk.return_value = self.basic_backend
+        for _ in range(2):
+            headers = self.controller.info(
+                'testbackend', self.client, None, ['gk_testbackend'], {}, None)
+            self.basic_asserts(headers)
+        self.controller.options('testbackend')
+        assert self.session.get_apigk.call_count == 1
+
+    def test_backend_invalidated(self):
+        self.session.get_apigk.return_value = self.basic_backend
+        self.controller.options('testbackend')
+        cassandra_client.notify_change('apigk', 'testbackend')
+        self.controller.options('testbackend')
+        assert self.session.get_apigk.call_count == 2
+
 
 class TestAuthHeader(TestCase):
     def test_token(self):
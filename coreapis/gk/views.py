@@ -11,7 +11,11 @@ def configure(config):
     contact_points = config.get_settings().get('cassandra_contact_points')
     keyspace = config.get_settings().get('cassandra_keyspace')
     authz = config.get_settings().get('cassandra_authz')
-    gk_controller = GkController(contact_points, keyspace, authz)
+    timer = config.get_settings().get('timer')
+    apigk_cache_size = int(config.get_settings().get('gk_apigk_cache_size', '1000'))
+    apigk_cache_ttl = int(config.get_settings().get('gk_apigk_cache_ttl', '60'))
+    gk_controller = GkController(contact_points, keyspace, authz, timer,
+                                 apigk_cache_size, apigk_cache_ttl)
     config.add_settings(gk_controller=gk_controller)
     config.add_request_method(lambda r: r.registry.settings['gk_controller'], 'gk_controller',
                               reify=True)
@@ -52,8 +56,10 @@ def info(request):
     scopes = request.environ.get('FC_SCOPES', [])
     subtokens = request.environ.get('FC_SUBTOKENS', None)
     acr = request.environ.get('FC_ACR', None)
+    subtoken = request.environ.get('FC_SUBTOKEN', None)
     try:
-        headers = request.gk_controller.info(backend, client, user, scopes, subtokens, acr)
+        headers = request.gk_controller.info(backend, client, user, scopes, subtokens, acr,
+                                             subtoken)
         if headers is None:
             raise HTTPForbidden('Token misses required scope, or is not associated with a user')
         for header, value in headers.items():
@@ -12,11 +12,47 @@ class IDHandler(object):
         self.permissions_ok = permissions_ok
 
 
+class PartialGroups(list):
+    """Member groups where some of the lookups failed. They are returned
+    to the caller, but never cached."""
+
+
+def join_groups(results):
+    """Joins lists of groups. A None in results is a failed lookup, which
+    like a partial list makes the whole result partial."""
+    groups = []
+    partial = False
+    for res in results:
+        if res is None or isinstance(res, PartialGroups):
+            partial = True
+        if res:
+            groups.extend(res)
+    if partial:
+        return PartialGroups(groups)
+    return groups
+
+
+class _Uncacheable(Exception):
+    def __init__(self, groups):
+        super(_Uncacheable, self).__init__('groups not cacheable')
+        self.groups = groups
+
+
+def _cacheable(groups):
+    """Raises _Uncacheable for empty or partial groups, which may just
+    mean that a backend is having trouble"""
+    if not groups or isinstance(groups, PartialGroups):
+        raise _Uncacheable(groups or [])
+    return groups
+
+
 class BaseBackend(object):
     def __init__(self, prefix, maxrows, settings):
         self.prefix = prefix
         self.maxrows = maxrows
         self.scopes_needed = set()
+        # Set by GroupsController
+        self.membership_cache = None
 
     def _groupid(self, gid):
         return "{}:{}".format(self.prefix, gid)
@@ -37,15 +73,31 @@ class BaseBackend(object):
         objections = [scope for scope in self.scopes_needed if not perm_checker(scope)]
         return len(objections) == 0
 
+    def cached_member_groups(self, user, show_all, load=None):
+        """get_member_groups, through the membership cache if there is one.
+        On a miss the groups are fetched with load, which takes the same
+        arguments and defaults to get_member_groups. Empty and partial
+        results are not cached."""
+        if load is None:
+            load = self.get_member_groups
+        if self.membership_cache is None:
+            return load(user, show_all)
+        try:
+            return self.membership_cache.get(
+                (user['userid'], self.prefix, show_all),
+                lambda: _cacheable(load(user, show_all)))
+        except _Uncacheable as ex:
+            return ex.groups
+
     def get_membership(self, user, groupid):
-        my_groups = self.get_member_groups(user, True)
+        my_groups = self.cached_member_groups(user, True)
         for group in my_groups:
             if group['id'] == groupid:
                 return group['membership']
         raise KeyError('Not found')
 
     def get_group(self, user, groupid):
-        my_groups = self.get_member_groups(user, True)
+        my_groups = self.cached_member_groups(user, True)
         for group in my_groups:
             if group['id'] == groupid:
                 return group
@@ -66,6 +118,9 @@ class BaseBackend(object):
     def grouptypes(self):
         pass
 
+    def status(self):
+        return {}
+
 
 class Pool(GreenPool):
     def imap(self, func, *args):
@@ -1,4 +1,4 @@
-from functools import partial
+from collections import OrderedDict
 import uuid
 
 from coreapis import cassandra_client
@@ -88,26 +88,44 @@ class AdHocGroupBackend(BaseBackend):
         group, _ = self._get(userid, groupid)
         return self.format_group(group, None)
 
-    def _handle_member(self, group, member):
+    def _member_ok(self, member):
         if member['status'] not in ('normal', 'unconfirmed'):
             tmpl = 'skipping group with unhandled membership status {}'
             self.log.debug(tmpl.format(member['status']))
-            return None
-        user = self.session.get_user_by_id(member['userid'])
-        return {
-            'membership': format_membership(group, member),
-            'name': public_userinfo(user)['name']
-        }
+            return False
+        return True
 
     def get_members(self, user, groupid, show_all, include_member_ids):
         userid = user['userid']
         group, membership = self._get(userid, groupid)
         if membership is None:
             raise KeyError("Not member of group")
-        member_ids = self.session.get_group_members(group['id'])
-        pool = Pool()
-        members = pool.imap(failsafe(partial(self._handle_member, group)), member_ids)
-        return [member for member in members if member]
+        members = [member for member in self.session.get_group_members(group['id'])
+                   if self._member_ok(member)]
+        userids = list(OrderedDict.fromkeys(member['userid'] for member in members))
+        users = self._get_users(userids)
+        format_member = failsafe(self._format_member)
+        formatted = (format_member(group, member, users[member['userid']])
+                     for member in members if member['userid'] in users)
+        return [member for member in formatted if member]
+
+    def _get_users(self, userids):
+        """Returns the public user rows of userids, by userid. If they
+        cannot be read in one go, each is read on its own, so a bad row
+        only loses that member."""
+        try:
+            return self.session.get_public_users(userids)
+        except Exception as ex:  # pylint: disable=broad-except
+            self.log.warn('could not read members in one go', exception=str(ex))
+        users = Pool().imap(failsafe(self.session.get_user_by_id), userids)
+        return {userid: user for userid, user in zip(userids, users) if user}
+
+    @staticmethod
+    def _format_member(group, member, user):
+        return {
+            'membership': format_membership(group, member),
+            'name': public_userinfo(user)['name'],
+        }
 
     def get_member_groups(self, user, show_all):
         userid = user['userid']
@@ -1,11 +1,20 @@
+import functools
+import time
+
 from eventlet.greenpool import GreenPool, GreenPile
+from eventlet.queue import LightQueue
 from eventlet.timeout import Timeout
 from paste.deploy.util import lookup_object
 
+from coreapis import cassandra_client
+from coreapis.cache import Cache
+from coreapis.circuitbreaker import CircuitOpenError, breaker_factory
 from coreapis.utils import LogWrapper, request_id, set_request_id
 
 BACKEND_CONFIG_KEY = 'groups_backend_'
 ID_PREFIX = 'fc'
+# Backend calls with a circuit breaker each, as their latencies differ
+BREAKER_CALLS = ('get_member_groups', 'get_groups')
 
 
 class GroupsController(object):
@@ -26,6 +35,34 @@ class GroupsController(object):
         self.id_handlers = {}
         for backend in self.backends.values():
             self.id_handlers.update(backend.get_id_handlers())
+        make_breaker = breaker_factory(settings, self.timeout)
+        self.breakers = {(backend.prefix, call): make_breaker('{} {}'.format(backend.prefix, call))
+                         for backend in self.backends.values() for call in BREAKER_CALLS}
+        settings.get('status_methods', {})['groups'] = self.status
+        # Member groups per user and backend, so that looking up a single
+        # group right after listing them does not ask the backends again
+        membership_cache_ttl = int(settings.get('groups_membership_cache_ttl', '30'))
+        self.membership_cache = None
+        if membership_cache_ttl > 0:
+            membership_cache_size = int(settings.get('groups_membership_cache_size', '10000'))
+            self.membership_cache = Cache(membership_cache_ttl, 'groups.membership_cache',
+                                          maxsize=membership_cache_size, timer=self.timer,
+                                          use_eventlets=True)
+            for backend in self.backends.values():
+                backend.membership_cache = self.membership_cache
+            cassandra_client.add_change_listener('group_members', self.invalidate_user)
+            cassandra_client.add_change_listener('groups', self.invalidate_groups)
+
+    def invalidate_user(self, userid):
+        for backend in self.backends.values():
+            for show_all in (True, False):
+                self.membership_cache.invalidate((userid, backend.prefix, show_all))
+
+    def invalidate_groups(self, groupid):
+        # Only the members with the changed group cached are affected
+        suffix = ':{}'.format(groupid)
+        self.membership_cache.invalidate_matching(
+            lambda key, groups: any(group['id'].endswith(suffix) for group in groups))
 
     def _backend(self, groupid, perm_checker):
         parts = groupid.split(':', 2)
@@ -42,37 +79,94 @@ class GroupsController(object):
             raise KeyError('No access to backend')
         return res
 
-    def _backend_call(self, method, reqid, *args, **kwargs):
+    def status(self):
+        result = {}
+        for backend in self.backends.values():
+            circuit = {call: self.breakers[(backend.prefix, call)].status()
+                       for call in BREAKER_CALLS}
+            result[backend.prefix] = dict(backend.status(), circuit=circuit)
+        return result
+
+    def _guarded_call(self, call, backend, method, *args, **kwargs):
+        """Calls method of backend through the circuit breaker and timeout
+        for call. Raises CircuitOpenError if the breaker is open."""
+        statsd_backend = backend.prefix.replace(':', '_')
+        breaker = self.breakers[(backend.prefix, call)]
+        if not breaker.allow():
+            self.timer.incr('groups.circuit_open.{}'.format(statsd_backend))
+            raise CircuitOpenError(backend.prefix)
+        success = False
+        start = time.monotonic()
+        try:
+            with self.timer.time('groups.{}.{}'.format(call, statsd_backend)):
+                with Timeout(breaker.timeout()):
+                    result = method(*args, **kwargs)
+            success = True
+            return result
+        finally:
+            breaker.record(success, time.monotonic() - start)
+
+    def _member_groups_call(self, backend):
+        # Only calls missing the membership cache reach the breaker, so
+        # cache hits do not count towards its latencies
+        load = functools.partial(self._guarded_call, 'get_member_groups', backend,
+                                 backend.get_member_groups)
+        return functools.partial(backend.cached_member_groups, load=load)
+
+    def _groups_call(self, backend):
+        return functools.partial(self._guarded_call, 'get_groups', backend, backend.get_groups)
+
+    def _backend_call(self, call, backend, method, reqid, *args, **kwargs):
         set_request_id(reqid)
-        backend = method.__self__.prefix
-        call = method.__name__
-        with self.timer.time('groups.{}.{}'.format(call, backend.replace(':', '_'))):
-            with Timeout(self.timeout):
-                try:
-                    return method(*args, **kwargs)
-                except Timeout:
-                    self.log.warn("Timeout in group backend", backend=backend,
-                                  method=call)
-
-                except:  # pylint: disable=bare-except
-                    self.log.exception('unhandled exception in group backend')
-
-    def _call_backends(self, func, perm_checker, *args, **kwargs):
+        try:
+            return method(*args, **kwargs)
+        except CircuitOpenError:
+            return None
+        except Timeout:
+            self.log.warn("Timeout in group backend", backend=backend.prefix, method=call)
+        except:  # pylint: disable=bare-except
+            self.log.exception('unhandled exception in group backend')
+
+    def _call_backends(self, call, func, perm_checker, *args, **kwargs):
         pile = GreenPile(self.pool)
         reqid = request_id()
         for backend in (backend for backend in self.backends.values()
                         if backend.permissions_ok(perm_checker)):
-            pile.spawn(self._backend_call, func(backend), reqid, *args, **kwargs)
+            pile.spawn(self._backend_call, call, backend, func(backend), reqid,
+                       *args, **kwargs)
         for result in pile:
             if result:
                 for value in result:
                     yield value
 
+    def _iter_backends(self, call, func, perm_checker, *args, **kwargs):
+        """Like _call_backends, but yields the results of each backend as
+        soon as it is done, so slow backends do not hold back fast ones"""
+        queue = LightQueue()
+        reqid = request_id()
+        backends = [backend for backend in self.backends.values()
+                    if backend.permissions_ok(perm_checker)]
+
+        def run(backend):
+            queue.put(self._backend_call(call, backend, func(backend), reqid, *args, **kwargs))
+
+        for backend in backends:
+            self.pool.spawn_n(run, backend)
+        for _ in backends:
+            result = queue.get()
+            if result:
+                for value in result:
+                    yield value
+
     def get_member_groups(self, user, show_all, perm_checker):
         with self.timer.time('groups.get_member_groups'):
-            return list(self._call_backends(lambda x: x.get_member_groups,
+            return list(self._call_backends('get_member_groups', self._member_groups_call,
                                             perm_checker, user, show_all))
 
+    def iter_member_groups(self, user, show_all, perm_checker):
+        return self._iter_backends('get_member_groups', self._member_groups_call,
+                                   perm_checker, user, show_all)
+
     def get_membership(self, user, groupid, perm_checker):
         return self._backend(groupid, perm_checker).get_membership(user, groupid)
 
@@ -89,8 +183,12 @@ class GroupsController(object):
 
     def get_groups(self, user, query, perm_checker):
         with self.timer.time('groups.get_groups'):
-            return list(self._call_backends(lambda x: x.get_groups, perm_checker,
-                                            user, query))
+            return list(self._call_backends('get_groups', self._groups_call,
+                                            perm_checker, user, query))
+
+    def iter_groups(self, user, query, perm_checker):
+        return self._iter_backends('get_groups', self._groups_call,
+                                   perm_checker, user, query)
 
     def grouptypes(self):
         types = {}
@@ -1,9 +1,9 @@
 import functools
 import eventlet
 from coreapis.utils import LogWrapper, get_feideids, failsafe, translatable, parse_datetime
-from coreapis.cache import Cache
 from coreapis import cassandra_client
-from . import BaseBackend, Pool
+from coreapis.orgsnapshot import get_org_snapshot
+from . import BaseBackend, Pool, join_groups
 
 requests = eventlet.import_patched('requests')  # pylint: disable=invalid-name
 
@@ -20,10 +20,10 @@ class FsBackend(BaseBackend):
         keyspace = settings.get('cassandra_keyspace')
         authz = settings.get('cassandra_authz')
         self.session = cassandra_client.Client(contact_points, keyspace, True, authz=authz)
-        self.org_enabled = Cache(300, 'groups.fs_backend.cache')
+        self.orgs = get_org_snapshot(settings, self.session)
 
     def is_org_enabled(self, realm):
-        return self.org_enabled.get(realm, functools.partial(self.session.org_use_fs_groups, realm))
+        return self.orgs.realm_has_service(realm, 'fsgroups')
 
     def get_members(self, user, groupid, show_all, include_member_ids):
         gid_parts = groupid.split(':')
@@ -101,13 +101,9 @@ class FsBackend(BaseBackend):
             self._adapt(group) for group in response.json() if self._should_show(group, show_all)]
 
     def get_member_groups(self, user, show_all):
-        result = []
         pool = Pool()
         func = failsafe(functools.partial(self._get_member_groups, show_all))
-        for res in pool.imap(func, get_feideids(user)):
-            if res:
-                result.extend(res)
-        return result
+        return join_groups(pool.imap(func, get_feideids(user)))
 
     def grouptypes(self):
         return [
@@ -0,0 +1,81 @@
+from coreapis.cache import Cache
+from coreapis.utils import LogWrapper
+
+# How long an index may be served after its reload interval, if reloading fails
+MAX_STALE = 24 * 3600
+
+
+class GrepCodeIndex(object):
+    """In-memory index of the grep_codes table, by id and by (code, type).
+
+    The table is a few thousand rows that bin/fetch-grep.py updates
+    rarely, so it is loaded as a whole and reloaded in the background
+    once it is older than reload_interval seconds. Codes missing from
+    the index are looked up in the database and added to it, so codes
+    added since the last load are found at once. Codes the database
+    does not have either are remembered as missing until the next
+    reload. Lookups also reach the database if the index could not be
+    loaded.
+    """
+    def __init__(self, session, reload_interval, timer=None):
+        self.log = LogWrapper('groups.grepcodes')
+        self.session = session
+        self.cache = Cache(reload_interval, 'groups.grepcodes', maxsize=1, stale=MAX_STALE,
+                           timer=timer, counter_prefix='groups.grep_code_index',
+                           use_eventlets=True)
+
+    def _load(self):
+        by_id = {}
+        by_code = {}
+        for grep in self.session.list_grep_codes():
+            by_id[grep['id']] = grep
+            by_code[(grep['code'], grep['type'])] = grep
+        self.log.info('loaded grep codes', count=len(by_id))
+        return by_id, by_code, set()
+
+    def _index(self):
+        try:
+            return self.cache.get('index', self._load)
+        except Exception as ex:  # pylint: disable=broad-except
+            self.log.warn('could not load grep codes', exception=str(ex))
+            return None
+
+    def preload(self):
+        self._index()
+
+    @staticmethod
+    def _add(index, grep):
+        by_id, by_code, _ = index
+        by_id[grep['id']] = grep
+        by_code[(grep['code'], grep['type'])] = grep
+
+    def _lookup(self, index, table, key, fetch):
+        try:
+            return table[key]
+        except KeyError:
+            pass
+        missing = index[2]
+        if key not in missing:
+            try:
+                grep = fetch()
+            except KeyError:
+                missing.add(key)
+            else:
+                self.log.debug('grep code not in index', key=key)
+                self._add(index, grep)
+                return grep
+        raise KeyError('No such grep code')
+
+    def get(self, grepid):
+        index = self._index()
+        if index is None:
+            return self.session.get_grep_code(grepid)
+        return self._lookup(index, index[0], grepid,
+                            lambda: self.session.get_grep_code(grepid))
+
+    def get_by_code(self, code, greptype):
+        index = self._index()
+        if index is None:
+            return self.session.get_grep_code_by_code(code, greptype)
+        return self._lookup(index, index[1], (code, greptype),
+                            lambda: self.session.get_grep_code_by_code(code, greptype))
@@ -4,14 +4,20 @@ import time
 
 import eventlet
 import eventlet.greenthread
+import eventlet.semaphore
+from eventlet.timeout import Timeout
 
 from coreapis.utils import LogWrapper, get_feideids, translatable, failsafe
 from coreapis.cache import Cache
+from coreapis.circuitbreaker import breaker_factory
 from coreapis import cassandra_client, feide
 from coreapis.groups.gogroups import (
     AFFILIATION_NAMES as go_affiliation_names, GOGroup, groupid_entitlement)
-from coreapis.ldap import ORG_ATTRIBUTE_NAMES, GROUP_PERSON_ATTRIBUTES, get_single
-from . import BaseBackend, IDHandler, Pool
+from coreapis.groups.grepcodes import GrepCodeIndex
+from coreapis.orgsnapshot import get_org_snapshot
+from coreapis.ldap import (
+    ORG_ATTRIBUTE_NAMES, ORG_UNIT_ATTRIBUTE_NAMES, GROUP_PERSON_ATTRIBUTES, get_single)
+from . import BaseBackend, IDHandler, PartialGroups, Pool, join_groups
 ldap3 = eventlet.import_patched('ldap3')  # pylint: disable=invalid-name
 ldap3.core = eventlet.import_patched('ldap3.core')
 ldap3.core.exceptions = eventlet.import_patched('ldap3.core.exceptions')
@@ -35,6 +41,9 @@ AFFILIATION_PRIORITY = (
     'member'
 )
 
+ORG_SEARCH_ATTRIBUTES = tuple(sorted(ORG_ATTRIBUTE_NAMES))
+ORG_UNIT_SEARCH_ATTRIBUTES = tuple(sorted(ORG_UNIT_ATTRIBUTE_NAMES))
+
 GREP_PREFIX = 'urn:mace:feide.no:go:grep:'
 GREP_ID_PREFIX = 'fc:grep'
 GOGROUP_ID_PREFIX = 'fc:gogroup'
@@ -155,14 +164,22 @@ class LDAPBackend(BaseBackend):
         keyspace = settings.get('cassandra_keyspace')
         authz = settings.get('cassandra_authz')
         self.session = cassandra_client.Client(contact_points, keyspace, True, authz=authz)
-        self.org_types = Cache(3600, 'groups.ldap_backend.cache')
-
-    def _get_org_type_real(self, realm):
-        org = self.session.get_org_by_realm(realm)
-        return org['type']
+        self.orgs = get_org_snapshot(settings, self.session)
+        self.dn_cache_ttl = int(settings.get('groups_ldap_dn_cache_ttl', '900'))
+        self.dn_cache_size = int(settings.get('groups_ldap_dn_cache_size', '10000'))
+        self.dn_caches = {}
+        self.max_parallel = int(settings.get('groups_ldap_max_parallel', '4'))
+        self.realm_semaphores = {}
+        grep_reload_interval = int(settings.get('groups_grep_reload_interval', '3600'))
+        self.grep_codes = GrepCodeIndex(self.session, grep_reload_interval, self.timer)
+        if 'warm_up_methods' in settings:
+            settings['warm_up_methods']['grep_codes'] = self.grep_codes.preload
+        realm_timeout = int(settings.get('groups_timeout_backend', '3000')) / 1000
+        self.make_breaker = breaker_factory(settings, realm_timeout)
+        self.realm_breakers = {}
 
     def _get_org_type(self, realm):
-        return self.org_types.get(realm, functools.partial(self._get_org_type_real, realm))
+        return self.orgs.get_org_by_realm(realm)['type']
 
     def get_id_handlers(self):
         return {
@@ -174,14 +191,53 @@ class LDAPBackend(BaseBackend):
                                          self.get_go_members, self.get_logo, self.permissions_ok),
         }
 
+    def _get_dn_cache(self, realm):
+        cache = self.dn_caches.get(realm)
+        if cache is None:
+            cache = Cache(self.dn_cache_ttl, 'groups.ldap_backend.dn_cache',
+                          maxsize=self.dn_cache_size, stale=self.dn_cache_ttl, timer=self.timer,
+                          counter_prefix='groups.ldap.dn_cache', use_eventlets=True)
+            cache = self.dn_caches.setdefault(realm, cache)
+        return cache
+
+    def _get_realm_semaphore(self, realm):
+        # Bounds the concurrent entry lookups against a realm's servers, to
+        # leave room in their connection pools
+        semaphore = self.realm_semaphores.get(realm)
+        if semaphore is None:
+            semaphore = self.realm_semaphores.setdefault(
+                realm, eventlet.semaphore.Semaphore(self.max_parallel))
+        return semaphore
+
+    def _get_realm_breaker(self, realm):
+        breaker = self.realm_breakers.get(realm)
+        if breaker is None:
+            breaker = self.realm_breakers.setdefault(
+                realm, self.make_breaker('{} {}'.format(self.prefix, realm)))
+        return breaker
+
+    def status(self):
+        return {'realms': {realm: breaker.status()
+                           for realm, breaker in self.realm_breakers.items()}}
+
+    def _get_entry_attributes(self, realm, dn, attributes, notfound):
+        """Returns the given attributes of the catalog entry at dn. Entries
+        are cached per realm, as the org and orgunit entries are shared by
+        many users."""
+        def fetch():
+            with self._get_realm_semaphore(realm):
+                entry = self.ldap.search(realm, dn, '(objectClass=*)',
+                                         ldap3.BASE,
+                                         attributes, 1)
+            if not entry:
+                raise KeyError(notfound)
+            return entry[0]['attributes']
+
+        return self._get_dn_cache(realm).get((dn, attributes), fetch)
+
     def _get_org(self, realm, dn, person):
-        org = self.ldap.search(realm, dn, '(objectClass=*)',
-                               ldap3.BASE,
-                               ldap3.ALL_ATTRIBUTES, 1)
-        if not org:
-            raise KeyError('orgDN not found in catalog')
-        org = org[0]
-        org_attributes = org['attributes']
+        org_attributes = self._get_entry_attributes(realm, dn, ORG_SEARCH_ATTRIBUTES,
+                                                    'orgDN not found in catalog')
         org_type = list(self._get_org_type(realm).intersection(EDUCATIONAL_ORG_TYPES))
         if 'higher_education' not in org_type:
             org_type = ['{}_owner'.format(o) for o in org_type]
@@ -199,13 +255,8 @@ class LDAPBackend(BaseBackend):
         return res
 
     def _get_orgunit(self, realm, dn, primary_dn):
-        ou = self.ldap.search(realm, dn, '(objectClass=*)',
-                              ldap3.BASE,
-                              ldap3.ALL_ATTRIBUTES, 1)
-        if not ou:
-            raise KeyError('orgUnitDN not found in catalog')
-        ou = ou[0]
-        ou_attributes = ou['attributes']
+        ou_attributes = self._get_entry_attributes(realm, dn, ORG_UNIT_SEARCH_ATTRIBUTES,
+                                                   'orgUnitDN not found in catalog')
         org_type = self._get_org_type(realm).intersection(EDUCATIONAL_ORG_TYPES)
         data = {
             'id': self._groupid('{}:unit:{}'.format(
@@ -228,8 +279,7 @@ class LDAPBackend(BaseBackend):
         return data
 
     def _handle_grepcode(self, grep_id, is_member):
-        with self.timer.time('getting grep code'):
-            grep_data = self.session.get_grep_code(grep_id)
+        grep_data = self.grep_codes.get(grep_id)
         result = {
             'id': '{}:{}'.format(GREP_ID_PREFIX, quote(grep_id)),
             'displayName': grep_translatable(grep_data['title']),
@@ -253,42 +303,98 @@ class LDAPBackend(BaseBackend):
             raise KeyError('Group not valid now and show_all off')
         result = group.format_group(GOGROUP_ID_PREFIX, realm, self.prefix)
         if group.grep_code:
-            grep_data = self.session.get_grep_code_by_code(group.grep_code, 'fagkoder')
+            grep_data = self.grep_codes.get_by_code(group.grep_code, 'fagkoder')
             result['grep'] = {
                 'displayName': grep_translatable(grep_data['title']),
                 'code': group.grep_code,
             }
         return result
 
+    @staticmethod
+    def _run_tasks(tasks):
+        """Runs the tasks concurrently. Each task returns a list of groups,
+        and the lists are joined in task order. A task returns None when it
+        failed, which makes the result partial."""
+        return join_groups(Pool().imap(lambda task: task(), tasks))
+
+    def _orgunit_task(self, realm, dn, primary_dn):
+        try:
+            return [self._get_orgunit(realm, dn, primary_dn)]
+        except KeyError as ex:
+            self.log.warn('Could not format OU data, org_unit_dn={}: {}'.format(dn, ex))
+            return []
+        except Exception:  # pylint: disable=broad-except
+            self.log.exception(
+                'Could not format OU data, org_unit_dn={}'.format(dn))
+            return None
+
+    def _grepcode_task(self, grep_id):
+        try:
+            return [self._handle_grepcode(grep_id, True)]
+        except KeyError:
+            return []
+
+    def _gogroup_task(self, realm, group_info, show_all):
+        try:
+            return [self._handle_gogroup(realm, group_info, show_all)]
+        except KeyError as ex:
+            self.log.debug("GO Group ignored: {}".format(ex))
+            return []
+
+    def _grepcode_tasks(self, entitlements):
+        return [functools.partial(self._grepcode_task, val[len(GREP_PREFIX):])
+                for val in entitlements if val.startswith(GREP_PREFIX)]
+
+    def _go_group_tasks(self, realm, entitlements, show_all):
+        return [functools.partial(self._gogroup_task, realm, val, show_all)
+                for val in entitlements if GOGroup.candidate(val)]
+
     def _handle_grepcodes(self, entitlements):
-        res = []
-        for val in entitlements:
-            if val.startswith(GREP_PREFIX):
-                try:
-                    res.append(self._handle_grepcode(val[len(GREP_PREFIX):], True))
-                except KeyError:
-                    pass
-        return res
+        return self._run_tasks(self._grepcode_tasks(entitlements))
 
     def _handle_go_groups(self, realm, entitlements, show_all):
-        res = []
-        for val in entitlements:
-            if GOGroup.candidate(val):
-                try:
-                    res.append(self._handle_gogroup(realm, val, show_all))
-                except KeyError as ex:
-                    self.log.debug("GO Group ignored: {}".format(ex))
-        return res
+        return self._run_tasks(self._go_group_tasks(realm, entitlements, show_all))
 
     def _get_member_groups(self, show_all, feideid):
         self.log.debug('looking up groups', feideid=feideid)
-        result = []
         realm = feideid.split('@', 1)[1]
         try:
             base_dn = self.ldap.get_base_dn(realm)
         except KeyError:
             self.log.debug('ldap not configured for realm', realm=realm)
             return []
+        breaker = self._get_realm_breaker(realm)
+        if not breaker.allow():
+            self.log.debug('circuit open for realm', realm=realm)
+            if self.timer:
+                self.timer.incr('groups.ldap.circuit_open.{}'.format(realm.replace('.', '_')))
+            return PartialGroups()
+        success = False
+        cancelled = False
+        start = time.monotonic()
+        try:
+            with Timeout(breaker.timeout()) as timeout:
+                result = self._lookup_member_groups(realm, base_dn, show_all, feideid)
+            success = True
+            return result
+        except KeyError:
+            # The realm answered, the user is just not there
+            success = True
+            raise
+        except Timeout as ex:
+            if ex is not timeout:
+                # The caller gave up, which is not the realm's fault
+                cancelled = True
+                raise
+            self.log.warn('timeout looking up groups in realm', realm=realm)
+            return PartialGroups()
+        finally:
+            if cancelled:
+                breaker.cancel()
+            else:
+                breaker.record(success, time.monotonic() - start)
+
+    def _lookup_member_groups(self, realm, base_dn, show_all, feideid):
         res = self.ldap.search(realm, base_dn, '(eduPersonPrincipalName={})'.format(feideid),
                                ldap3.SUBTREE,
                                GROUP_PERSON_ATTRIBUTES, 1)
@@ -296,9 +402,10 @@ class LDAPBackend(BaseBackend):
             raise KeyError('could not find user in catalog')
         res = res[0]
         attributes = res['attributes']
+        tasks = []
         if 'eduPersonOrgDN' in attributes:
             org_dn = get_single(attributes['eduPersonOrgDN'])
-            result.append(self._get_org(realm, org_dn, attributes))
+            tasks.append(lambda: [self._get_org(realm, org_dn, attributes)])
         if 'eduPersonOrgUnitDN' in attributes:
             primary_org_unit = attributes.get('eduPersonPrimaryOrgUnitDN', [])
             if primary_org_unit:
@@ -306,26 +413,25 @@ class LDAPBackend(BaseBackend):
             else:
                 primary_org_unit = None
             for org_unit_dn in attributes['eduPersonOrgUnitDN']:
-                try:
-                    ou = self._get_orgunit(realm, org_unit_dn, primary_org_unit)
-                    result.append(ou)
-                except Exception:  # pylint: disable=broad-except
-                    self.log.exception(
-                        'Could not format OU data, org_unit_dn={}'.format(org_unit_dn))
+                tasks.append(functools.partial(self._orgunit_task, realm, org_unit_dn,
+                                               primary_org_unit))
         if 'eduPersonEntitlement' in attributes:
-            result.extend(self._handle_grepcodes(attributes['eduPersonEntitlement']))
-            result.extend(self._handle_go_groups(realm, attributes['eduPersonEntitlement'],
-                                                 show_all))
-        return result
+            tasks.extend(self._grepcode_tasks(attributes['eduPersonEntitlement']))
+            tasks.extend(self._go_group_tasks(realm, attributes['eduPersonEntitlement'],
+                                              show_all))
+        return self._run_tasks(tasks)
+
+    def _user_member_groups(self, show_all, feideid):
+        try:
+            return self._get_member_groups(show_all, feideid)
+        except KeyError as ex:
+            self.log.debug('no groups for user', feideid=feideid, error=str(ex))
+            return []
 
     def get_member_groups(self, user, show_all):
-        result = []
         pool = Pool()
-        get_member_groups = failsafe(functools.partial(self._get_member_groups, show_all))
-        for res in pool.imap(get_member_groups, get_feideids(user)):
-            if res:
-                result.extend(res)
-        return result
+        get_member_groups = failsafe(functools.partial(self._user_member_groups, show_all))
+        return join_groups(pool.imap(get_member_groups, get_feideids(user)))
 
     def get_grep_group(self, user, groupid):
         try:
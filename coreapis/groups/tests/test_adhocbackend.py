@@ -160,27 +160,73 @@ class TestAdHocBackendGetMembers(TestAdHocBackendBase):
     def test_normal(self):
         members = [{'userid': user1, 'type': 'member', 'status': 'normal'}]
         self.session.get_group_members.return_value = iter(members)
-        self.session.get_user_by_id.return_value = public_userinfo
+        self.session.get_public_users.return_value = {user1: public_userinfo}
         with mock.patch('coreapis.groups.adhoc_backend.AdHocGroupBackend._get') as _get:
             _get.return_value = group1, MEMBERSHIP1
             res = self.backend.get_members({'userid': user1},
                                            'fc:adhoc:{}'.format(groupid1), False, False)
             assert res == [{'membership': {'basic': 'owner'}, 'name': 'foo'}]
+            self.session.get_public_users.assert_called_once_with([user1])
+
+    def test_many_members(self):
+        members = [{'userid': user2, 'type': 'member', 'status': 'normal'},
+                   {'userid': user3, 'type': 'member', 'status': 'hacked'},
+                   {'userid': user1, 'type': 'admin', 'status': 'normal'}]
+        self.session.get_group_members.return_value = iter(members)
+        self.session.get_public_users.return_value = {user1: public_userinfo,
+                                                      user2: public_userinfo}
+        with mock.patch('coreapis.groups.adhoc_backend.AdHocGroupBackend._get') as _get:
+            _get.return_value = group1, MEMBERSHIP1
+            res = self.backend.get_members({'userid': user1},
+                                           'fc:adhoc:{}'.format(groupid1), False, False)
+            assert [member['membership']['basic'] for member in res] == ['member', 'owner']
+            self.session.get_public_users.assert_called_once_with([user2, user1])
 
     def test_bad_member(self):
         members = [{'userid': user1, 'type': 'member', 'status': 'normal'}]
         self.session.get_group_members.return_value = iter(members)
-        self.session.get_user_by_id.side_effect = KeyError
+        self.session.get_public_users.return_value = {}
         with mock.patch('coreapis.groups.adhoc_backend.AdHocGroupBackend._get') as _get:
             _get.return_value = group1, MEMBERSHIP1
             res = self.backend.get_members({'userid': user1},
                                            'fc:adhoc:{}'.format(groupid1), False, False)
             assert res == []
 
+    def test_bad_user_row_skipped(self):
+        members = [{'userid': user2, 'type': 'member', 'status': 'normal'},
+                   {'userid': user1, 'type': 'admin', 'status': 'normal'}]
+        self.session.get_group_members.return_value = iter(members)
+        self.session.get_public_users.return_value = {
+            user1: public_userinfo,
+            user2: dict(public_userinfo, userid_sec=None),
+        }
+        with mock.patch('coreapis.groups.adhoc_backend.AdHocGroupBackend._get') as _get:
+            _get.return_value = group1, MEMBERSHIP1
+            res = self.backend.get_members({'userid': user1},
+                                           'fc:adhoc:{}'.format(groupid1), False, False)
+            assert res == [{'membership': {'basic': 'owner'}, 'name': 'foo'}]
+
+    def test_batch_lookup_fails(self):
+        members = [{'userid': user2, 'type': 'member', 'status': 'normal'},
+                   {'userid': user1, 'type': 'admin', 'status': 'normal'}]
+        self.session.get_group_members.return_value = iter(members)
+        self.session.get_public_users.side_effect = RuntimeError('bad row')
+
+        def get_user_by_id(userid):
+            if userid == user2:
+                raise RuntimeError('bad row')
+            return public_userinfo
+        self.session.get_user_by_id.side_effect = get_user_by_id
+        with mock.patch('coreapis.groups.adhoc_backend.AdHocGroupBackend._get') as _get:
+            _get.return_value = group1, MEMBERSHIP1
+            res = self.backend.get_members({'userid': user1},
+                                           'fc:adhoc:{}'.format(groupid1), False, False)
+            assert res == [{'membership': {'basic': 'owner'}, 'name': 'foo'}]
+
     def test_bad_status(self):
         members = [{'userid': user1, 'type': 'member', 'status': 'hacked'}]
         self.session.get_group_members.return_value = iter(members)
-        self.session.get_user_by_id.return_value = public_userinfo
+        self.session.get_public_users.return_value = {user1: public_userinfo}
         with mock.patch('coreapis.groups.adhoc_backend.AdHocGroupBackend._get') as _get:
             _get.return_value = group1, MEMBERSHIP1
             res = self.backend.get_members({'userid': user1},
@@ -190,7 +236,7 @@ class TestAdHocBackendGetMembers(TestAdHocBackendBase):
     def test_not_member(self):
         members = []
         self.session.get_group_members.return_value = iter(members)
-        self.session.get_user_by_id.return_value = public_userinfo
+        self.session.get_public_users.return_value = {}
         with mock.patch('coreapis.groups.adhoc_backend.AdHocGroupBackend._get') as _get:
             _get.return_value = group1, None
             with py.test.raises(KeyError):
@@ -88,11 +88,17 @@ class MockResponse(object):
         return self.response_data
 
 
+def org_rows(services):
+    return [{'id': 'fc:org:' + realm, 'realm': realm, 'services': services}
+            for realm in ('bar', 'bar.no')]
+
+
 class TestFsBackend(unittest.TestCase):
     @mock.patch('coreapis.middleware.cassandra_client.Client')
     def setUp(self, Client):
         settings = {'timer': mock.MagicMock()}
         self.session = Client()
+        self.session.list_orgs.return_value = org_rows({'fsgroups'})
         self.backend = FsBackend('fs', 100, settings)
 
     def _get_member_groups(self, user, show_all):
@@ -114,7 +120,7 @@ class TestFsBackend(unittest.TestCase):
         assert not res
 
     def test_get_member_groups_org_not_enabled(self):
-        self.session.org_use_fs_groups.return_value = False
+        self.session.list_orgs.return_value = org_rows({'auth'})
         res = self._get_member_groups(USERS[0], False)
         assert not res
 
@@ -128,7 +134,7 @@ class TestFsBackend(unittest.TestCase):
         assert len(res) == 2
 
     def test_get_members_org_not_enabled(self):
-        self.session.org_use_fs_groups.return_value = False
+        self.session.list_orgs.return_value = org_rows({'auth'})
         with raises(KeyError) as ex:
             self._get_members(USERS[0], 'fc:kull:foo:bar')
         assert 'not enabled' in str(ex)
@@ -0,0 +1,59 @@
+import unittest
+from unittest import mock
+from pytest import raises
+from coreapis.groups.grepcodes import GrepCodeIndex
+
+GREP_CODES = [
+    {'id': 'uuid:1', 'code': 'REA3012', 'type': 'fagkoder', 'title': {'default': 'Kjemi 2'}},
+    {'id': 'uuid:2', 'code': 'VG1', 'type': 'aarstrinn', 'title': {'default': 'Vg1'}},
+]
+
+
+class TestGrepCodeIndex(unittest.TestCase):
+    def setUp(self):
+        self.session = mock.MagicMock()
+        self.session.list_grep_codes.return_value = GREP_CODES
+        self.index = GrepCodeIndex(self.session, 3600)
+
+    def test_get(self):
+        assert self.index.get('uuid:2') == GREP_CODES[1]
+        assert self.index.get('uuid:1') == GREP_CODES[0]
+        self.session.list_grep_codes.assert_called_once_with()
+        self.session.get_grep_code.assert_not_called()
+
+    def test_get_by_code(self):
+        assert self.index.get_by_code('REA3012', 'fagkoder') == GREP_CODES[0]
+        self.session.list_grep_codes.assert_called_once_with()
+        self.session.get_grep_code_by_code.assert_not_called()
+
+    def test_get_missing(self):
+        self.session.get_grep_code.side_effect = KeyError('grep_codes entry not found')
+        for _ in range(2):
+            with raises(KeyError):
+                self.index.get('uuid:3')
+        self.session.get_grep_code.assert_called_once_with('uuid:3')
+
+    def test_get_by_code_missing(self):
+        self.session.get_grep_code_by_code.side_effect = KeyError('No such grep code')
+        for _ in range(2):
+            with raises(KeyError):
+                self.index.get_by_code('REA3012', 'aarstrinn')
+        self.session.get_grep_code_by_code.assert_called_once_with('REA3012', 'aarstrinn')
+
+    def test_added_after_load(self):
+        assert self.index.get('uuid:1') == GREP_CODES[0]
+        added = {'id': 'uuid:3', 'code': 'VG2', 'type': 'aarstrinn', 'title': {}}
+        self.session.get_grep_code.return_value = added
+        assert self.index.get('uuid:3') == added
+        assert self.index.get_by_code('VG2', 'aarstrinn') == added
+        self.session.get_grep_code.assert_called_once_with('uuid:3')
+        self.session.get_grep_code_by_code.assert_not_called()
+
+    def test_load_failure_falls_back_to_database(self):
+        self.session.list_grep_codes.side_effect = RuntimeError('no database')
+        self.session.get_grep_code.return_value = GREP_CODES[0]
+        assert self.index.get('uuid:1') == GREP_CODES[0]
+        self.session.get_grep_code.assert_called_once_with('uuid:1')
+        self.session.list_grep_codes.side_effect = None
+        assert self.index.get('uuid:2') == GREP_CODES[1]
+        assert self.session.get_grep_code.call_count == 1
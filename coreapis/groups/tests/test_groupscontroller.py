@@ -0,0 +1,159 @@
+import unittest
+from unittest import mock
+
+import eventlet
+
+from coreapis import cassandra_client
+from coreapis.groups import BaseBackend, PartialGroups
+from coreapis.groups.controller import GroupsController
+from . import USER1, GROUP1, GROUPID1, GROUP2, GROUPID2
+
+
+class CountingBackend(BaseBackend):
+    calls = 0
+    fail = False
+    result = None
+
+    def get_member_groups(self, user, show_all):
+        CountingBackend.calls += 1
+        if CountingBackend.fail:
+            raise RuntimeError('backend down')
+        if CountingBackend.result is not None:
+            return CountingBackend.result
+        return [dict(GROUP1, membership={'basic': 'member'})]
+
+    def get_groups(self, user, query):
+        return []
+
+    def grouptypes(self):
+        return []
+
+
+class SlowBackend(BaseBackend):
+    def get_member_groups(self, user, show_all):
+        eventlet.sleep(0.05)
+        return [GROUP2]
+
+    def grouptypes(self):
+        return []
+
+
+class TestMembershipCache(unittest.TestCase):
+    def setUp(self):
+        CountingBackend.calls = 0
+        CountingBackend.fail = False
+        CountingBackend.result = None
+        self.user = {'userid': USER1}
+
+    def make_controller(self, **settings):
+        settings.update({
+            'timer': mock.MagicMock(),
+            'groups_backend_test': 'coreapis.groups.tests.test_groupscontroller:CountingBackend',
+        })
+        return GroupsController(settings)
+
+    def test_single_group_lookups_cached(self):
+        controller = self.make_controller()
+        groups = controller.get_member_groups(self.user, True, lambda scope: True)
+        assert [group['id'] for group in groups] == [GROUPID1]
+        assert controller.get_group(self.user, GROUPID1, lambda scope: True)['id'] == GROUPID1
+        assert controller.get_membership(self.user, GROUPID1, lambda scope: True) == \
+            {'basic': 'member'}
+        assert CountingBackend.calls == 1
+
+    def test_show_all_cached_separately(self):
+        controller = self.make_controller()
+        controller.get_member_groups(self.user, True, lambda scope: True)
+        controller.get_member_groups(self.user, False, lambda scope: True)
+        assert CountingBackend.calls == 2
+
+    def test_invalidated_on_membership_change(self):
+        controller = self.make_controller()
+        controller.get_member_groups(self.user, True, lambda scope: True)
+        cassandra_client.notify_change('group_members', USER1)
+        controller.get_group(self.user, GROUPID1, lambda scope: True)
+        assert CountingBackend.calls == 2
+
+    def test_failure_not_cached(self):
+        controller = self.make_controller()
+        CountingBackend.fail = True
+        assert controller.get_member_groups(self.user, True, lambda scope: True) == []
+        CountingBackend.fail = False
+        assert len(controller.get_member_groups(self.user, True, lambda scope: True)) == 1
+        assert CountingBackend.calls == 2
+
+    def test_partial_not_cached(self):
+        controller = self.make_controller()
+        CountingBackend.result = PartialGroups([GROUP2])
+        assert controller.get_group(self.user, GROUPID2, lambda scope: True)['id'] == GROUPID2
+        CountingBackend.result = None
+        assert controller.get_group(self.user, GROUPID1, lambda scope: True)['id'] == GROUPID1
+        assert CountingBackend.calls == 2
+
+    def test_empty_not_cached(self):
+        controller = self.make_controller()
+        CountingBackend.result = []
+        assert controller.get_member_groups(self.user, True, lambda scope: True) == []
+        CountingBackend.result = None
+        assert len(controller.get_member_groups(self.user, True, lambda scope: True)) == 1
+        assert CountingBackend.calls == 2
+
+    def test_invalidated_on_group_change(self):
+        controller = self.make_controller()
+        other = {'userid': 'other'}
+        CountingBackend.result = [GROUP2]
+        controller.get_member_groups(other, True, lambda scope: True)
+        CountingBackend.result = None
+        controller.get_member_groups(self.user, True, lambda scope: True)
+        cassandra_client.notify_change('groups', '1')
+        controller.get_member_groups(other, True, lambda scope: True)
+        controller.get_member_groups(self.user, True, lambda scope: True)
+        assert CountingBackend.calls == 3
+
+    def test_disabled(self):
+        controller = self.make_controller(groups_membership_cache_ttl='0')
+        controller.get_member_groups(self.user, True, lambda scope: True)
+        controller.get_group(self.user, GROUPID1, lambda scope: True)
+        assert CountingBackend.calls == 2
+
+
+class TestStreaming(unittest.TestCase):
+    def test_results_in_completion_order(self):
+        controller = GroupsController({
+            'timer': mock.MagicMock(),
+            'groups_backend_slow': 'coreapis.groups.tests.test_groupscontroller:SlowBackend',
+            'groups_backend_test': 'coreapis.groups.tests.test_groupscontroller:CountingBackend',
+        })
+        groups = controller.iter_member_groups({'userid': USER1}, True, lambda scope: True)
+        assert [group['id'] for group in groups] == [GROUPID1, GROUPID2]
+
+
+class TestCircuitBreaker(unittest.TestCase):
+    def setUp(self):
+        CountingBackend.calls = 0
+        CountingBackend.fail = True
+        self.settings = {
+            'timer': mock.MagicMock(),
+            'status_methods': {},
+            'groups_membership_cache_ttl': '0',
+            'circuit_breaker_min_calls': '2',
+            'groups_backend_test': 'coreapis.groups.tests.test_groupscontroller:CountingBackend',
+        }
+        self.controller = GroupsController(self.settings)
+
+    def test_failing_backend_skipped(self):
+        for _ in range(4):
+            self.controller.get_member_groups({'userid': USER1}, True, lambda scope: True)
+        assert CountingBackend.calls == 2
+        status = self.settings['status_methods']['groups']()
+        assert status['fc:test']['circuit']['get_member_groups']['state'] == 'open'
+        assert status['fc:test']['circuit']['get_groups']['state'] == 'closed'
+
+    def test_cache_hits_not_recorded(self):
+        CountingBackend.fail = False
+        self.settings['groups_membership_cache_ttl'] = '30'
+        controller = GroupsController(self.settings)
+        for _ in range(4):
+            controller.get_member_groups({'userid': USER1}, True, lambda scope: True)
+        assert CountingBackend.calls == 1
+        assert len(controller.breakers[('fc:test', 'get_member_groups')].calls) == 1
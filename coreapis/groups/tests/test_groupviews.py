@@ -1,3 +1,4 @@
+import json
 import unittest
 import webtest
 from coreapis import main, middleware
@@ -101,6 +102,21 @@ class GroupsViewTests(unittest.TestCase):
             assert groups[1]['id'] == groupid2
             assert 'displayName' in groups[1]
 
+    def test_get_member_groups_ndjson(self):
+        headers = {'Authorization': 'Bearer user_token', 'Accept': 'application/x-ndjson'}
+        res = self.testapp.get('/groups/me/groups', status=200, headers=headers)
+        assert res.content_type == 'application/x-ndjson'
+        groups = [json.loads(line) for line in res.text.splitlines()]
+        assert len(groups) == 1
+        assert groups[0]['id'] == groupid1
+
+    def test_get_groups_ndjson(self):
+        headers = {'Authorization': 'Bearer user_token', 'Accept': 'application/x-ndjson'}
+        res = self.testapp.get('/groups/groups', status=200, headers=headers)
+        assert res.content_type == 'application/x-ndjson'
+        groups = [json.loads(line) for line in res.text.splitlines()]
+        assert [group['id'] for group in groups] == [groupid1, groupid2]
+
     def test_get_group_logo(self):
         for ver in ['', '/v1']:
             path = '/groups{}/groups/{}/logo'.format(ver, groupid1)
@@ -137,6 +153,12 @@ class GroupsViewErrorHandlingTests(unittest.TestCase):
         assert groups[1]['id'] == groupid2
         assert 'displayName' in groups[1]
 
+    def test_get_groups_ndjson(self):
+        headers = {'Authorization': 'Bearer user_token', 'Accept': 'application/x-ndjson'}
+        res = self.testapp.get('/groups/groups', status=200, headers=headers)
+        groups = [json.loads(line) for line in res.text.splitlines()]
+        assert [group['id'] for group in groups] == [groupid1, groupid2]
+
     def test_get_groups_bad_authscheme(self):
         headers = {'Authorization': 'Basic {}'.format('Zm9vOmJhcg==')}  # foo:bar
         self.testapp.get('/groups/groups',
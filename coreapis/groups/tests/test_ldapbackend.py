@@ -1,13 +1,21 @@
 import time
 import unittest
 from unittest import mock
+import eventlet
 from pytest import raises
+from coreapis.circuitbreaker import CircuitBreaker
+from coreapis.groups import PartialGroups
 from coreapis.utils import translatable
 from coreapis.groups.ldap_backend import (
-    org_membership_name, should_canonicalize_groupid, LDAPBackend)
+    org_membership_name, should_canonicalize_groupid, LDAPBackend, ORG_SEARCH_ATTRIBUTES,
+    ORG_UNIT_SEARCH_ATTRIBUTES)
 from coreapis.groups.tests import test_gogroups
 
 
+def org_rows(org):
+    return [dict(org, id='fc:org:example.org', realm='example.org')]
+
+
 class TestOrgMembershipName(unittest.TestCase):
     def test_he_faculty(self):
         assert org_membership_name(['member', 'employee', 'faculty'],
@@ -48,6 +56,13 @@ class TestLDAPBackend(unittest.TestCase):
         self.session = session()
         self.ldap = ldap.LDAPController()
 
+    @mock.patch('coreapis.groups.ldap_backend.ldapcontroller')
+    @mock.patch('coreapis.groups.ldap_backend.cassandra_client.Client')
+    def test_grep_codes_warm_up(self, session, ldap):
+        settings = {'warm_up_methods': {}}
+        backend = LDAPBackend('org', 100, settings)
+        assert settings['warm_up_methods']['grep_codes'] == backend.grep_codes.preload
+
     def test_handle_gogroup(self):
         with raises(KeyError):
             self.backend._handle_gogroup('example.org', test_gogroups.GROUP1, False)
@@ -59,7 +74,10 @@ class TestLDAPBackend(unittest.TestCase):
         assert 'example.org' in result['id']
 
     def test_handle_gogroup_grep(self):
-        self.session.get_grep_code_by_code.return_value = {'title': {'default': 'grep stuff'}}
+        self.session.list_grep_codes.return_value = [
+            {'id': 'uuid:1', 'code': 'REA3012', 'type': 'fagkoder',
+             'title': {'default': 'grep stuff'}},
+        ]
         result = self.backend._handle_gogroup('example.org', test_gogroups.GROUP2, True)
         assert 'grep' in result
         assert result['grep'] == {'displayName': 'grep stuff',
@@ -233,9 +251,9 @@ class TestLDAPBackend(unittest.TestCase):
                 'eduOrgLegalName': ['testOrg'],
             },
         }]
-        self.session.get_org_by_realm.return_value = {
+        self.session.list_orgs.return_value = org_rows({
             'type': {'higher_education', 'service_provider'},
-        }
+        })
         result = self.backend._get_org('example.org', 'dc=example,dc=org', {})
         assert result == {
             'displayName': 'testOrg',
@@ -253,9 +271,9 @@ class TestLDAPBackend(unittest.TestCase):
                 'eduOrgLegalName': ['testOrg'],
             },
         }]
-        self.session.get_org_by_realm.return_value = {
+        self.session.list_orgs.return_value = org_rows({
             'type': {'primary_and_lower_secondary', 'service_provider'},
-        }
+        })
         result = self.backend._get_org('example.org', 'dc=example,dc=org', {})
         assert result == {
             'displayName': 'testOrg',
@@ -279,9 +297,9 @@ class TestLDAPBackend(unittest.TestCase):
                 'norEduOrgUnitUniqueIdentifier': ['AVD-Q10'],
             },
         }]
-        self.session.get_org_by_realm.return_value = {
+        self.session.list_orgs.return_value = org_rows({
             'type': {'higher_education', 'service_provider'},
-        }
+        })
         result = self.backend._get_orgunit('example.org', 'dc=example,dc=org', 'dc=example,dc=org')
         assert result == {
             'displayName': 'testOrgUnit',
@@ -302,9 +320,9 @@ class TestLDAPBackend(unittest.TestCase):
                 'norEduOrgUnitUniqueIdentifier': ['NO123456789'],
             },
         }]
-        self.session.get_org_by_realm.return_value = {
+        self.session.list_orgs.return_value = org_rows({
             'type': {'primary_and_lower_secondary', 'service_provider'},
-        }
+        })
         result = self.backend._get_orgunit('example.org', 'dc=example,dc=org', None)
         assert result == {
             'displayName': 'testSchool',
@@ -323,3 +341,143 @@ class TestLDAPBackend(unittest.TestCase):
         self.ldap.search.return_value = []
         with raises(KeyError):
             self.backend._get_orgunit('example.org', 'dc=example,dc=org', None)
+
+    def test_get_org_cached(self):
+        self.ldap.search.return_value = [{
+            'attributes': {
+                'eduOrgLegalName': ['testOrg'],
+            },
+        }]
+        self.session.list_orgs.return_value = org_rows({
+            'type': {'higher_education'},
+        })
+        for _ in range(2):
+            result = self.backend._get_org('example.org', 'dc=example,dc=org', {})
+            assert result['displayName'] == 'testOrg'
+        self.ldap.search.assert_called_once_with(
+            'example.org', 'dc=example,dc=org', '(objectClass=*)', mock.ANY,
+            ORG_SEARCH_ATTRIBUTES, 1)
+
+    def test_get_org_and_orgunit_cached_separately(self):
+        self.ldap.search.return_value = [{
+            'attributes': {
+                'eduOrgLegalName': ['testOrg'],
+                'ou': ['testOrgUnit'],
+                'norEduOrgUnitUniqueIdentifier': ['AVD-Q10'],
+            },
+        }]
+        self.session.list_orgs.return_value = org_rows({
+            'type': {'higher_education'},
+        })
+        self.backend._get_org('example.org', 'dc=example,dc=org', {})
+        self.backend._get_orgunit('example.org', 'dc=example,dc=org', None)
+        self.backend._get_orgunit('example.org', 'dc=example,dc=org', None)
+        assert self.ldap.search.call_count == 2
+        assert self.ldap.search.call_args[0][4] == ORG_UNIT_SEARCH_ATTRIBUTES
+
+    def test_get_org_not_found_not_cached(self):
+        self.ldap.search.return_value = []
+        for _ in range(2):
+            with raises(KeyError):
+                self.backend._get_org('example.org', 'dc=example,dc=org', {})
+        assert self.ldap.search.call_count == 2
+
+    def test_get_member_groups_order(self):
+        entries = {
+            'dc=example,dc=org': {'eduOrgLegalName': ['testOrg']},
+            'ou=a,dc=example,dc=org': {'ou': ['A'], 'norEduOrgUnitUniqueIdentifier': ['A']},
+            'ou=b,dc=example,dc=org': {'ou': ['B'], 'norEduOrgUnitUniqueIdentifier': ['B']},
+        }
+        person = {
+            'eduPersonOrgDN': ['dc=example,dc=org'],
+            'eduPersonOrgUnitDN': ['ou=b,dc=example,dc=org', 'ou=missing,dc=example,dc=org',
+                                   'ou=a,dc=example,dc=org'],
+        }
+
+        def search(realm, base_dn, search_filter, scope, attributes, size_limit):
+            if base_dn in entries:
+                eventlet.sleep(0.01 if base_dn == 'dc=example,dc=org' else 0)
+                return [{'attributes': entries[base_dn]}]
+            if search_filter.startswith('(eduPersonPrincipalName'):
+                return [{'attributes': person}]
+            return []
+        self.ldap.search.side_effect = search
+        self.session.list_orgs.return_value = org_rows({'type': {'higher_education'}})
+        result = self.backend._get_member_groups(True, 'user@example.org')
+        assert [group['id'] for group in result] == [
+            'org:example.org', 'org:example.org:unit:B', 'org:example.org:unit:A']
+        assert not isinstance(result, PartialGroups)
+
+    def test_get_member_groups_partial(self):
+        person = {
+            'eduPersonOrgDN': ['dc=example,dc=org'],
+            'eduPersonOrgUnitDN': ['ou=a,dc=example,dc=org'],
+        }
+
+        def search(realm, base_dn, search_filter, scope, attributes, size_limit):
+            if search_filter.startswith('(eduPersonPrincipalName'):
+                return [{'attributes': person}]
+            if base_dn == 'ou=a,dc=example,dc=org':
+                raise RuntimeError('ldap down')
+            return [{'attributes': {'eduOrgLegalName': ['testOrg']}}]
+        self.ldap.search.side_effect = search
+        self.session.list_orgs.return_value = org_rows({'type': {'higher_education'}})
+        result = self.backend.get_member_groups({'userid_sec': ['feide:user@example.org']},
+                                                True)
+        assert isinstance(result, PartialGroups)
+        assert [group['id'] for group in result] == ['org:example.org']
+
+    def test_entry_lookups_bounded(self):
+        self.backend.max_parallel = 2
+        active = []
+        peak = []
+
+        def search(realm, base_dn, search_filter, scope, attributes, size_limit):
+            if search_filter.startswith('(eduPersonPrincipalName'):
+                return [{'attributes': {
+                    'eduPersonOrgUnitDN': ['ou={},dc=example,dc=org'.format(i)
+                                           for i in range(6)],
+                }}]
+            active.append(base_dn)
+            peak.append(len(active))
+            eventlet.sleep(0.01)
+            active.remove(base_dn)
+            return [{'attributes': {'ou': [base_dn], 'norEduOrgUnitUniqueIdentifier': [base_dn]}}]
+        self.ldap.search.side_effect = search
+        self.session.list_orgs.return_value = org_rows({'type': {'higher_education'}})
+        result = self.backend._get_member_groups(True, 'user@example.org')
+        assert len(result) == 6
+        assert max(peak) == 2
+
+    def test_realm_circuit_breaker(self):
+        self.backend.realm_breakers['example.org'] = CircuitBreaker('test', 3., min_calls=2)
+        self.ldap.search.side_effect = RuntimeError('ldap down')
+        for _ in range(2):
+            with raises(RuntimeError):
+                self.backend._get_member_groups(True, 'user@example.org')
+        result = self.backend._get_member_groups(True, 'user@example.org')
+        assert result == []
+        assert isinstance(result, PartialGroups)
+        assert self.ldap.search.call_count == 2
+        assert self.backend.status()['realms']['example.org']['state'] == 'open'
+
+    def test_caller_timeout_not_blamed_on_realm(self):
+        breaker = CircuitBreaker('test', 3., min_calls=1)
+        self.backend.realm_breakers['example.org'] = breaker
+
+        def search(*args):
+            eventlet.sleep(1)
+        self.ldap.search.side_effect = search
+        with raises(eventlet.Timeout):
+            with eventlet.Timeout(0.01):
+                self.backend._get_member_groups(True, 'user@example.org')
+        assert len(breaker.calls) == 0
+        assert breaker.state == 'closed'
+
+    def test_realm_user_not_found_is_success(self):
+        self.backend.realm_breakers['example.org'] = CircuitBreaker('test', 3., min_calls=2)
+        self.ldap.search.return_value = []
+        for _ in range(3):
+            with raises(KeyError):
+                self.backend._get_member_groups(True, 'user@example.org')
+        assert self.backend.status()['realms']['example.org']['state'] == 'closed'
@@ -1,6 +1,6 @@
 from pyramid.view import view_config
 from pyramid.httpexceptions import HTTPNotFound, HTTPForbidden
-from coreapis.utils import get_user, translation
+from coreapis.utils import get_user, translation, wants_ndjson
 from .controller import GroupsController
 
 
@@ -33,6 +33,10 @@ def my_groups_v1(request):
     if not user:
         raise HTTPForbidden('This resource requires a personal token')
     show_all = request.params.get('showAll', 'false').lower() == 'true'
+    if wants_ndjson(request):
+        request.override_renderer = 'ndjson'
+        return request.groups_controller.iter_member_groups(user, show_all,
+                                                            request.has_permission)
     return request.groups_controller.get_member_groups(user, show_all,
                                                        request.has_permission)
 
@@ -118,6 +122,9 @@ def group_members(request):
 def list_groups_v1(request):
     user = get_user(request)
     query = request.params.get('query', None)
+    if wants_ndjson(request):
+        request.override_renderer = 'ndjson'
+        return request.groups_controller.iter_groups(user, query, request.has_permission)
     return request.groups_controller.get_groups(user, query,
                                                 request.has_permission)
 
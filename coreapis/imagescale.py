@@ -0,0 +1,115 @@
+import io
+import multiprocessing
+import threading
+import warnings
+
+from PIL import Image
+
+from coreapis.utils import LogWrapper
+
+warnings.simplefilter('error', Image.DecompressionBombWarning)
+
+
+def scale_image(data, size, fmt):
+    """Returns the encoded image data scaled down to fit within size, and
+    encoded as fmt. thumbnail() sets up draft mode, so JPEG images are
+    decoded at reduced scale."""
+    image = Image.open(io.BytesIO(data))
+    image.thumbnail(size)
+    output = io.BytesIO()
+    image.save(output, format=fmt)
+    return output.getvalue()
+
+
+class ImageScaler(object):
+    """Runs scale_image in a pool of processes, so decoding and encoding
+    images does not hold the GIL while other request threads of the
+    serving process wait for it.
+
+    At most max_pending images are queued or being scaled. Beyond that,
+    and if processes is 0, images are scaled in the calling thread. The
+    pool is started on first use by a forkserver, as forking the worker
+    process itself could leave a child holding a lock taken by one of
+    its threads. If an image is not scaled within timeout seconds, say
+    because a pool process died or hung, the pool is replaced and the
+    image is scaled in the calling thread.
+    """
+    def __init__(self, processes, max_pending, timer=None, timeout=10.):
+        self.log = LogWrapper('coreapis.ImageScaler')
+        self.processes = processes
+        self.max_pending = max_pending
+        self.timer = timer
+        self.timeout = timeout
+        self.pending = 0
+        self.lock = threading.Lock()
+        self.pool = None
+
+    def _incr(self, name):
+        if self.timer:
+            self.timer.incr('imagescale.{}'.format(name))
+
+    def _gauge_pending(self):
+        if self.timer:
+            self.timer.gauge('imagescale.pending', self.pending)
+
+    def _get_pool(self):
+        with self.lock:
+            if self.pool is None:
+                self.log.info('starting image scaling pool', processes=self.processes)
+                context = multiprocessing.get_context('forkserver')
+                self.pool = context.Pool(self.processes)
+            return self.pool
+
+    def _drop_pool(self, pool):
+        with self.lock:
+            if self.pool is not pool:
+                # Already replaced by another thread
+                return
+            self.pool = None
+        self.log.warn('image scaling timed out, replacing pool')
+        self._incr('timeout')
+        pool.terminate()
+
+    def _reserve(self):
+        if self.processes <= 0:
+            return False
+        with self.lock:
+            if self.pending >= self.max_pending:
+                return False
+            self.pending += 1
+        self._gauge_pending()
+        return True
+
+    def _release(self):
+        with self.lock:
+            self.pending -= 1
+        self._gauge_pending()
+
+    def scale(self, data, size, fmt):
+        """Like scale_image, raising the same exceptions"""
+        if not self._reserve():
+            if self.processes > 0:
+                self._incr('overflow')
+            return scale_image(data, size, fmt)
+        pool = self._get_pool()
+        try:
+            return pool.apply_async(scale_image, (data, size, fmt)).get(self.timeout)
+        except multiprocessing.TimeoutError:
+            self._drop_pool(pool)
+        finally:
+            self._release()
+        return scale_image(data, size, fmt)
+
+
+def get_image_scaler(settings):
+    """Returns the ImageScaler kept in settings, creating it on first use
+    from the image_scale_processes, image_scale_max_pending and
+    image_scale_timeout settings"""
+    scaler = settings.get('image_scaler')
+    if scaler is None:
+        scaler = ImageScaler(int(settings.get('image_scale_processes', '2')),
+                             int(settings.get('image_scale_max_pending', '16')),
+                             settings.get('timer'),
+                             float(settings.get('image_scale_timeout', '10')))
+        settings['image_scaler'] = scaler
+    return scaler
@@ -1,5 +1,7 @@
 import base64
+import functools
 import json
+import re
 import urllib.parse
 import uuid
 from copy import deepcopy
@@ -8,11 +10,11 @@ from aniso8601 import parse_datetime
 from eventlet.pools import Pool as EventletPool
 
 from . import cassandra_client
+from .cache import SubtokenCache, TokenCache
+from .ratelimit import RateLimiter, SharedMemoryBucketStore
 from .utils import (
-    LogWrapper, Timer, RateLimiter, now, www_authenticate, init_request_id, request_id,
-    ResourcePool, log_token, get_cassandra_authz)
-
-NULL_USER = uuid.UUID('00000000-0000-0000-0000-000000000000')
+    LogWrapper, Timer, now, www_authenticate, init_request_id, request_id,
+    ResourcePool, log_token, get_cassandra_authz, run_warm_up)
 
 
 def mock_main(app, config):
@@ -27,10 +29,17 @@ def cors_main(app, config):
     return CorsMiddleware(app)
 
 
-def ratelimit_main(app, config, client_max_share, client_max_rate, client_max_burst_size):
-    ratelimiter = RateLimiter(float(client_max_share),
+def ratelimit_main(app, config, client_max_rate, client_max_burst_size, client_max_share=None,
+                   shared_memory_path=None):
+    # client_max_share only works with buckets private to each worker
+    store = None
+    if shared_memory_path:
+        store = SharedMemoryBucketStore(shared_memory_path)
+    maxshare = float(client_max_share) if client_max_share else None
+    ratelimiter = RateLimiter(maxshare,
                               int(client_max_burst_size),
-                              float(client_max_rate))
+                              float(client_max_rate),
+                              store)
     return RateLimitMiddleware(app, ratelimiter)
 
 
@@ -45,11 +54,20 @@ def cassandra_main(app, config, cls=None):
     else:
         pool = ResourcePool
     timer = Timer(config['statsd_server'], int(config['statsd_port']),
-                  config['statsd_prefix'], log_timings, pool)
+                  config['statsd_prefix'], log_timings, pool,
+                  float(config.get('statsd_flush_interval', '1')),
+                  int(config.get('statsd_max_pending', '1000')))
+    token_cache_size = int(config.get('token_cache_size', '10000'))
+    token_cache_ttl = int(config.get('token_cache_ttl', '10'))
+    token_cache_negative_ttl = int(config.get('token_cache_negative_ttl', '10'))
     if cls is None:
         cls = CassandraMiddleware
-    return cls(app, config['oauth_realm'], contact_points,
-               keyspace, timer, use_eventlets, authz)
+    middleware = cls(app, config['oauth_realm'], contact_points,
+                     keyspace, timer, use_eventlets, authz,
+                     token_cache_size, token_cache_ttl, token_cache_negative_ttl)
+    run_warm_up({'cassandra': cassandra_client.warm_up_shared_sessions},
+                config.get('warm_up', 'background'))
+    return middleware
 
 
 def gatekeeped_mw_main(app, config, username, password):
@@ -63,9 +81,14 @@ def gatekeeped_mw_main(app, config, username, password):
     else:
         pool = ResourcePool
     timer = Timer(config['statsd_server'], int(config['statsd_port']),
-                  config['statsd_prefix'], log_timings, pool)
-    return GatekeepedMiddleware(app, config['oauth_realm'], contact_points,
-                                keyspace, timer, use_eventlets, authz, username, password)
+                  config['statsd_prefix'], log_timings, pool,
+                  float(config.get('statsd_flush_interval', '1')),
+                  int(config.get('statsd_max_pending', '1000')))
+    middleware = GatekeepedMiddleware(app, config['oauth_realm'], contact_points,
+                                      keyspace, timer, use_eventlets, authz, username, password)
+    run_warm_up({'cassandra': cassandra_client.warm_up_shared_sessions},
+                config.get('warm_up', 'background'))
+    return middleware
 
 
 def gk_main(app, config):
@@ -124,7 +147,7 @@ class AuthMiddleware(object):
         token = self.get_token(environ)
         if token:
             try:
-                tokendata = self.lookup_token(token)
+                tokendata = self.lookup_request_token(token, environ)
                 environ.update(tokendata)
                 user = environ["FC_USER"]
                 client = environ["FC_CLIENT"]
@@ -153,6 +176,9 @@ class AuthMiddleware(object):
                 self.log.debug('unhandled authorization scheme {}'.format(authorization.split()[0]))
         return None
 
+    def lookup_request_token(self, token, environ):  # pylint: disable=unused-argument
+        return self.lookup_token(token)
+
     def lookup_token(self, token):
         raise KeyError("Not implemented")
 
@@ -256,11 +282,17 @@ class RateLimitMiddleware(object):
 
 class CassandraMiddleware(AuthMiddleware):
     def __init__(self, app, realm, contact_points, keyspace, timer,
-                 use_eventlet, authz):
+                 use_eventlet, authz, token_cache_size=0, token_cache_ttl=10,
+                 token_cache_negative_ttl=10):
         super(CassandraMiddleware, self).__init__(app, realm)
         self.timer = timer
         self.session = cassandra_client.Client(contact_points, keyspace, use_eventlet, authz=authz)
         self.session.timer = timer
+        self.token_cache = None
+        if token_cache_size > 0:
+            self.token_cache = TokenCache(token_cache_size, token_cache_ttl,
+                                          token_cache_negative_ttl, timer)
+            cassandra_client.add_change_listener('oauth_tokens', self.token_cache.invalidate)
 
     def token_is_valid(self, token, token_string):
         for column in ('clientid', 'scope', 'validuntil'):
@@ -274,22 +306,23 @@ class CassandraMiddleware(AuthMiddleware):
             return False
         return True
 
-    def _lookup_token(self, token_string):
+    def _fetch_token(self, token_uuid, token_string):
+        return self.session.get_token_context(
+            token_uuid, lambda token: self.token_is_valid(token, token_string))
+
+    def _lookup_token(self, token_string, fetch=None):
         try:
             token_uuid = uuid.UUID(token_string)
         except ValueError:
             raise KeyError("Token is invalid")
+        if fetch is None:
+            fetch = functools.partial(self._fetch_token, token_uuid, token_string)
+        else:
+            fetch = functools.partial(fetch, token_uuid)
         with self.timer.time('auth.lookup_token'):
-            token = self.session.get_token(token_uuid)
-            if not self.token_is_valid(token, token_string):
-                raise KeyError("Token is invalid")
-
-            client = self.session.get_client_by_id(token['clientid'])
-            if 'userid' in token and token['userid'] is not None and token['userid'] != NULL_USER:
-                user = self.session.get_user_by_id(token['userid'])
-            else:
-                user = None
-            return token, client, user
+            if self.token_cache is None:
+                return fetch()
+            return self.token_cache.get(token_uuid, fetch)
 
     def lookup_token(self, token_string):
         token, client, user = self._lookup_token(token_string)
@@ -300,9 +333,30 @@ class CassandraMiddleware(AuthMiddleware):
         }
 
 
+GK_INFO_PATH = re.compile(r'/info/([^/]+)$')
+
+
+def get_gk_backend(environ):
+    """Returns the API gatekeeper id of a gatekeeper info request, or None"""
+    match = GK_INFO_PATH.search(environ.get('PATH_INFO', ''))
+    if match is None:
+        return None
+    return match.group(1)
+
+
 class GKMiddleware(CassandraMiddleware):
-    def lookup_token(self, token_string):
-        token, client, user = self._lookup_token(token_string)
+    def __init__(self, *args, **kwargs):
+        super(GKMiddleware, self).__init__(*args, **kwargs)
+        self.subtoken_cache = None
+        if self.token_cache is not None:
+            self.subtoken_cache = SubtokenCache(self.token_cache.expiry,
+                                                'coreapis.GKMiddleware.subtoken_cache',
+                                                self.token_cache.maxsize, timer=self.timer,
+                                                counter_prefix='auth.subtoken_cache')
+            cassandra_client.add_change_listener('oauth_tokens', self.subtoken_cache.invalidate)
+
+    @staticmethod
+    def _token_data(token, client, user):
         if 'subtokens' not in token or not token['subtokens']:
             raise KeyError("Token is invalid")
         return {
@@ -313,6 +367,47 @@ class GKMiddleware(CassandraMiddleware):
             'FC_ACR': token.get('acr'),
         }
 
+    def lookup_token(self, token_string):
+        return self._token_data(*self._lookup_token(token_string))
+
+    def _lookup_subtoken(self, subtokenid, prefetched):
+        def fetch():
+            if 'subtoken' in prefetched:
+                if prefetched['subtoken'] is None:
+                    raise KeyError('oauth_tokens entry not found')
+                return prefetched['subtoken']
+            return self.session.get_token(subtokenid)
+
+        if self.subtoken_cache is None:
+            return fetch()
+        return self.subtoken_cache.get(subtokenid, fetch)
+
+    def lookup_request_token(self, token_string, environ):
+        """For gatekeeper info requests, the subtoken for the requested
+        backend is looked up along with the token and passed on as
+        FC_SUBTOKEN."""
+        backend = get_gk_backend(environ)
+        if backend is None:
+            return self.lookup_token(token_string)
+        prefetched = {}
+
+        def fetch(token_uuid):
+            token, client, user, subtoken = self.session.get_gk_token_context(
+                token_uuid, backend, lambda token: self.token_is_valid(token, token_string))
+            prefetched['subtoken'] = subtoken
+            return token, client, user
+
+        token, client, user = self._lookup_token(token_string, fetch)
+        data = self._token_data(token, client, user)
+        subtokenid = token['subtokens'].get(backend)
+        if subtokenid is not None:
+            try:
+                data['FC_SUBTOKEN'] = self._lookup_subtoken(subtokenid, prefetched)
+            except KeyError:
+                # Left for GkController to look up and report
+                pass
+        return data
+
 
 class GatekeepedMiddleware(object):
     def __init__(self, app, realm, contact_points, keyspace, timer,
@@ -341,10 +436,10 @@ class GatekeepedMiddleware(object):
                     scopes = []
                 scopes.append(gatekeeper)
                 if userid:
-                    user = self.session.get_user_by_id(uuid.UUID(userid))
+                    userid = uuid.UUID(userid)
                 else:
-                    user = None
-                client = self.session.get_client_by_id(uuid.UUID(clientid))
+                    userid = None
+                client, user = self.session.get_client_and_user(uuid.UUID(clientid), userid)
                 token = environ.get('HTTP_X_DATAPORTEN_TOKEN')
                 environ.update({
                     'FC_USER': user,
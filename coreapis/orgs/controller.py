@@ -8,7 +8,9 @@ from coreapis.utils import (
     json_normalize, userinfo_for_log)
 from coreapis.cache import Cache
 from coreapis import cassandra_client
+from coreapis.orgsnapshot import get_org_snapshot
 from coreapis.crud_base import CrudControllerBase
+from coreapis.imagescale import get_image_scaler
 from coreapis.clientadm.controller import ClientAdmController
 from coreapis.ldap.status import ldap_status
 
@@ -82,9 +84,11 @@ class OrgController(CrudControllerBase):
         maxrows = settings.get('orgadmin_maxrows')
         ldap_config = settings.get('ldap_config_file', 'ldap-config.json')
         super(OrgController, self).__init__(maxrows)
+        self.image_scaler = get_image_scaler(settings)
         self.timer = timer
         self.log = LogWrapper('org.OrgController')
         self.session = cassandra_client.Client(contact_points, keyspace, authz=authz)
+        self.orgs = get_org_snapshot(settings, self.session)
         self.log.debug('org controller init', keyspace=keyspace)
         self.cadm_controller = ClientAdmController(settings)
         self.ldap_config_file = ldap_config
@@ -133,7 +137,7 @@ class OrgController(CrudControllerBase):
 
     def list_orgs(self, want_peoplesearch=None):
         res = []
-        for org in self.session.list_orgs():
+        for org in self.orgs.list_orgs():
             org = self.format_org(org)
             if want_peoplesearch is None or want_peoplesearch == org['has_peoplesearch']:
                 res.append(org)
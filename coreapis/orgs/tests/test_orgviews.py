@@ -70,6 +70,7 @@ class OrgViewTests(unittest.TestCase):
                 'oauth_realm': 'test realm',
                 'cassandra_contact_points': '',
                 'cassandra_keyspace': 'notused',
+                'warm_up': 'none',
             },
             enabled_components='orgs',
             clientadm_maxrows=100,
@@ -0,0 +1,142 @@
+from coreapis.cache import Cache
+from coreapis.cassandra_client import add_change_listener
+from coreapis.utils import LogWrapper, translatable
+
+# How long a snapshot may be served after its reload interval, if reloading fails
+MAX_STALE = 24 * 3600
+
+
+def _with_translatable_name(org):
+    if org.get('name') is None or isinstance(org['name'], translatable):
+        return org
+    return dict(org, name=translatable(org['name']))
+
+
+class Snapshot(object):
+    """The organizations table at one point in time, indexed by id,
+    realm, service and type. Names are translatable, as from
+    Client.get_org."""
+    def __init__(self, orgs):
+        orgs = [_with_translatable_name(org) for org in orgs]
+        self.by_id = {org['id']: org for org in orgs}
+        self.by_realm = {}
+        self.by_service = {}
+        self.by_type = {}
+        for org in orgs:
+            if org.get('realm'):
+                self.by_realm[org['realm']] = org
+            for service in org.get('services') or ():
+                self.by_service.setdefault(service, []).append(org)
+            for orgtype in org.get('type') or ():
+                self.by_type.setdefault(orgtype, []).append(org)
+
+    def __len__(self):
+        return len(self.by_id)
+
+
+class OrgSnapshot(object):
+    """In-memory copy of the organizations table, shared by the
+    controllers in a process.
+
+    The table is a few hundred rows, so it is loaded as a whole and
+    reloaded in the background once it is older than reload_interval
+    seconds. A reload that finds no changes keeps the current snapshot.
+    invalidate drops the snapshot, so changes are seen at once. Lookups
+    return copies, which callers may
+    modify. They only reach the database if the table could not be
+    loaded.
+    """
+    def __init__(self, session, reload_interval, timer=None):
+        self.log = LogWrapper('coreapis.orgsnapshot')
+        self.session = session
+        self.timer = timer
+        self.current = None
+        self.cache = Cache(reload_interval, 'coreapis.orgsnapshot', maxsize=1, stale=MAX_STALE,
+                           timer=timer, counter_prefix='org_snapshot', use_eventlets=True)
+
+    def invalidate(self, orgid=None):  # pylint: disable=unused-argument
+        self.cache.invalidate('snapshot')
+
+    def _load(self):
+        orgs = list(self.session.list_orgs())
+        current = self.current
+        if current is not None and {org['id']: org for org in orgs} == current.by_id:
+            self.log.debug('organizations unchanged', count=len(current))
+            return current
+        snapshot = Snapshot(orgs)
+        if current is not None and self.timer:
+            self.timer.incr('org_snapshot.changed')
+        self.log.info('loaded organizations', count=len(snapshot))
+        self.current = snapshot
+        return snapshot
+
+    def _snapshot(self):
+        try:
+            return self.cache.get('snapshot', self._load)
+        except Exception as ex:  # pylint: disable=broad-except
+            self.log.warn('could not load organizations', exception=str(ex))
+            return None
+
+    def preload(self):
+        self._snapshot()
+
+    def list_orgs(self):
+        snapshot = self._snapshot()
+        if snapshot is None:
+            return list(self.session.list_orgs())
+        return [dict(org) for org in snapshot.by_id.values()]
+
+    def get_org(self, orgid):
+        snapshot = self._snapshot()
+        if snapshot is None:
+            return self.session.get_org(orgid)
+        try:
+            return dict(snapshot.by_id[orgid])
+        except KeyError:
+            raise KeyError('organizations entry not found')
+
+    def get_org_by_realm(self, realm):
+        snapshot = self._snapshot()
+        if snapshot is None:
+            return self.session.get_org_by_realm(realm)
+        try:
+            return dict(snapshot.by_realm[realm])
+        except KeyError:
+            raise KeyError('organizations entry not found')
+
+    def orgs_with_service(self, service):
+        snapshot = self._snapshot()
+        if snapshot is None:
+            return [org for org in self.session.list_orgs()
+                    if service in (org.get('services') or ())]
+        return [dict(org) for org in snapshot.by_service.get(service, [])]
+
+    def orgs_of_type(self, orgtype):
+        snapshot = self._snapshot()
+        if snapshot is None:
+            return [org for org in self.session.list_orgs()
+                    if orgtype in (org.get('type') or ())]
+        return [dict(org) for org in snapshot.by_type.get(orgtype, [])]
+
+    def realm_has_service(self, realm, service):
+        try:
+            org = self.get_org_by_realm(realm)
+        except KeyError:
+            return False
+        return service in (org.get('services') or ())
+
+
+def get_org_snapshot(settings, session):
+    """Returns the OrgSnapshot kept in settings, creating it with session
+    on first use. It is reloaded every org_snapshot_reload_interval
+    seconds, loaded during warm up, and invalidated by changes made
+    through a Client in this process."""
+    snapshot = settings.get('org_snapshot')
+    if snapshot is None:
+        reload_interval = int(settings.get('org_snapshot_reload_interval', '60'))
+        snapshot = OrgSnapshot(session, reload_interval, settings.get('timer'))
+        settings['org_snapshot'] = snapshot
+        add_change_listener('organizations', snapshot.invalidate)
+        if 'warm_up_methods' in settings:
+            settings['warm_up_methods']['org_snapshot'] = snapshot.preload
+    return snapshot
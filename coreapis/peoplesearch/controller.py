@@ -1,18 +1,22 @@
 import base64
+import concurrent.futures
 import datetime
 import hashlib
-import io
-
-from PIL import Image
+import threading
 
 from coreapis.utils import ValidationError, LogWrapper, now, \
     get_platform_admins, get_feideids
+from coreapis.assets import get_default_assets
+from coreapis.cache import Cache
+from coreapis.imagescale import get_image_scaler
 import coreapis.cassandra_client
 from coreapis.ldap.controller import validate_query
 from coreapis.ldap import PEOPLE_SEARCH_ATTRIBUTES, get_single
 from .tokens import crypt_token, decrypt_token
 
 THUMB_SIZE = 128, 128
+# Seconds before retrying to refresh a stale image whose refresh failed
+REFRESH_RETRY = 60
 SINGLE_VALUED_ATTRIBUTES = ['cn', 'displayName', 'eduPersonPrincipalName']
 
 
@@ -40,6 +44,14 @@ class CassandraCache(coreapis.cassandra_client.Client):
     def __init__(self, contact_points, keyspace, authz):
         super(CassandraCache, self).__init__(contact_points, keyspace, False, authz)
 
+    def statement_catalogue(self):
+        return [
+            'SELECT * from profile_image_cache where user=?',
+            'SELECT etag, last_modified, last_updated from profile_image_cache where user=?',
+            'UPDATE profile_image_cache set last_modified=?, etag=?, last_updated=?, image=? ' +
+            'WHERE user=?',
+        ]
+
     def lookup(self, user):
         s_lookup = self._prepare('SELECT * from profile_image_cache where user=?')
         res = list(self.session.execute(s_lookup.bind([user])))
@@ -48,6 +60,21 @@ class CassandraCache(coreapis.cassandra_client.Client):
         entry = res[0]
         return entry
 
+    def lookup_many(self, users):
+        """Like lookup, for many users at once. Returns a dict of the
+        entries found, by user."""
+        s_lookup = self._prepare('SELECT * from profile_image_cache where user=?')
+        return self._get_concurrent(s_lookup, users)
+
+    def lookup_meta(self, user):
+        """Like lookup, but without the image"""
+        s_lookup = self._prepare(
+            'SELECT etag, last_modified, last_updated from profile_image_cache where user=?')
+        res = list(self.session.execute(s_lookup.bind([user])))
+        if not res:
+            return None
+        return res[0]
+
     def insert(self, user, last_updated, last_modified, etag, image):
         s_insert = self._prepare(
             'UPDATE profile_image_cache set last_modified=?, etag=?, last_updated=?, image=? ' +
@@ -55,6 +82,26 @@ class CassandraCache(coreapis.cassandra_client.Client):
         self.session.execute(s_insert.bind([last_modified, etag, last_updated, image, user]))
 
 
+class ProfileImageCache(Cache):
+    """In-process LRU of profile image cache entries, holding up to
+    maxbytes of images. An entry is fresh as long as it is in
+    profile_image_cache, and is served stale for up to update_age more
+    while it is refreshed."""
+    def __init__(self, maxbytes, update_age, timer):
+        seconds = update_age.total_seconds()
+        super(ProfileImageCache, self).__init__(seconds, 'peoplesearch.ProfileImageCache',
+                                                maxbytes, seconds, timer,
+                                                'ps.profileimage.memory_cache')
+        self.update_age = update_age
+
+    def entry_expiry(self, value):
+        expires = value['last_updated'] + self.update_age - now()
+        return max(expires.total_seconds(), REFRESH_RETRY)
+
+    def entry_size(self, value):
+        return len(value['image'])
+
+
 class PeopleSearchController(object):
 
     def __init__(self, ldap_controller, settings):
@@ -63,15 +110,22 @@ class PeopleSearchController(object):
         authz = settings.get('cassandra_authz')
         cache_keyspace = settings.get('peoplesearch.cache_keyspace')
         cache_update_seconds = int(settings.get('peoplesearch.cache_update_seconds', 3600))
+        memory_cache_bytes = int(settings.get('peoplesearch.memory_cache_bytes', 32 * 2**20))
+        batch_parallelism = int(settings.get('peoplesearch.batch_parallelism', 8))
         timer = settings.get('timer')
 
         self.key = key
         self.timer = timer
         self.ldap = ldap_controller
-        self.image_cache = dict()
         self.log = LogWrapper('peoplesearch.PeopleSearchController')
         self.db = CassandraCache(contact_points, cache_keyspace, authz)
         self.cache_update_age = datetime.timedelta(seconds=cache_update_seconds)
+        self.image_cache = ProfileImageCache(memory_cache_bytes, self.cache_update_age, timer)
+        self.image_scaler = get_image_scaler(settings)
+        self.default_assets = get_default_assets(settings)
+        self.refreshing = set()
+        self.refreshing_lock = threading.Lock()
+        self.batch_parallelism = batch_parallelism
         self.search_max_replies = 50
         platformadmins_file = settings.get('platformadmins_file')
         self.platformadmins = get_platform_admins(platformadmins_file)
@@ -178,10 +232,8 @@ class PeopleSearchController(object):
         return decrypt_token(token, self.key)
 
     def _default_image(self):
-        with open('data/default-profile.jpg', 'rb') as fh:
-            data = fh.read()
-            etag = make_etag(data)
-            return data, etag, now()
+        asset = self.default_assets.get('data/default-profile.jpg')
+        return asset.data, asset.etag, asset.last_modified
 
     def _fetch_profile_image(self, user):
         if ':' not in user:
@@ -192,32 +244,109 @@ class PeopleSearchController(object):
         else:
             raise ValidationError("Unhandled user id type '{}'".format(idtype))
         if data is None:
-            data, etag, last_modified = self._default_image()
+            return self._default_image()
         with self.timer.time('ps.profileimage.scale'):
-            fake_file = io.BytesIO(data)
-            image = Image.open(fake_file)
-            image.thumbnail(THUMB_SIZE)
-            fake_output = io.BytesIO()
-            image.save(fake_output, format='JPEG')
-            return bytes(fake_output.getbuffer()), etag, last_modified
+            return self.image_scaler.scale(data, THUMB_SIZE, 'JPEG'), etag, last_modified
 
     def profile_image(self, user):
+        entry = self.image_cache.get(user, lambda: self._load_profile_image(user))
+        return entry['image'], entry['etag'], entry['last_modified']
+
+    def profile_images(self, users):
+        """Like profile_image for many users at once. Cache entries are
+        read in bulk, and images not cached are fetched concurrently.
+        Returns a dict of (image, etag, last_modified) by user, without
+        the users whose image could not be fetched."""
+        entries = {}
+        missing = []
+        for user in set(users):
+            entry = self.image_cache.peek(user)
+            if entry is None:
+                missing.append(user)
+            else:
+                entries[user] = entry
+        if missing:
+            with self.timer.time('ps.profileimage.lookup_many'):
+                cached = self.db.lookup_many(missing)
+            for user, cache in cached.items():
+                if cache['last_updated'] < (now() - self.cache_update_age):
+                    self._spawn_refresh(user, cache)
+                entries[user] = cache
+                self.image_cache.set(user, cache)
+        fetch = [user for user in missing if user not in entries]
+        if fetch:
+            parallelism = min(len(fetch), self.batch_parallelism)
+            with concurrent.futures.ThreadPoolExecutor(parallelism) as executor:
+                fetched = list(executor.map(self._try_update_profile_image, fetch))
+            for user, entry in zip(fetch, fetched):
+                if entry is not None:
+                    entries[user] = entry
+                    self.image_cache.set(user, entry)
+        return {user: (entry['image'], entry['etag'], entry['last_modified'])
+                for user, entry in entries.items()}
+
+    def _try_update_profile_image(self, user):
+        try:
+            return self._update_profile_image(user, None)
+        except Exception as ex:  # pylint: disable=broad-except
+            self.log.warn('profile image fetch failed', user=user, exception=str(ex))
+            return None
+
+    def profile_image_meta(self, user):
+        """Returns (etag, last_modified) of the cached image of user, or
+        None if it is not cached. Used to answer conditional requests
+        without reading the image."""
+        entry = self.image_cache.peek(user)
+        if entry is None:
+            entry = self.db.lookup_meta(user)
+            if entry is None:
+                return None
+            if entry['last_updated'] < (now() - self.cache_update_age):
+                self._spawn_refresh(user, entry)
+        return entry['etag'], entry['last_modified']
+
+    def _load_profile_image(self, user):
         cache = self.db.lookup(user)
         if cache is None:
             self.log.debug('image not in cache')
-            image, etag, last_modified = self._fetch_profile_image(user)
-            self.cache_profile_image(user, last_modified, etag, image)
-            return image, etag, last_modified
+            return self._update_profile_image(user, None)
         if cache['last_updated'] < (now() - self.cache_update_age):
             self.log.debug('image cache stale')
-            image, etag, last_modified = self._fetch_profile_image(user)
-            if etag == cache['etag']:
-                last_modified = cache['last_modified']
-                self.log.debug('image had not changed when refreshing cache')
-            self.cache_profile_image(user, last_modified, etag, image)
-            return image, etag, last_modified
-        self.log.debug('image cache OK')
-        return cache['image'], cache['etag'], cache['last_modified']
+            self._spawn_refresh(user, cache)
+        else:
+            self.log.debug('image cache OK')
+        return cache
+
+    @staticmethod
+    def _spawn(func, *args):
+        threading.Thread(target=func, args=args, daemon=True).start()
+
+    def _spawn_refresh(self, user, cache):
+        with self.refreshing_lock:
+            if user in self.refreshing:
+                return
+            self.refreshing.add(user)
+        self._spawn(self._refresh_profile_image, user, cache)
+
+    def _refresh_profile_image(self, user, cache):
+        try:
+            self.image_cache.set(user, self._update_profile_image(user, cache))
+        except Exception as ex:  # pylint: disable=broad-except
+            self.log.warn('profile image refresh failed', user=user, exception=str(ex))
+        finally:
+            with self.refreshing_lock:
+                self.refreshing.discard(user)
+
+    def _update_profile_image(self, user, cache):
+        """Fetches and scales the image of user, and stores it in
+        profile_image_cache. Returns the new cache entry."""
+        image, etag, last_modified = self._fetch_profile_image(user)
+        if cache is not None and etag == cache['etag']:
+            last_modified = cache['last_modified']
+            self.log.debug('image had not changed when refreshing cache')
+        self.cache_profile_image(user, last_modified, etag, image)
+        return {'image': image, 'etag': etag, 'last_modified': last_modified,
+                'last_updated': now()}
 
     def cache_profile_image(self, user, last_modified, etag, data):
         last_modified = last_modified.replace(microsecond=0)
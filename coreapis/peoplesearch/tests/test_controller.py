@@ -27,26 +27,33 @@ class TestProfileImageCacheLogic(TestCase):
 
     def test_cache_miss(self):
         self.controller.db.lookup = mock.MagicMock(return_value=None)
-        self.controller._fetch_profile_image = mock.MagicMock(return_value=(1, 2, 3))
+        self.controller._fetch_profile_image = mock.MagicMock(return_value=(b'1', 2, 3))
         self.controller.cache_profile_image = mock.MagicMock()
         image, etag, last_modified = self.controller.profile_image('testuser')
         self.controller._fetch_profile_image.assert_called_with('testuser')
-        self.controller.cache_profile_image.assert_called_with('testuser', 3, 2, 1)
+        self.controller.cache_profile_image.assert_called_with('testuser', 3, 2, b'1')
+        assert (image, etag, last_modified) == (b'1', 2, 3)
+
+    def _test_cache_stale(self, cache, fetched):
+        self.controller.db.lookup = mock.MagicMock(return_value=cache)
+        self.controller._fetch_profile_image = mock.MagicMock(return_value=fetched)
+        self.controller.cache_profile_image = mock.MagicMock()
+        self.controller._spawn = lambda func, *args: func(*args)
+        image, etag, last_modified = self.controller.profile_image('testuser')
+        assert image == cache['image']
+        assert etag == cache['etag']
+        self.controller._fetch_profile_image.assert_called_with('testuser')
 
     def test_cache_stale_updated(self):
         cache = {
             'last_modified': now(),
             'last_updated': now() - datetime.timedelta(seconds=self.age),
             'etag': 1,
-            'image': 2
+            'image': b'2'
         }
-        self.controller.db.lookup = mock.MagicMock(return_value=cache)
         modified_time = now()
-        self.controller._fetch_profile_image = mock.MagicMock(return_value=(4, 5, modified_time))
-        self.controller.cache_profile_image = mock.MagicMock()
-        image, etag, last_modified = self.controller.profile_image('testuser')
-        self.controller._fetch_profile_image.assert_called_with('testuser')
-        self.controller.cache_profile_image.assert_called_with('testuser', modified_time, 5, 4)
+        self._test_cache_stale(cache, (b'4', 5, modified_time))
+        self.controller.cache_profile_image.assert_called_with('testuser', modified_time, 5, b'4')
 
     def test_cache_stale_not_updated(self):
         modified_time = now()
@@ -54,14 +61,24 @@ class TestProfileImageCacheLogic(TestCase):
             'last_modified': modified_time,
             'last_updated': now() - datetime.timedelta(seconds=self.age),
             'etag': 1,
-            'image': 2
+            'image': b'2'
+        }
+        self._test_cache_stale(cache, (b'2', 1, now()))
+        self.controller.cache_profile_image.assert_called_with('testuser', modified_time, 1, b'2')
+
+    def test_cache_stale_refresh_in_progress(self):
+        cache = {
+            'last_modified': now(),
+            'last_updated': now() - datetime.timedelta(seconds=self.age),
+            'etag': 1,
+            'image': b'2'
         }
         self.controller.db.lookup = mock.MagicMock(return_value=cache)
-        self.controller._fetch_profile_image = mock.MagicMock(return_value=(2, 1, now()))
-        self.controller.cache_profile_image = mock.MagicMock()
-        image, etag, last_modified = self.controller.profile_image('testuser')
-        self.controller._fetch_profile_image.assert_called_with('testuser')
-        self.controller.cache_profile_image.assert_called_with('testuser', modified_time, 1, 2)
+        self.controller._fetch_profile_image = mock.MagicMock()
+        self.controller.refreshing.add('testuser')
+        image, _, _ = self.controller.profile_image('testuser')
+        assert image == b'2'
+        assert not self.controller._fetch_profile_image.called
 
     def test_cache_up_to_date(self):
         modified_time = now()
@@ -69,18 +86,106 @@ class TestProfileImageCacheLogic(TestCase):
             'last_modified': modified_time,
             'last_updated': modified_time,
             'etag': 1,
-            'image': 2
+            'image': b'2'
         }
         self.controller.db.lookup = mock.MagicMock(return_value=cache)
-        self.controller._fetch_profile_image = mock.MagicMock(return_value=(2, 1, now()))
+        self.controller._fetch_profile_image = mock.MagicMock(return_value=(b'2', 1, now()))
         self.controller.cache_profile_image = mock.MagicMock()
         image, etag, last_modified = self.controller.profile_image('testuser')
-        assert image == 2
+        assert image == b'2'
         assert etag == 1
         assert last_modified == modified_time
         assert not self.controller._fetch_profile_image.called
         assert not self.controller.cache_profile_image.called
 
+    def test_memory_cache(self):
+        cache = {
+            'last_modified': now(),
+            'last_updated': now(),
+            'etag': 1,
+            'image': b'2'
+        }
+        self.controller.db.lookup = mock.MagicMock(return_value=cache)
+        for _ in range(3):
+            assert self.controller.profile_image('testuser')[0] == b'2'
+        self.controller.db.lookup.assert_called_once_with('testuser')
+        assert self.controller.image_cache.used == 1
+
+    def test_meta_from_memory(self):
+        modified_time = now()
+        cache = {
+            'last_modified': modified_time,
+            'last_updated': modified_time,
+            'etag': 1,
+            'image': b'2'
+        }
+        self.controller.db.lookup = mock.MagicMock(return_value=cache)
+        self.controller.profile_image('testuser')
+        assert self.controller.profile_image_meta('testuser') == (1, modified_time)
+        assert not self.controller.db.lookup_meta.called
+
+    def test_meta_from_database(self):
+        modified_time = now()
+        meta = {'last_modified': modified_time, 'last_updated': modified_time, 'etag': 1}
+        self.controller.db.lookup_meta = mock.MagicMock(return_value=meta)
+        self.controller._spawn = mock.MagicMock()
+        assert self.controller.profile_image_meta('testuser') == (1, modified_time)
+        assert not self.controller.db.lookup.called
+        assert not self.controller._spawn.called
+
+    def test_meta_stale_refreshes(self):
+        meta = {
+            'last_modified': now(),
+            'last_updated': now() - datetime.timedelta(seconds=self.age),
+            'etag': 1,
+        }
+        self.controller.db.lookup_meta = mock.MagicMock(return_value=meta)
+        self.controller._spawn = mock.MagicMock()
+        assert self.controller.profile_image_meta('testuser')[0] == 1
+        self.controller._spawn.assert_called_once_with(
+            self.controller._refresh_profile_image, 'testuser', meta)
+
+    def test_meta_not_cached(self):
+        self.controller.db.lookup_meta = mock.MagicMock(return_value=None)
+        assert self.controller.profile_image_meta('testuser') is None
+
+    def test_profile_images(self):
+        fresh = {'last_modified': now(), 'last_updated': now(), 'etag': 1, 'image': b'1'}
+        stale = {
+            'last_modified': now(),
+            'last_updated': now() - datetime.timedelta(seconds=self.age),
+            'etag': 2,
+            'image': b'2'
+        }
+        self.controller.image_cache.set('memory', fresh)
+        self.controller.db.lookup_many = mock.MagicMock(
+            return_value={'fresh': fresh, 'stale': stale})
+        self.controller._spawn = mock.MagicMock()
+        modified_time = now()
+
+        def fetch(user):
+            if user == 'fail':
+                raise KeyError('ldap down')
+            return b'3', 3, modified_time
+        self.controller._fetch_profile_image = mock.MagicMock(side_effect=fetch)
+        self.controller.cache_profile_image = mock.MagicMock()
+        res = self.controller.profile_images(['memory', 'fresh', 'stale', 'new', 'fail', 'new'])
+        assert res == {
+            'memory': (b'1', 1, fresh['last_modified']),
+            'fresh': (b'1', 1, fresh['last_modified']),
+            'stale': (b'2', 2, stale['last_modified']),
+            'new': (b'3', 3, modified_time),
+        }
+        assert sorted(self.controller.db.lookup_many.call_args[0][0]) == \
+            ['fail', 'fresh', 'new', 'stale']
+        assert sorted(call[0][0] for call in self.controller._fetch_profile_image.call_args_list) \
+            == ['fail', 'new']
+        self.controller._spawn.assert_called_once_with(
+            self.controller._refresh_profile_image, 'stale', stale)
+        self.controller.cache_profile_image.assert_called_once_with(
+            'new', modified_time, 3, b'3')
+        assert self.controller.image_cache.peek('new')['image'] == b'3'
+
 
 class TestProfileImageFetch(TestCase):
     def setUp(self):
@@ -0,0 +1,67 @@
+import unittest
+from unittest import mock
+
+import webtest
+from pyramid import testing
+
+from coreapis import main, middleware
+from coreapis.utils import now
+
+
+class ProfilePhotosViewTests(unittest.TestCase):
+    @mock.patch('coreapis.peoplesearch.views.PeopleSearchController')
+    @mock.patch('coreapis.peoplesearch.views.LDAPController')
+    @mock.patch('coreapis.middleware.cassandra_client.Client')
+    def setUp(self, Client, ldap, controller):
+        app = main({
+            'statsd_server': 'localhost',
+            'statsd_port': '8125',
+            'statsd_prefix': 'dataporten.tests',
+            'oauth_realm': 'test realm',
+            'cassandra_contact_points': '',
+            'cassandra_keyspace': 'notused',
+            'warm_up': 'none',
+        }, enabled_components='peoplesearch')
+        mw = middleware.MockAuthMiddleware(app, 'test realm')
+        self.controller = controller()
+        self.controller.search_max_replies = 2
+        self.testapp = webtest.TestApp(mw)
+
+    def tearDown(self):
+        testing.tearDown()
+
+    def test_profile_photos(self):
+        modified = now()
+
+        def decrypt(token):
+            if token == 'bad':
+                raise ValueError('invalid token')
+            return 'feide:{}@example.org'.format(token)
+        self.controller.decrypt_profile_image_token.side_effect = decrypt
+        self.controller.profile_images.return_value = {
+            'feide:found@example.org': (b'image', 'etag', modified),
+        }
+        res = self.testapp.post_json('/peoplesearch/v1/people/profilephotos', ['found', 'bad'],
+                                     status=200)
+        assert res.json['found']['image'] == 'aW1hZ2U='
+        assert res.json['found']['etag'] == 'etag'
+        assert res.json['bad'] == {'error': 'invalid token'}
+        self.controller.profile_images.assert_called_once_with(['feide:found@example.org'])
+
+    def test_profile_photos_not_found(self):
+        self.controller.decrypt_profile_image_token.return_value = 'feide:gone@example.org'
+        self.controller.profile_images.return_value = {}
+        res = self.testapp.post_json('/peoplesearch/v1/people/profilephotos', ['gone'],
+                                     status=200)
+        assert res.json == {'gone': {'error': 'not found'}}
+
+    def test_profile_photos_not_a_list(self):
+        self.testapp.post_json('/peoplesearch/v1/people/profilephotos', {'token': 'found'},
+                               status=400)
+        self.testapp.post_json('/peoplesearch/v1/people/profilephotos', [1], status=400)
+        self.controller.profile_images.assert_not_called()
+
+    def test_profile_photos_too_many(self):
+        self.testapp.post_json('/peoplesearch/v1/people/profilephotos', ['a', 'b', 'c'],
+                               status=400)
+        self.controller.profile_images.assert_not_called()
@@ -1,8 +1,9 @@
+import base64
 import threading
 from pyramid.view import view_config
 from pyramid.httpexceptions import HTTPNotFound, HTTPNotModified, HTTPForbidden
 from pyramid.response import Response
-from coreapis.utils import get_user, get_max_replies
+from coreapis.utils import get_user, get_max_replies, get_payload, ValidationError
 from coreapis.ldap.controller import LDAPController
 from .controller import validate_query, PeopleSearchController
 
@@ -25,6 +26,7 @@ def configure(config):
     config.add_route('list_realms', '/orgs')
     config.add_route('profile_photo_v1', '/v1/people/profilephoto/{token}')
     config.add_route('profile_photo', '/people/profilephoto/{token}')
+    config.add_route('profile_photos_v1', '/v1/people/profilephotos')
     config.scan(__name__)
 
 
@@ -87,15 +89,25 @@ def cache_date_min(a, b):
     return min(a, b)
 
 
+def not_modified(request, etag, last_modified):
+    if request.if_none_match and etag in request.if_none_match:
+        return True
+    if request.if_modified_since and request.if_modified_since >= last_modified:
+        return True
+    return False
+
+
 @view_config(route_name='profile_photo_v1')
 def profilephoto_v1(request):
     token = request.matchdict['token']
     user = request.ps_controller.decrypt_profile_image_token(token)
+    if request.if_none_match or request.if_modified_since:
+        meta = request.ps_controller.profile_image_meta(user)
+        if meta is not None and not_modified(request, *meta):
+            raise HTTPNotModified()
     image, etag, last_modified = \
         request.ps_controller.profile_image(user)
-    if request.if_none_match and etag in request.if_none_match:
-        raise HTTPNotModified()
-    if request.if_modified_since and request.if_modified_since >= last_modified:
+    if not_modified(request, etag, last_modified):
         raise HTTPNotModified()
     response = Response(image, charset=None)
     response.content_type = 'image/jpeg'
@@ -108,3 +120,35 @@ def profilephoto_v1(request):
 @view_config(route_name='profile_photo')
 def profilephoto(request):
     return profilephoto_v1(request)
+
+
+@view_config(route_name='profile_photos_v1', request_method='POST', renderer='json')
+def profilephotos_v1(request):
+    """Returns the profile photos of a JSON list of profile image tokens,
+    as an object with the base64 encoded image, etag and last_modified,
+    or an error, by token"""
+    tokens = get_payload(request)
+    if not isinstance(tokens, list) or not all(isinstance(token, str) for token in tokens):
+        raise ValidationError('payload must be a list of profile image tokens')
+    if len(tokens) > request.ps_controller.search_max_replies:
+        raise ValidationError('at most {} tokens are allowed'.format(
+            request.ps_controller.search_max_replies))
+    result = {}
+    users = {}
+    for token in tokens:
+        try:
+            users[token] = request.ps_controller.decrypt_profile_image_token(token)
+        except ValueError:
+            result[token] = {'error': 'invalid token'}
+    images = request.ps_controller.profile_images(list(users.values()))
+    for token, user in users.items():
+        if user not in images:
+            result[token] = {'error': 'not found'}
+            continue
+        image, etag, last_modified = images[user]
+        result[token] = {
+            'image': base64.b64encode(image).decode('ASCII'),
+            'etag': etag,
+            'last_modified': last_modified,
+        }
+    return result
@@ -0,0 +1,164 @@
+from collections import defaultdict, deque
+import fcntl
+import hashlib
+import logging
+import mmap
+import os
+import struct
+import time
+
+from coreapis.utils import LogWrapper
+
+
+class LeakyBucket(object):
+    __slots__ = ('contents', 'ts')
+
+    def __init__(self, ts):
+        self.contents = 0.
+        self.ts = ts
+
+    def add(self, capacity, leak_rate, ts):
+        """Leaks what has leaked since the last call, and adds one unit if
+        there is room. Returns False if the bucket was full."""
+        contents = self.contents - leak_rate * (ts - self.ts)
+        if contents < 0.:
+            contents = 0.
+        self.ts = ts
+        if contents >= capacity:
+            self.contents = contents
+            return False
+        self.contents = contents + 1.
+        return True
+
+
+class LocalBucketStore(object):
+    """Leaky buckets private to this process"""
+    shared = False
+
+    def __init__(self):
+        self.buckets = {}
+
+    def add(self, key, capacity, leak_rate, ts):
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = self.buckets[key] = LeakyBucket(ts)
+        return bucket.add(capacity, leak_rate, ts)
+
+    def contents(self, key):
+        bucket = self.buckets.get(key)
+        return bucket.contents if bucket else 0.
+
+    def delete(self, key):
+        self.buckets.pop(key, None)
+
+
+class SharedMemoryBucketStore(object):
+    """Leaky buckets in a memory mapped file, shared by all workers on a
+    host that use the same path (preferably on tmpfs, like /dev/shm).
+
+    The file is a fixed table of nslots buckets, indexed by a hash of
+    the key. When two keys hash to the same slot the newest one takes
+    it over, so a colliding client gets an empty bucket rather than
+    someone else's. Each slot is guarded by a byte range lock on the
+    file. Timestamps must come from a clock shared by the processes,
+    like time.monotonic.
+
+    Buckets are never deleted on behalf of a single worker, as the
+    others may still be counting on them, so RateLimiter refuses a
+    maxshare with this store. Abandoned buckets leak empty and their
+    slots are taken over by other keys.
+    """
+    slot = struct.Struct('=Qdd')  # key hash, contents, timestamp
+    shared = True
+
+    def __init__(self, path, nslots=65536):
+        self.nslots = nslots
+        size = self.slot.size * nslots
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        if os.fstat(self.fd).st_size < size:
+            os.ftruncate(self.fd, size)
+        self.map = mmap.mmap(self.fd, size)
+
+    def _locate(self, key):
+        digest = hashlib.md5(key.encode('UTF-8')).digest()[:8]
+        khash = int.from_bytes(digest, 'little') | 1  # 0 marks an empty slot
+        return khash, (khash % self.nslots) * self.slot.size
+
+    def _read(self, khash, offset):
+        stored_hash, contents, ts = self.slot.unpack_from(self.map, offset)
+        if stored_hash != khash:
+            return None, None
+        return contents, ts
+
+    def add(self, key, capacity, leak_rate, ts):
+        khash, offset = self._locate(key)
+        fcntl.lockf(self.fd, fcntl.LOCK_EX, self.slot.size, offset)
+        try:
+            contents, bucket_ts = self._read(khash, offset)
+            if contents is None:
+                contents, bucket_ts = 0., ts
+            contents -= leak_rate * max(0., ts - bucket_ts)
+            if contents < 0.:
+                contents = 0.
+            accepted = contents < capacity
+            if accepted:
+                contents += 1.
+            self.slot.pack_into(self.map, offset, khash, contents, max(ts, bucket_ts))
+            return accepted
+        finally:
+            fcntl.lockf(self.fd, fcntl.LOCK_UN, self.slot.size, offset)
+
+    def contents(self, key):
+        contents, _ = self._read(*self._locate(key))
+        return contents or 0.
+
+    def delete(self, key):
+        khash, offset = self._locate(key)
+        fcntl.lockf(self.fd, fcntl.LOCK_EX, self.slot.size, offset)
+        try:
+            if self.slot.unpack_from(self.map, offset)[0] == khash:
+                self.slot.pack_into(self.map, offset, 0, 0., 0.)
+        finally:
+            fcntl.lockf(self.fd, fcntl.LOCK_UN, self.slot.size, offset)
+
+
+class RateLimiter(object):
+    # Requests are let through if client is not among last 1/maxshare
+    # clients served, or if there is still room in the client's token bucket.
+    # The recent clients are counted per process, so maxshare can not be
+    # combined with a shared store: one worker would reset buckets that the
+    # others are still filling. Without maxshare buckets just leak empty.
+    def __init__(self, maxshare, capacity, rate, store=None, clock=time.monotonic):
+        self.log = LogWrapper('coreapis.RateLimiter')
+        if store is None:
+            store = LocalBucketStore()
+        if maxshare is not None and store.shared:
+            raise ValueError('maxshare can not be used with a shared bucket store')
+        self.nwatched = int(1./maxshare + 0.5) if maxshare is not None else 0
+        self.recents = deque([None] * self.nwatched)
+        self.counts = defaultdict(int)
+        self.capacity = capacity
+        self.rate = rate
+        self.store = store
+        self.clock = clock
+
+    def check_rate(self, remote_addr):
+        client = remote_addr
+        accepted = self.store.add(client, self.capacity, self.rate, self.clock())
+        debug = self.log.logger.isEnabledFor(logging.DEBUG)
+        if debug:
+            self.log.debug("check_rate", src_ip=client, accepted=accepted)
+        if accepted and self.nwatched:
+            oldclient = self.recents.popleft()
+            if oldclient:
+                self.counts[oldclient] -= 1
+                if self.counts[oldclient] <= 0:
+                    del self.counts[oldclient]
+                    if debug:
+                        self.log.debug("bucket deleted",
+                                       src_ip=oldclient,
+                                       contents=self.store.contents(oldclient))
+                    self.store.delete(oldclient)
+            self.recents.append(client)
+            self.counts[client] += 1
+        return accepted
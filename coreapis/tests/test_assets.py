@@ -0,0 +1,60 @@
+import io
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from PIL import Image
+
+from coreapis.assets import AssetRegistry, get_default_assets
+
+
+class TestAssetRegistry(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.assets = AssetRegistry(self.directory)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write_image(self, name, size, fmt):
+        path = os.path.join(self.directory, name)
+        Image.new('RGB', size, (10, 20, 30)).save(path, format=fmt)
+        return path
+
+    def test_get(self):
+        path = self.write_image('default-client.png', (64, 64), 'PNG')
+        asset = self.assets.get(path)
+        with open(path, 'rb') as fh:
+            assert asset.data == fh.read()
+        assert asset.content_type == 'image/png'
+        assert len(asset.etag) == 32
+        assert asset.last_modified.timestamp() == int(os.path.getmtime(path))
+        os.unlink(path)
+        assert self.assets.get(path) is asset
+
+    def test_scaled_down(self):
+        path = self.write_image('default-profile.jpg', (512, 256), 'JPEG')
+        asset = self.assets.get(path)
+        image = Image.open(io.BytesIO(asset.data))
+        assert image.size == (128, 64)
+        assert image.format == 'JPEG'
+        assert asset.content_type == 'image/jpeg'
+
+    def test_preload(self):
+        self.write_image('default-client.png', (64, 64), 'PNG')
+        self.write_image('other.png', (64, 64), 'PNG')
+        self.assets.preload()
+        assert list(self.assets.assets) == [os.path.join(self.directory, 'default-client.png')]
+
+    def test_shipped_defaults(self):
+        assets = AssetRegistry()
+        assets.preload()
+        assert len(assets.assets) == 4
+        assert assets.get('data/default-profile.jpg').content_type == 'image/jpeg'
+
+    def test_shared(self):
+        settings = {'warm_up_methods': {}}
+        assets = get_default_assets(settings)
+        assert get_default_assets(settings) is assets
+        assert settings['warm_up_methods']['default_assets'] == assets.preload
@@ -0,0 +1,239 @@
+import datetime
+import threading
+import time
+from unittest import TestCase, mock
+import uuid
+
+import eventlet
+import py.test
+
+from coreapis.cache import Cache, TokenCache
+from coreapis.utils import now
+
+
+def make_lookup(validuntil):
+    token = {
+        'access_token': uuid.uuid4(),
+        'validuntil': validuntil,
+    }
+    return token, {'id': uuid.uuid4()}, None
+
+
+class TestCache(TestCase):
+    def setUp(self):
+        self.timer = mock.Mock()
+        self.cache = Cache(10, 'test', maxsize=2, timer=self.timer, counter_prefix='test')
+
+    def counted(self, name):
+        return mock.call('test.{}'.format(name)) in self.timer.incr.mock_calls
+
+    def test_hit(self):
+        getter = mock.Mock(return_value='bar')
+        assert self.cache.get('foo', getter) == 'bar'
+        assert self.cache.get('foo', getter) == 'bar'
+        assert getter.call_count == 1
+        assert self.counted('miss')
+        assert self.counted('hit')
+        self.timer.gauge.assert_called_with('test.size', 1)
+
+    def test_expires(self):
+        getter = mock.Mock(return_value='bar')
+        self.cache.get('foo', getter)
+        with mock.patch('time.time', return_value=time.time() + 11):
+            self.cache.get('foo', getter)
+        assert getter.call_count == 2
+
+    def test_eviction(self):
+        getter = mock.Mock(return_value='bar')
+        for key in ('a', 'b', 'a', 'c'):
+            self.cache.get(key, getter)
+        assert list(self.cache.data.keys()) == ['a', 'c']
+        assert self.counted('eviction')
+
+    def test_entry_size(self):
+        cache = Cache(10, 'test', maxsize=10, timer=self.timer, counter_prefix='test')
+        cache.entry_size = len
+        for key in ('a', 'b', 'c'):
+            cache.get(key, lambda: 'xxxx')
+        assert list(cache.data.keys()) == ['b', 'c']
+        assert cache.used == 8
+        cache.get('d', lambda: 'x' * 11)
+        assert not cache.data
+        assert cache.used == 0
+
+    def test_peek(self):
+        assert self.cache.peek('foo') is None
+        self.cache.get('foo', lambda: 'bar')
+        assert self.cache.peek('foo') == 'bar'
+        with mock.patch('time.time', return_value=time.time() + 11):
+            assert self.cache.peek('foo') is None
+
+    def test_set(self):
+        getter = mock.Mock(return_value='bar')
+        self.cache.get('foo', getter)
+        self.cache.set('foo', 'baz')
+        assert self.cache.get('foo', getter) == 'baz'
+        assert getter.call_count == 1
+        assert self.cache.used == 1
+
+    def test_error_not_cached(self):
+        getter = mock.Mock(side_effect=RuntimeError('down'))
+        for _ in range(2):
+            with py.test.raises(RuntimeError):
+                self.cache.get('foo', getter)
+        assert getter.call_count == 2
+        assert not self.cache.inflight
+
+    def test_single_flight_threads(self):
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+
+        def getter():
+            calls.append(1)
+            started.set()
+            release.wait(5)
+            return 'bar'
+
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(self.cache.get('foo', getter)))
+                   for _ in range(5)]
+        threads[0].start()
+        started.wait(5)
+        for thread in threads[1:]:
+            thread.start()
+        time.sleep(0.05)
+        release.set()
+        for thread in threads:
+            thread.join(5)
+        assert results == ['bar'] * 5
+        assert len(calls) == 1
+
+    def test_single_flight_eventlets(self):
+        cache = Cache(10, 'test', use_eventlets=True)
+        calls = []
+
+        def getter():
+            calls.append(1)
+            eventlet.sleep(0.01)
+            return 'bar'
+
+        pool = eventlet.GreenPool()
+        results = list(pool.imap(lambda _: cache.get('foo', getter), range(5)))
+        assert results == ['bar'] * 5
+        assert len(calls) == 1
+
+    def test_single_flight_error(self):
+        cache = Cache(10, 'test', use_eventlets=True)
+        calls = []
+
+        def getter():
+            calls.append(1)
+            eventlet.sleep(0.01)
+            raise RuntimeError('down')
+
+        def get(_):
+            try:
+                return cache.get('foo', getter)
+            except RuntimeError as ex:
+                return str(ex)
+
+        pool = eventlet.GreenPool()
+        assert list(pool.imap(get, range(3))) == ['down'] * 3
+        assert len(calls) == 1
+
+    def test_stale_while_revalidate(self):
+        cache = Cache(10, 'test', stale=30, use_eventlets=True)
+        cache.get('foo', lambda: 'old')
+        with mock.patch('time.time', return_value=time.time() + 20):
+            assert cache.get('foo', lambda: 'new') == 'old'
+            eventlet.sleep(0)
+            assert cache.get('foo', lambda: 'newer') == 'new'
+
+    def test_stale_too_old(self):
+        cache = Cache(10, 'test', stale=30)
+        cache.get('foo', lambda: 'old')
+        with mock.patch('time.time', return_value=time.time() + 41):
+            assert cache.get('foo', lambda: 'new') == 'new'
+
+    def test_invalidate_during_fetch(self):
+        def getter():
+            self.cache.invalidate('foo')
+            return 'bar'
+        assert self.cache.get('foo', getter) == 'bar'
+        assert 'foo' not in self.cache.data
+
+    def test_invalidate_matching(self):
+        self.cache.get('foo', lambda: 1)
+        self.cache.get('bar', lambda: 2)
+        assert self.cache.invalidate_matching(lambda key, value: value == 2) == 1
+        assert self.cache.peek('foo') == 1
+        assert self.cache.peek('bar') is None
+        assert self.cache.used == 1
+
+
+class TestTokenCache(TestCase):
+    def setUp(self):
+        self.timer = mock.Mock()
+        self.cache = TokenCache(2, 60, 10, self.timer)
+        self.key = uuid.uuid4()
+        self.value = make_lookup(now() + datetime.timedelta(days=1))
+
+    def counted(self, name):
+        return mock.call('auth.token_cache.{}'.format(name)) in self.timer.incr.mock_calls
+
+    def test_hit(self):
+        getter = mock.Mock(return_value=self.value)
+        assert self.cache.get(self.key, getter) == self.value
+        assert self.cache.get(self.key, getter) == self.value
+        assert getter.call_count == 1
+        assert self.counted('miss')
+        assert self.counted('hit')
+
+    def test_negative(self):
+        getter = mock.Mock(side_effect=KeyError('Token is invalid'))
+        for _ in range(2):
+            with py.test.raises(KeyError) as ex:
+                self.cache.get(self.key, getter)
+            assert ex.value.args[0] == 'Token is invalid'
+        assert getter.call_count == 1
+
+    def test_negative_expires(self):
+        getter = mock.Mock(side_effect=KeyError('oauth_tokens entry not found'))
+        with py.test.raises(KeyError):
+            self.cache.get(self.key, getter)
+        with mock.patch('time.time', return_value=now().timestamp() + 11):
+            getter.side_effect = None
+            getter.return_value = self.value
+            assert self.cache.get(self.key, getter) == self.value
+
+    def test_ttl_capped_by_validuntil(self):
+        value = make_lookup(now() + datetime.timedelta(seconds=5))
+        getter = mock.Mock(return_value=value)
+        self.cache.get(self.key, getter)
+        with mock.patch('time.time', return_value=now().timestamp() + 6):
+            self.cache.get(self.key, getter)
+        assert getter.call_count == 2
+
+    def test_eviction(self):
+        getter = mock.Mock(return_value=self.value)
+        keys = [uuid.uuid4() for _ in range(3)]
+        for key in keys:
+            self.cache.get(key, getter)
+        assert keys[0] not in self.cache.data
+        assert len(self.cache.data) == 2
+        assert self.counted('eviction')
+
+    def test_invalidate(self):
+        getter = mock.Mock(return_value=self.value)
+        self.cache.get(self.key, getter)
+        self.cache.invalidate(self.key)
+        self.cache.get(self.key, getter)
+        assert getter.call_count == 2
+
+    def test_invalidate_during_fetch(self):
+        def getter():
+            self.cache.invalidate(self.key)
+            return self.value
+        self.cache.get(self.key, getter)
+        assert self.key not in self.cache.data
@@ -23,7 +23,8 @@ import os
 import datetime
 from collections import Mapping, Sequence
 from cassandra.cluster import NoHostAvailable
-from coreapis.cassandra_client import Client
+from coreapis.cassandra_client import (Client, NULL_USER, GROUP_MEMBERS_BY_USER_DDL,
+                                       LOOKUP_TABLES, lookup_table_ddl, set_rollout_stage)
 from coreapis.utils import now
 
 TABLES = [
@@ -34,6 +35,7 @@ TABLES = [
     'apigk',
     'groups',
     'group_members',
+    'group_members_by_user',
     'grep_codes',
     'organizations',
     'orgroles',
@@ -41,7 +43,7 @@ TABLES = [
     'remote_apigatekeepers',
     'logins_stats',
     'clients_counters',
-]
+] + sorted(LOOKUP_TABLES)
 
 db_node = os.environ.get('DP_CASSANDRA_TEST_NODE', 'cassandra-test-coreapis')
 db_keyspace = os.environ.get('DP_CASSANDRA_TEST_KEYSPACE', 'test_coreapis')
@@ -55,6 +57,11 @@ def setUpModule():
         cclient = Client([db_node], db_keyspace)
     except NoHostAvailable:
         raise unittest.SkipTest('No database available')
+    cclient.session.execute(GROUP_MEMBERS_BY_USER_DDL)
+    set_rollout_stage('group_members_by_user', 'read')
+    set_rollout_stage('lookup_tables', 'read')
+    for statement in lookup_table_ddl():
+        cclient.session.execute(statement)
     truncate_tables(cclient, TABLES)
     return cclient
 
@@ -320,6 +327,8 @@ class CassandraClientTests(unittest.TestCase):
             'validuntil',
             'lastuse',
         ]
+        if 'subtokens' in token:
+            self.cclient.default_columns['oauth_tokens'].append('subtokens')
         self.cclient.json_columns['oauth_tokens'] = []
         self.cclient.insert_generic(token, 'oauth_tokens')
 
@@ -516,6 +525,31 @@ class CassandraClientTests(unittest.TestCase):
         res = self.cclient.get_clients_by_scope_requested(scopes[0])
         assert id_and_owner_match(res[0], client)
 
+    def test_get_clients_by_owner_after_update(self):
+        client = self.insert_clients(1)[0]
+        oldowner = client['owner']
+        client['owner'] = uuid.uuid4()
+        self.cclient.insert_client(client)
+        assert self.cclient.get_clients_by_owner(oldowner) == []
+        res = self.cclient.get_clients_by_owner(client['owner'])
+        assert [c['id'] for c in res] == [client['id']]
+
+    def test_get_clients_selector_lookup(self):
+        clients = self.insert_clients(self.nrecs)
+        client = clients[self.nrecs - 2]
+        res = self.cclient.get_clients(['owner = ?', 'scopes contains ?'],
+                                       [client['owner'], client['scopes'][0]], self.maxrows)
+        assert [c['id'] for c in res] == [client['id']]
+        res = self.cclient.get_clients(['owner = ?', 'scopes contains ?'],
+                                       [client['owner'], 'nosuchscope'], self.maxrows)
+        assert res == []
+
+    def test_delete_client_lookups(self):
+        client = self.insert_clients(1)[0]
+        self.cclient.delete_client(client['id'])
+        prep = self.cclient.session.prepare('SELECT id FROM clients_by_owner WHERE owner = ?')
+        assert list(self.cclient.session.execute(prep.bind([client['owner']]))) == []
+
     def test_delete_client(self):
         clients = self.insert_clients(self.nrecs)
         client = clients[self.nrecs - 2]
@@ -555,6 +589,52 @@ class CassandraClientTests(unittest.TestCase):
         self._test_get_rec(self.insert_tokens, self.cclient.get_token, 'access_token',
                            tokens_match)
 
+    def test_get_token_context(self):
+        users = self.insert_users(self.nrecs)
+        clients = self.insert_clients(self.nrecs)
+        token = make_token()
+        token['userid'] = users[0]['userid']
+        token['clientid'] = clients[0]['id']
+        self.insert_token(token)
+        res_token, res_client, res_user = self.cclient.get_token_context(token['access_token'])
+        assert tokens_match(res_token, token)
+        assert id_and_owner_match(res_client, clients[0])
+        assert users_match(res_user, users[0])
+
+    def test_get_token_context_invalid(self):
+        tokens = self.insert_tokens(self.nrecs)
+        with self.assertRaises(KeyError):
+            self.cclient.get_token_context(tokens[0]['access_token'], lambda token: False)
+
+    def test_get_gk_token_context(self):
+        clients = self.insert_clients(self.nrecs)
+        subtoken = make_token()
+        subtoken['clientid'] = clients[0]['id']
+        subtoken['userid'] = NULL_USER
+        self.insert_token(subtoken)
+        token = make_token()
+        token['clientid'] = clients[0]['id']
+        token['userid'] = NULL_USER
+        token['subtokens'] = {'testgk': subtoken['access_token'],
+                              'missinggk': uuid.uuid4()}
+        self.insert_token(token)
+        res = self.cclient.get_gk_token_context(token['access_token'], 'testgk')
+        res_token, res_client, res_user, res_subtoken = res
+        assert tokens_match(res_token, token)
+        assert id_and_owner_match(res_client, clients[0])
+        assert res_user is None
+        assert tokens_match(res_subtoken, subtoken)
+        res = self.cclient.get_gk_token_context(token['access_token'], 'missinggk')
+        assert res[3] is None
+        res = self.cclient.get_gk_token_context(token['access_token'], 'othergk')
+        assert res[3] is None
+
+    def test_get_client_and_user_no_user(self):
+        clients = self.insert_clients(self.nrecs)
+        client, user = self.cclient.get_client_and_user(clients[0]['id'], NULL_USER)
+        assert id_and_owner_match(client, clients[0])
+        assert user is None
+
     def test_get_tokens_by_scope(self):
         tokens = self.insert_tokens(self.nrecs)
         token = tokens[self.nrecs - 2]
@@ -573,6 +653,15 @@ class CassandraClientTests(unittest.TestCase):
     def test_get_user_by_id(self):
         self._test_get_rec(self.insert_users, self.cclient.get_user_by_id, 'userid', users_match)
 
+    def test_get_public_users(self):
+        users = self.insert_users(self.nrecs)
+        userids = [user['userid'] for user in users[:3]]
+        res = self.cclient.get_public_users(userids)
+        assert set(res.keys()) == set(userids)
+        for user in users[:3]:
+            assert users_match(res[user['userid']], user)
+            assert 'email' not in res[user['userid']]
+
     def test_get_user_profilephoto(self):
         users = self.insert_users(self.nrecs)
         user = users[self.nrecs - 2]
@@ -626,6 +715,14 @@ class CassandraClientTests(unittest.TestCase):
         self._test_delete_rec(self.insert_apigks, self.cclient.delete_apigk,
                               self.cclient.get_apigk, 'id')
 
+    def test_get_apigks_by_owner(self):
+        apigks = self.insert_apigks(self.nrecs)
+        apigk = apigks[self.nrecs - 2]
+        res = self.cclient.get_apigks(['owner = ?'], [apigk['owner']], self.maxrows)
+        assert [gk['id'] for gk in res] == [apigk['id']]
+        self.cclient.delete_apigk(apigk['id'])
+        assert self.cclient.get_apigks(['owner = ?'], [apigk['owner']], self.maxrows) == []
+
     def _test_get_logo(self, table, seeder, getter):
         recs = seeder(self.nrecs)
         rec = recs[self.nrecs - 2]
@@ -719,6 +816,18 @@ class CassandraClientTests(unittest.TestCase):
         res = self.cclient.get_group_memberships(userid, mtype, status, self.maxrows)
         assert group_members_match(res[0], member)
 
+    def test_get_group_memberships_after_update(self):
+        member = self.setup_group_member()
+        groupid = member['groupid']
+        userid = member['userid']
+        self.cclient.set_group_member_status(groupid, userid, 'normal')
+        self.cclient.set_group_member_type(groupid, userid, 'admin')
+        res = list(self.cclient.get_group_memberships(userid, 'admin', 'normal', self.maxrows))
+        assert len(res) == 1
+        assert res[0]['groupid'] == groupid
+        self.cclient.del_group_member(groupid, userid)
+        assert list(self.cclient.get_group_memberships(userid, None, None, self.maxrows)) == []
+
     def test_get_grep_code(self):
         self._test_get_rec(self.insert_grep_codes, self.cclient.get_grep_code, 'id',
                            grep_codes_match)
@@ -731,6 +840,12 @@ class CassandraClientTests(unittest.TestCase):
         res = self.cclient.get_grep_code_by_code(code, greptype)
         assert grep_codes_match(res, rec)
 
+    def test_list_grep_codes(self):
+        recs = self.insert_grep_codes(self.nrecs)
+        res = {grep['id']: grep for grep in self.cclient.list_grep_codes()}
+        for rec in recs:
+            assert grep_codes_match(res[rec['id']], rec)
+
     def test_get_grep_code_by_code_no_match(self):
         recs = self.insert_grep_codes(self.nrecs)
         rec = recs[self.nrecs - 2]
@@ -769,20 +884,6 @@ class CassandraClientTests(unittest.TestCase):
         logo, _ = self.cclient.get_org_logo(orgid)
         assert data == logo
 
-    def test_org_use_fs_groups(self):
-        orgs = [make_org() for i in range(self.nrecs)]
-        savedorg = orgs[self.nrecs - 2]
-        savedorg['services'].add('fsgroups')
-        for org in orgs:
-            self.cclient.insert_org(org)
-        res = self.cclient.org_use_fs_groups(savedorg['realm'])
-        assert res
-        savedorg = orgs[0]
-        res = self.cclient.org_use_fs_groups(savedorg['realm'])
-        assert not res
-        res = self.cclient.org_use_fs_groups(random_string(16))
-        assert not res
-
     def test_is_org_admin(self):
         roles = [make_role() for i in range(self.nrecs)]
         savedrole = roles[self.nrecs - 2]
@@ -0,0 +1,121 @@
+from unittest import TestCase, mock
+
+import cassandra
+
+from coreapis import cassandra_client
+
+
+@mock.patch('coreapis.cassandra_client.Cluster')
+class TestSharedSessions(TestCase):
+    def setUp(self):
+        cassandra_client.shutdown_shared_sessions()
+
+    def tearDown(self):
+        cassandra_client.shutdown_shared_sessions()
+
+    def test_clients_share_session(self, cluster):
+        client1 = cassandra_client.Client(['localhost'], 'ks')
+        client2 = cassandra_client.Client(['localhost'], 'ks')
+        assert client1.session is client2.session
+        assert client1.prepared is client2.prepared
+        assert cluster.call_count == 1
+        assert cluster.return_value.connect.call_count == 1
+
+    def test_prepared_statements_shared(self, cluster):
+        client1 = cassandra_client.Client(['localhost'], 'ks')
+        client2 = cassandra_client.Client(['localhost'], 'ks')
+        client1._prepare('SELECT 1')
+        client2._prepare('SELECT 1')
+        assert cluster.return_value.connect.return_value.prepare.call_count == 1
+
+    def test_keyspaces_share_cluster(self, cluster):
+        client1 = cassandra_client.Client(['localhost'], 'ks')
+        client2 = cassandra_client.Client(['localhost'], 'cache')
+        assert cluster.call_count == 1
+        cluster.return_value.connect.assert_has_calls([mock.call('ks'), mock.call('cache')])
+        assert client1.prepared is not client2.prepared
+
+    def test_separate_clusters(self, cluster):
+        cassandra_client.Client(['localhost'], 'ks')
+        cassandra_client.Client(['otherhost'], 'ks')
+        cassandra_client.Client(['localhost'], 'ks', authz={'cassandra_username': 'u',
+                                                            'cassandra_password': 'p',
+                                                            'cassandra_cacerts': None})
+        assert cluster.call_count == 3
+
+    def test_warm_up(self, cluster):
+        session = cluster.return_value.connect.return_value
+        client = cassandra_client.Client(['localhost'], 'ks')
+        count = cassandra_client.warm_up_shared_sessions()
+        assert count == len(client.statement_catalogue())
+        assert session.prepare.call_count == count
+        session.execute.return_value = [{'id': 'foo'}]
+        client.get_client_by_id('foo')
+        assert session.prepare.call_count == count
+        assert cassandra_client.warm_up_shared_sessions() == 0
+
+    def test_warm_up_prepare_fails(self, cluster):
+        session = cluster.return_value.connect.return_value
+        session.prepare.side_effect = cassandra.InvalidRequest('unconfigured table')
+        client = cassandra_client.Client(['localhost'], 'ks')
+        assert client.warm_up() == 0
+        assert client.prepared == {}
+
+
+@mock.patch('coreapis.cassandra_client.Cluster')
+class TestRollout(TestCase):
+    def setUp(self):
+        cassandra_client.shutdown_shared_sessions()
+
+    def tearDown(self):
+        cassandra_client.set_rollout_stage('group_members_by_user', 'off')
+        cassandra_client.set_rollout_stage('lookup_tables', 'off')
+        cassandra_client.shutdown_shared_sessions()
+
+    def test_off(self, cluster):
+        client = cassandra_client.Client(['localhost'], 'ks')
+        client.del_group_member('g', 'u')
+        client.get_group_memberships('u', None, None, 100)
+        session = cluster.return_value.connect.return_value
+        queries = [args[0] for args, _ in session.prepare.call_args_list]
+        assert not any('group_members_by_user' in query for query in queries)
+
+    def test_write(self, cluster):
+        cassandra_client.set_rollout_stage('group_members_by_user', 'write')
+        client = cassandra_client.Client(['localhost'], 'ks')
+        client.del_group_member('g', 'u')
+        session = cluster.return_value.connect.return_value
+        queries = [args[0] for args, _ in session.prepare.call_args_list]
+        assert 'DELETE FROM group_members_by_user WHERE groupid = ? AND userid = ?' in queries
+        assert 'DELETE FROM group_members WHERE groupid = ? AND userid = ?' in queries
+        client.get_group_memberships('u', None, None, 100)
+        assert 'from group_members WHERE' in session.prepare.call_args[0][0]
+
+    def test_read(self, cluster):
+        cassandra_client.set_rollout_stage('group_members_by_user', 'read')
+        client = cassandra_client.Client(['localhost'], 'ks')
+        client.get_group_memberships('u', None, None, 100)
+        session = cluster.return_value.connect.return_value
+        assert 'from group_members_by_user WHERE' in session.prepare.call_args[0][0]
+
+    def test_unknown_stage(self, cluster):
+        with self.assertRaises(ValueError):
+            cassandra_client.set_rollout_stage('group_members_by_user', 'on')
+
+    def test_lookup_tables_off(self, cluster):
+        client = cassandra_client.Client(['localhost'], 'ks')
+        session = cluster.return_value.connect.return_value
+        client.delete_apigk('gk')
+        session.execute.assert_called_once_with(session.prepare.return_value.bind.return_value)
+        client.get_clients_by_owner('owner')
+        assert session.prepare.call_args[0][0] == 'SELECT * from clients WHERE owner = ?'
+        assert not any('_by_' in query for query in client.statement_catalogue())
+
+    def test_lookup_tables_read(self, cluster):
+        cassandra_client.set_rollout_stage('lookup_tables', 'read')
+        client = cassandra_client.Client(['localhost'], 'ks')
+        session = cluster.return_value.connect.return_value
+        session.execute.return_value = []
+        client.get_clients_by_owner('owner')
+        queries = [args[0] for args, _ in session.prepare.call_args_list]
+        assert 'SELECT id FROM clients_by_owner WHERE owner = ?' in queries
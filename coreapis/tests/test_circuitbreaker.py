@@ -0,0 +1,98 @@
+import unittest
+
+from coreapis.circuitbreaker import CircuitBreaker, breaker_factory, CLOSED, OPEN, HALF_OPEN
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.ts = 1000.
+
+    def __call__(self):
+        return self.ts
+
+    def advance(self, seconds):
+        self.ts += seconds
+
+
+class CircuitBreakerTests(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.breaker = CircuitBreaker('test', 3., min_timeout=0.1, slow_call=1., min_calls=4,
+                                      window=10, open_time=5., clock=self.clock)
+
+    def record(self, success, duration=0.01, count=1):
+        for _ in range(count):
+            assert self.breaker.allow()
+            self.breaker.record(success, duration)
+
+    def test_opens_on_failures(self):
+        self.record(True, count=2)
+        self.record(False, count=1)
+        assert self.breaker.state == CLOSED
+        self.record(False, count=1)
+        assert self.breaker.state == OPEN
+        assert not self.breaker.allow()
+
+    def test_slow_calls_are_failures(self):
+        self.record(True, duration=2., count=4)
+        assert self.breaker.state == OPEN
+
+    def test_not_opened_before_min_calls(self):
+        self.record(False, count=3)
+        assert self.breaker.state == CLOSED
+
+    def test_half_open_probe_closes(self):
+        self.record(False, count=4)
+        self.clock.advance(5.)
+        assert self.breaker.allow()
+        assert self.breaker.state == HALF_OPEN
+        assert not self.breaker.allow()
+        self.breaker.record(True, 0.01)
+        assert self.breaker.state == CLOSED
+        assert self.breaker.allow()
+
+    def test_half_open_probe_reopens(self):
+        self.record(False, count=4)
+        self.clock.advance(5.)
+        assert self.breaker.allow()
+        self.breaker.record(False, 0.01)
+        assert self.breaker.state == OPEN
+        self.clock.advance(4.)
+        assert not self.breaker.allow()
+
+    def test_cancelled_probe(self):
+        self.record(False, count=4)
+        self.clock.advance(5.)
+        assert self.breaker.allow()
+        self.breaker.cancel()
+        assert self.breaker.state == HALF_OPEN
+        assert self.breaker.allow()
+
+    def test_cancel_not_recorded(self):
+        assert self.breaker.allow()
+        self.breaker.cancel()
+        assert len(self.breaker.calls) == 0
+
+    def test_timeout_follows_p99(self):
+        assert self.breaker.timeout() == 3.
+        self.record(True, duration=0.2, count=4)
+        assert self.breaker.timeout() == 0.4
+        self.record(True, duration=0.01, count=6)
+        assert self.breaker.timeout() == 0.4
+        self.record(True, duration=0.01, count=10)
+        assert self.breaker.timeout() == 0.1
+
+    def test_timeout_is_max_when_probing(self):
+        self.record(False, duration=0.01, count=4)
+        self.clock.advance(5.)
+        assert self.breaker.allow()
+        assert self.breaker.timeout() == 3.
+
+    def test_breaker_factory(self):
+        make_breaker = breaker_factory({'circuit_breaker_min_calls': '5',
+                                        'circuit_breaker_slow_call': '500'}, 2.)
+        breaker = make_breaker('test')
+        assert breaker.name == 'test'
+        assert breaker.min_calls == 5
+        assert breaker.slow_call == 0.5
+        assert breaker.max_timeout == 2.
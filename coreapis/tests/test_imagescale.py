@@ -0,0 +1,84 @@
+import io
+import multiprocessing
+from unittest import TestCase, mock
+
+from PIL import Image
+import py.test
+
+from coreapis.imagescale import ImageScaler, get_image_scaler, scale_image
+
+
+def make_image(size, fmt):
+    output = io.BytesIO()
+    Image.new('RGB', size, (200, 100, 50)).save(output, format=fmt)
+    return output.getvalue()
+
+
+class TestScaleImage(TestCase):
+    def test_jpeg(self):
+        data = scale_image(make_image((1024, 512), 'JPEG'), (128, 128), 'JPEG')
+        image = Image.open(io.BytesIO(data))
+        assert image.format == 'JPEG'
+        assert image.size == (128, 64)
+
+    def test_png_to_png(self):
+        data = scale_image(make_image((300, 600), 'PNG'), (128, 128), 'PNG')
+        image = Image.open(io.BytesIO(data))
+        assert image.format == 'PNG'
+        assert image.size == (64, 128)
+
+    def test_small_image_not_enlarged(self):
+        data = scale_image(make_image((32, 32), 'PNG'), (128, 128), 'PNG')
+        assert Image.open(io.BytesIO(data)).size == (32, 32)
+
+    def test_bad_image(self):
+        with py.test.raises(OSError):
+            scale_image(b'not an image', (128, 128), 'PNG')
+
+
+class TestImageScaler(TestCase):
+    def test_pool(self):
+        timer = mock.Mock()
+        scaler = ImageScaler(1, 4, timer)
+        data = scaler.scale(make_image((256, 256), 'JPEG'), (128, 128), 'PNG')
+        assert Image.open(io.BytesIO(data)).size == (128, 128)
+        assert scaler.pending == 0
+        timer.gauge.assert_called_with('imagescale.pending', 0)
+        with py.test.raises(OSError):
+            scaler.scale(b'not an image', (128, 128), 'PNG')
+        assert scaler.pending == 0
+
+    def test_timeout_replaces_pool(self):
+        timer = mock.Mock()
+        scaler = ImageScaler(1, 4, timer, timeout=0.5)
+        hung = mock.Mock()
+        hung.apply_async.return_value.get.side_effect = multiprocessing.TimeoutError
+        scaler.pool = hung
+        data = scaler.scale(make_image((256, 256), 'JPEG'), (128, 128), 'PNG')
+        assert Image.open(io.BytesIO(data)).size == (128, 128)
+        hung.apply_async.return_value.get.assert_called_once_with(0.5)
+        hung.terminate.assert_called_once_with()
+        assert scaler.pool is None
+        assert scaler.pending == 0
+        timer.incr.assert_called_once_with('imagescale.timeout')
+
+    def test_inline(self):
+        scaler = ImageScaler(0, 0)
+        data = scaler.scale(make_image((256, 256), 'JPEG'), (128, 128), 'PNG')
+        assert Image.open(io.BytesIO(data)).size == (128, 128)
+        assert scaler.pool is None
+
+    def test_overflow_scales_inline(self):
+        timer = mock.Mock()
+        scaler = ImageScaler(1, 1, timer)
+        scaler.pending = 1
+        scaler.scale(make_image((256, 256), 'JPEG'), (128, 128), 'PNG')
+        assert scaler.pool is None
+        timer.incr.assert_called_once_with('imagescale.overflow')
+
+    def test_shared(self):
+        settings = {'image_scale_processes': '0'}
+        scaler = get_image_scaler(settings)
+        assert get_image_scaler(settings) is scaler
+        assert scaler.processes == 0
+        assert scaler.timeout == 10.
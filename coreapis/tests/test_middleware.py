@@ -1,13 +1,17 @@
+import datetime
 import unittest
+import uuid
 
 from unittest import mock
 import webtest
 
-from coreapis import middleware
+from coreapis import middleware, cassandra_client
+from coreapis.utils import now
 
 
 userid1 = '00000000-0000-0000-0000-000000000001'
 clientid1 = '00000000-0000-0000-0000-000000000004'
+token1 = '00000000-0000-0000-0000-000000000005'
 
 
 class GatekeepedMiddlewareTests(unittest.TestCase):
@@ -27,8 +31,7 @@ class GatekeepedMiddlewareTests(unittest.TestCase):
         assert self.mw.get_authorization({'HTTP_AUTHORIZATION': 'Basic foo'}) == 'foo'
 
     def testOKAll(self):
-        self.session.get_user_by_id.return_value = 'testuserobject'
-        self.session.get_client_by_id.return_value = 'testclientobject'
+        self.session.get_client_and_user.return_value = ('testclientobject', 'testuserobject')
         self.testapp.authorization = ('Basic', ('testuser', 'testpass'))
 
         def app(environ, start_response):
@@ -51,8 +54,7 @@ class GatekeepedMiddlewareTests(unittest.TestCase):
         assert self.app.called
 
     def testOKSubscopes(self):
-        self.session.get_user_by_id.return_value = 'testuserobject'
-        self.session.get_client_by_id.return_value = 'testclientobject'
+        self.session.get_client_and_user.return_value = ('testclientobject', None)
         self.testapp.authorization = ('Basic', ('testuser', 'testpass'))
 
         def app(environ, start_response):
@@ -72,10 +74,10 @@ class GatekeepedMiddlewareTests(unittest.TestCase):
         }
         self.testapp.get('/', status=200, headers=headers)
         assert self.app.called
+        self.session.get_client_and_user.assert_called_with(uuid.UUID(clientid1), None)
 
     def testOKUser(self):
-        self.session.get_user_by_id.return_value = 'testuserobject'
-        self.session.get_client_by_id.return_value = 'testclientobject'
+        self.session.get_client_and_user.return_value = ('testclientobject', 'testuserobject')
         self.testapp.authorization = ('Basic', ('testuser', 'testpass'))
 
         def app(environ, start_response):
@@ -113,3 +115,122 @@ class GatekeepedMiddlewareTests(unittest.TestCase):
         self.testapp.authorization = ('Basic', ('wronguser', 'wrongpass'))
         self.testapp.get('/', status=401)
         assert not self.app.called
+
+
+class CassandraMiddlewareTests(unittest.TestCase):
+    @mock.patch('coreapis.middleware.cassandra_client.Client')
+    def setUp(self, Client):
+        self.app = mock.Mock()
+        self.timer = mock.MagicMock()
+        self.mw = middleware.CassandraMiddleware(self.app, 'testrealm', 'contact_points',
+                                                 'keyspace', self.timer, False, None,
+                                                 100, 60, 10)
+        self.session = Client()
+        self.token = {
+            'access_token': uuid.UUID(token1),
+            'clientid': uuid.UUID(clientid1),
+            'userid': uuid.UUID(userid1),
+            'scope': ['test'],
+            'validuntil': now() + datetime.timedelta(days=1),
+        }
+        self.session.get_token_context.return_value = (self.token, 'testclientobject',
+                                                       'testuserobject')
+
+    def test_lookup_cached(self):
+        for _ in range(2):
+            res = self.mw.lookup_token(token1)
+            assert res['FC_CLIENT'] == 'testclientobject'
+            assert res['FC_USER'] == 'testuserobject'
+        assert self.session.get_token_context.call_count == 1
+
+    def test_unknown_token_cached(self):
+        self.session.get_token_context.side_effect = KeyError('oauth_tokens entry not found')
+        for _ in range(2):
+            with self.assertRaises(KeyError):
+                self.mw.lookup_token(token1)
+        assert self.session.get_token_context.call_count == 1
+
+    def test_delete_token_invalidates(self):
+        self.mw.lookup_token(token1)
+        cassandra_client.notify_change('oauth_tokens', uuid.UUID(token1))
+        self.mw.lookup_token(token1)
+        assert self.session.get_token_context.call_count == 2
+
+    def test_cache_disabled(self):
+        self.mw.token_cache = None
+        self.mw.lookup_token(token1)
+        self.mw.lookup_token(token1)
+        assert self.session.get_token_context.call_count == 2
+
+
+class GKMiddlewareTests(unittest.TestCase):
+    @mock.patch('coreapis.middleware.cassandra_client.Client')
+    def setUp(self, Client):
+        self.app = mock.Mock()
+        self.timer = mock.MagicMock()
+        self.mw = middleware.GKMiddleware(self.app, 'testrealm', 'contact_points',
+                                          'keyspace', self.timer, False, None,
+                                          100, 60, 10)
+        self.session = Client()
+        self.subtokenid = uuid.uuid4()
+        self.token = {
+            'access_token': uuid.UUID(token1),
+            'clientid': uuid.UUID(clientid1),
+            'userid': uuid.UUID(userid1),
+            'scope': ['gk_testgk'],
+            'subtokens': {'testgk': self.subtokenid},
+            'validuntil': now() + datetime.timedelta(days=1),
+        }
+        self.subtoken = {'access_token': self.subtokenid, 'scope': ['userid'],
+                         'validuntil': now() + datetime.timedelta(days=1)}
+        self.session.get_gk_token_context.return_value = (self.token, 'testclientobject',
+                                                          'testuserobject', self.subtoken)
+        self.environ = {'PATH_INFO': '/gk/info/testgk'}
+
+    def test_get_gk_backend(self):
+        assert middleware.get_gk_backend({'PATH_INFO': '/gk/info/testgk'}) == 'testgk'
+        assert middleware.get_gk_backend({'PATH_INFO': '/info/testgk'}) == 'testgk'
+        assert middleware.get_gk_backend({'PATH_INFO': '/gk/info/'}) is None
+        assert middleware.get_gk_backend({}) is None
+
+    def test_subtoken_prefetched(self):
+        res = self.mw.lookup_request_token(token1, self.environ)
+        assert res['FC_SUBTOKEN'] == self.subtoken
+        assert res['FC_CLIENT'] == 'testclientobject'
+        self.session.get_gk_token_context.assert_called_once_with(
+            uuid.UUID(token1), 'testgk', mock.ANY)
+        assert not self.session.get_token.called
+
+    def test_subtoken_cached(self):
+        self.mw.lookup_request_token(token1, self.environ)
+        res = self.mw.lookup_request_token(token1, self.environ)
+        assert res['FC_SUBTOKEN'] == self.subtoken
+        assert self.session.get_gk_token_context.call_count == 1
+        assert not self.session.get_token.called
+
+    def test_subtoken_not_cached_past_validuntil(self):
+        self.subtoken['validuntil'] = now() - datetime.timedelta(seconds=1)
+        self.mw.lookup_request_token(token1, self.environ)
+        self.session.get_token.return_value = self.subtoken
+        self.mw.lookup_request_token(token1, self.environ)
+        self.session.get_token.assert_called_once_with(self.subtokenid)
+
+    def test_subtoken_invalidated(self):
+        self.mw.lookup_request_token(token1, self.environ)
+        cassandra_client.notify_change('oauth_tokens', self.subtokenid)
+        self.session.get_token.return_value = self.subtoken
+        res = self.mw.lookup_request_token(token1, self.environ)
+        assert res['FC_SUBTOKEN'] == self.subtoken
+        self.session.get_token.assert_called_once_with(self.subtokenid)
+
+    def test_subtoken_missing(self):
+        self.session.get_gk_token_context.return_value = (self.token, 'testclientobject',
+                                                          'testuserobject', None)
+        res = self.mw.lookup_request_token(token1, self.environ)
+        assert 'FC_SUBTOKEN' not in res
+        assert res['FC_SUBTOKENS'] == {'testgk': self.subtokenid}
+
+    def test_no_subtokens(self):
+        self.token['subtokens'] = None
+        with self.assertRaises(KeyError):
+            self.mw.lookup_request_token(token1, self.environ)
@@ -0,0 +1,101 @@
+import unittest
+from unittest import mock
+from pytest import raises
+from coreapis.cassandra_client import CHANGE_LISTENERS, notify_change
+from coreapis.orgsnapshot import OrgSnapshot, get_org_snapshot
+from coreapis.utils import translatable
+
+ORGS = [
+    {'id': 'fc:org:uninett.no', 'realm': 'uninett.no', 'type': {'service_provider'},
+     'services': {'auth', 'pilot'}},
+    {'id': 'fc:org:ntnu.no', 'realm': 'ntnu.no', 'type': {'higher_education'},
+     'services': {'auth', 'fsgroups'}},
+    {'id': 'fc:org:example.org', 'realm': None, 'type': None, 'services': None},
+]
+
+
+class TestOrgSnapshot(unittest.TestCase):
+    def setUp(self):
+        self.session = mock.MagicMock()
+        self.session.list_orgs.side_effect = lambda: iter([dict(org) for org in ORGS])
+        self.timer = mock.MagicMock()
+        self.orgs = OrgSnapshot(self.session, 3600, self.timer)
+
+    def test_lookups(self):
+        assert self.orgs.get_org('fc:org:ntnu.no') == ORGS[1]
+        assert self.orgs.get_org_by_realm('uninett.no') == ORGS[0]
+        assert [org['id'] for org in self.orgs.orgs_with_service('auth')] == \
+            ['fc:org:uninett.no', 'fc:org:ntnu.no']
+        assert self.orgs.orgs_of_type('higher_education') == [ORGS[1]]
+        assert self.orgs.orgs_of_type('upper_secondary') == []
+        assert len(self.orgs.list_orgs()) == 3
+        assert self.orgs.realm_has_service('ntnu.no', 'fsgroups')
+        assert not self.orgs.realm_has_service('uninett.no', 'fsgroups')
+        assert not self.orgs.realm_has_service('nosuch.org', 'fsgroups')
+        self.session.list_orgs.assert_called_once_with()
+        self.session.get_org.assert_not_called()
+
+    def test_name_translatable(self):
+        self.session.list_orgs.side_effect = lambda: iter([dict(ORGS[0], name={'nb': 'Uninett'})])
+        org = self.orgs.get_org_by_realm('uninett.no')
+        assert isinstance(org['name'], translatable)
+        assert org['name'] == {'nb': 'Uninett'}
+
+    def test_missing(self):
+        with raises(KeyError):
+            self.orgs.get_org('fc:org:nosuch.org')
+        with raises(KeyError):
+            self.orgs.get_org_by_realm('nosuch.org')
+
+    def test_returns_copies(self):
+        self.orgs.get_org('fc:org:ntnu.no')['realm'] = 'changed'
+        assert self.orgs.get_org('fc:org:ntnu.no')['realm'] == 'ntnu.no'
+
+    def test_change_detection(self):
+        first = self.orgs._snapshot()  # pylint: disable=protected-access
+        self.orgs.cache.clear()
+        assert self.orgs._snapshot() is first  # pylint: disable=protected-access
+        assert mock.call('org_snapshot.changed') not in self.timer.incr.call_args_list
+        ORGS.append({'id': 'fc:org:new.org', 'realm': 'new.org', 'type': None, 'services': None})
+        try:
+            self.orgs.cache.clear()
+            assert self.orgs.get_org_by_realm('new.org')['id'] == 'fc:org:new.org'
+        finally:
+            ORGS.pop()
+        assert self.timer.incr.call_args_list.count(mock.call('org_snapshot.changed')) == 1
+
+    def test_invalidate_reloads(self):
+        self.orgs.preload()
+        self.orgs.invalidate('fc:org:ntnu.no')
+        self.orgs.preload()
+        assert self.session.list_orgs.call_count == 2
+
+    def test_load_failure_falls_back_to_database(self):
+        self.session.list_orgs.side_effect = RuntimeError('no database')
+        self.session.get_org_by_realm.return_value = ORGS[1]
+        assert self.orgs.get_org_by_realm('ntnu.no') == ORGS[1]
+        self.session.get_org_by_realm.assert_called_once_with('ntnu.no')
+
+
+class TestGetOrgSnapshot(unittest.TestCase):
+    def test_shared(self):
+        settings = {'warm_up_methods': {}}
+        session = mock.MagicMock()
+        orgs = get_org_snapshot(settings, session)
+        assert get_org_snapshot(settings, mock.MagicMock()) is orgs
+        assert settings['warm_up_methods']['org_snapshot'] == orgs.preload
+
+    def test_local_change_reloads(self):
+        session = mock.MagicMock()
+        session.list_orgs.side_effect = lambda: iter([dict(org) for org in ORGS])
+        orgs = get_org_snapshot({}, session)
+        orgs.preload()
+        notify_change('organizations', 'fc:org:ntnu.no')
+        orgs.preload()
+        assert session.list_orgs.call_count == 2
+
+    def test_listener_not_added_per_instance(self):
+        listeners = len(CHANGE_LISTENERS['organizations'])
+        for _ in range(3):
+            OrgSnapshot(mock.MagicMock(), 3600)
+        assert len(CHANGE_LISTENERS['organizations']) == listeners
@@ -1,67 +1,110 @@
+import os
+import tempfile
 import unittest
-from unittest import mock
-import datetime
 from pyramid import testing
 
+from coreapis.ratelimit import RateLimiter, SharedMemoryBucketStore
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.ts = 1000.
+
+    def __call__(self):
+        return self.ts
+
+    def advance(self, seconds):
+        self.ts += seconds
+
 
 class RateLimitTests(unittest.TestCase):
+    client_max_share = 0.1
+
     def setUp(self):
-        from coreapis.utils import RateLimiter
-        client_max_share = 0.1
         self.bucket_capacity = 3
         self.bucket_leak_rate = 10
-        self.ratelimiter = RateLimiter(client_max_share,
-                                       self.bucket_capacity, self.bucket_leak_rate)
+        self.clock = FakeClock()
+        self.ratelimiter = RateLimiter(self.client_max_share,
+                                       self.bucket_capacity, self.bucket_leak_rate,
+                                       self.make_store(), self.clock)
         self.remote_addr = "127.0.0.1"
-        self.nwatched = int(1./client_max_share + 0.5)
+        self.nwatched = 10
+
+    def make_store(self):
+        return None
 
     def tearDown(self):
         testing.tearDown()
 
     def test_unspaced_calls(self):
-        faketime = datetime.datetime.now()
-        with mock.patch('coreapis.utils.now', return_value=faketime):
-            for _ in range(self.bucket_capacity):
-                res = self.ratelimiter.check_rate(self.remote_addr)
-                assert res is True
+        for _ in range(self.bucket_capacity):
             res = self.ratelimiter.check_rate(self.remote_addr)
-            assert res is False
+            assert res is True
+        res = self.ratelimiter.check_rate(self.remote_addr)
+        assert res is False
 
     def test_spaced_calls(self):
-        faketime = datetime.datetime.now()
-        with mock.patch('coreapis.utils.now', return_value=faketime):
-            for _ in range(self.bucket_capacity):
-                res = self.ratelimiter.check_rate(self.remote_addr)
-                assert res is True
-            res = self.ratelimiter.check_rate(self.remote_addr)
-            assert res is False
-        faketime += datetime.timedelta(milliseconds=1)
-        with mock.patch('coreapis.utils.now', return_value=faketime):
-            res = self.ratelimiter.check_rate(self.remote_addr)
-            assert res is True
-            res = self.ratelimiter.check_rate(self.remote_addr)
-            assert res is False
-        faketime += datetime.timedelta(milliseconds=1000./self.bucket_leak_rate + 1)
-        with mock.patch('coreapis.utils.now', return_value=faketime):
+        for _ in range(self.bucket_capacity):
             res = self.ratelimiter.check_rate(self.remote_addr)
             assert res is True
+        res = self.ratelimiter.check_rate(self.remote_addr)
+        assert res is False
+        self.clock.advance(0.001)
+        res = self.ratelimiter.check_rate(self.remote_addr)
+        assert res is True
+        res = self.ratelimiter.check_rate(self.remote_addr)
+        assert res is False
+        self.clock.advance(1./self.bucket_leak_rate + 0.001)
+        res = self.ratelimiter.check_rate(self.remote_addr)
+        assert res is True
 
     def test_few_clients(self):
-        faketime = datetime.datetime.now()
-        with mock.patch('coreapis.utils.now', return_value=faketime):
-            for _ in range(self.bucket_capacity + 1):
-                self.ratelimiter.check_rate(self.remote_addr)
-            for i in range(self.nwatched - 1):
-                self.ratelimiter.check_rate(str(i))
-            res = self.ratelimiter.check_rate(self.remote_addr)
-            assert res is False
+        for _ in range(self.bucket_capacity + 1):
+            self.ratelimiter.check_rate(self.remote_addr)
+        for i in range(self.nwatched - 1):
+            self.ratelimiter.check_rate(str(i))
+        res = self.ratelimiter.check_rate(self.remote_addr)
+        assert res is False
 
     def test_many_clients(self):
-        faketime = datetime.datetime.now()
-        with mock.patch('coreapis.utils.now', return_value=faketime):
-            for _ in range(self.bucket_capacity + 1):
-                self.ratelimiter.check_rate(self.remote_addr)
-            for i in range(self.nwatched + 1):
-                self.ratelimiter.check_rate(str(i))
-            res = self.ratelimiter.check_rate(self.remote_addr)
-            assert res is True
+        for _ in range(self.bucket_capacity + 1):
+            self.ratelimiter.check_rate(self.remote_addr)
+        for i in range(self.nwatched + 1):
+            self.ratelimiter.check_rate(str(i))
+        res = self.ratelimiter.check_rate(self.remote_addr)
+        assert res is True
+
+
+class SharedMemoryRateLimitTests(RateLimitTests):
+    client_max_share = None
+
+    def make_store(self):
+        fd, self.path = tempfile.mkstemp()
+        os.close(fd)
+        return SharedMemoryBucketStore(self.path, 128)
+
+    def tearDown(self):
+        os.unlink(self.path)
+        super(SharedMemoryRateLimitTests, self).tearDown()
+
+    def test_shared_between_stores(self):
+        other = RateLimiter(None, self.bucket_capacity, self.bucket_leak_rate,
+                            SharedMemoryBucketStore(self.path, 128), self.clock)
+        for _ in range(self.bucket_capacity):
+            assert other.check_rate(self.remote_addr) is True
+        assert self.ratelimiter.check_rate(self.remote_addr) is False
+
+    def test_many_clients(self):
+        # Shared buckets are left to leak rather than deleted
+        for _ in range(self.bucket_capacity + 1):
+            self.ratelimiter.check_rate(self.remote_addr)
+        for i in range(self.nwatched + 1):
+            self.ratelimiter.check_rate(str(i))
+        assert self.ratelimiter.check_rate(self.remote_addr) is False
+        self.clock.advance(1./self.bucket_leak_rate + 0.001)
+        assert self.ratelimiter.check_rate(self.remote_addr) is True
+
+    def test_max_share_rejected(self):
+        with self.assertRaises(ValueError):
+            RateLimiter(0.1, self.bucket_capacity, self.bucket_leak_rate,
+                        SharedMemoryBucketStore(self.path, 128), self.clock)
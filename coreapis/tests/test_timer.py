@@ -0,0 +1,56 @@
+import socket
+from unittest import TestCase
+
+from coreapis.utils import Timer, ResourcePool
+
+
+class StatsdCollector(object):
+    """Stands in for a statsd server on a local UDP port"""
+    def __init__(self):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.settimeout(2)
+        self.port = self.sock.getsockname()[1]
+
+    def receive(self):
+        return self.sock.recv(65536).decode('UTF-8').split('\n')
+
+    def close(self):
+        self.sock.close()
+
+
+class TestTimer(TestCase):
+    def setUp(self):
+        self.collector = StatsdCollector()
+
+    def tearDown(self):
+        self.collector.close()
+
+    def test_unbuffered(self):
+        timer = Timer('127.0.0.1', self.collector.port, 'test', False, ResourcePool)
+        timer.register('foo', 12)
+        assert self.collector.receive() == ['test.foo:12.000000|ms']
+
+    def test_buffered_flush(self):
+        timer = Timer('127.0.0.1', self.collector.port, 'test', False, ResourcePool, 60, 1000)
+        timer.register('foo', 12)
+        timer.register('foo', 13)
+        timer.incr('bar')
+        timer.incr('bar', 2)
+        timer.gauge('baz', 1)
+        timer.gauge('baz', 2)
+        timer.sink.flush()
+        assert self.collector.receive() == [
+            'test.foo:12.000000|ms', 'test.foo:13.000000|ms', 'test.bar:3|c', 'test.baz:2|g']
+
+    def test_buffered_max_pending(self):
+        timer = Timer('127.0.0.1', self.collector.port, 'test', False, ResourcePool, 60, 3)
+        for value in range(3):
+            timer.register('foo', value)
+        assert self.collector.receive() == [
+            'test.foo:0.000000|ms', 'test.foo:1.000000|ms', 'test.foo:2.000000|ms']
+
+    def test_buffered_interval(self):
+        timer = Timer('127.0.0.1', self.collector.port, 'test', False, ResourcePool, 0.01, 1000)
+        timer.incr('bar')
+        assert self.collector.receive() == ['test.bar:1|c']
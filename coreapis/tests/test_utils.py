@@ -1,4 +1,6 @@
-from unittest import TestCase
+import json
+import logging
+from unittest import TestCase, mock
 import uuid
 from coreapis import utils
 import py.test
@@ -222,3 +224,43 @@ class TestLogToken(TestCase):
     def test_uuid(self):
         assert utils.log_token(
             uuid.UUID('7d4a4d65-8670-4b75-994b-894872fe1d46')) == '739384b61d0cd34c2da0687e7aab162e'
+
+
+class TestLogWrapper(TestCase):
+    def setUp(self):
+        self.log = utils.LogWrapper('coreapis.tests.logwrapper', component='test')
+        self.log.logger.setLevel(logging.WARNING)
+        self.handler = mock.Mock(level=logging.DEBUG)
+        self.log.logger.addHandler(self.handler)
+
+    def tearDown(self):
+        self.log.logger.removeHandler(self.handler)
+
+    def test_disabled_level_builds_nothing(self):
+        with mock.patch('coreapis.utils.LogMessage') as logmessage:
+            self.log.debug('hidden', foo='bar')
+            self.log.info('hidden')
+        assert not logmessage.called
+        assert not self.handler.handle.called
+
+    def test_message_fields(self):
+        self.log.warn('shown', foo='bar')
+        record = self.handler.handle.call_args[0][0]
+        assert record.msg.args['component'] == 'test'
+        assert record.msg.args['foo'] == 'bar'
+        prefix, rest = str(record.msg).split(', ', 1)
+        assert prefix == '"message": "shown"'
+        assert json.loads('{' + rest + '}') == {'component': 'test', 'foo': 'bar'}
+
+    def test_defaults_added_later(self):
+        self.log.warn('first')
+        utils.LogWrapper.add_defaults(testdefault='x')
+        try:
+            self.log.warn('second')
+        finally:
+            utils.LogWrapper.remove_defaults('testdefault')
+        first, second = [c[0][0].msg for c in self.handler.handle.call_args_list]
+        assert 'testdefault' not in first.args
+        assert second.args['testdefault'] == 'x'
+        self.log.warn('third')
+        assert 'testdefault' not in self.handler.handle.call_args[0][0].msg.args
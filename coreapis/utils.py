@@ -1,4 +1,3 @@
-from collections import defaultdict, deque
 import datetime
 from email.mime.text import MIMEText
 import email.utils
@@ -14,6 +13,7 @@ import threading
 from threading import Lock
 import time
 import traceback
+import types
 import unicodedata
 from urllib.parse import urlparse
 import uuid
@@ -82,14 +82,26 @@ class CustomEncoder(json.JSONEncoder):
 
 
 class LogMessage(object):
+    # The fields are merged and serialized when the message is rendered,
+    # which only happens if a handler accepts the record. _base is not
+    # copied, and must not be changed afterwards.
     def __init__(self, message, _base, **kwargs):
         self.message = message
-        args = _base.copy()
-        args.update(kwargs)
-        self.args = args
-        request = request_id()
-        if request:
-            self.args['request'] = request
+        self._base = _base
+        self._kwargs = kwargs
+        self._request = request_id()
+        self._args = None
+        self._str = None
+
+    @property
+    def args(self):
+        if self._args is None:
+            args = self._base.copy()
+            args.update(self._kwargs)
+            if self._request:
+                args['request'] = self._request
+            self._args = args
+        return self._args
 
     def rest(self):
         rest = json.dumps(self.args, cls=CustomEncoder)
@@ -97,44 +109,67 @@ class LogMessage(object):
         return rest.strip()
 
     def __str__(self):
-        rest = self.rest()
-        if rest:
-            return '"message": "{}", {}'.format(self.message, rest)
-        return '"message": "{}"'.format(self.message)
+        if self._str is None:
+            rest = self.rest()
+            if rest:
+                self._str = '"message": "{}", {}'.format(self.message, rest)
+            else:
+                self._str = '"message": "{}"'.format(self.message)
+        return self._str
 
 
 class LogWrapper(object):
     clsbase = {}
+    generation = 0
 
     def __init__(self, name, **base):
         self._base = base
+        self._merged = None
+        self._generation = None
         self.logger = logging.getLogger(name)
 
     @property
     def base(self):
-        base = LogWrapper.clsbase.copy()
-        base.update(self._base)
-        return base
+        # Merged once per change of the class defaults, and shared by
+        # all messages
+        if self._generation != LogWrapper.generation:
+            base = LogWrapper.clsbase.copy()
+            base.update(self._base)
+            self._merged = base
+            self._generation = LogWrapper.generation
+        return self._merged
 
     @classmethod
     def add_defaults(cls, **kwargs):
         cls.clsbase.update(kwargs)
+        LogWrapper.generation += 1
+
+    @classmethod
+    def remove_defaults(cls, *keys):
+        for key in keys:
+            cls.clsbase.pop(key, None)
+        LogWrapper.generation += 1
 
     def debug(self, msg, **kwargs):
-        self.logger.debug(LogMessage(msg, self.base, **kwargs))
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug(LogMessage(msg, self.base, **kwargs))
 
     def warn(self, msg, **kwargs):
-        self.logger.warning(LogMessage(msg, self.base, **kwargs))
+        if self.logger.isEnabledFor(logging.WARNING):
+            self.logger.warning(LogMessage(msg, self.base, **kwargs))
 
     def error(self, msg, **kwargs):
-        self.logger.error(LogMessage(msg, self.base, **kwargs))
+        if self.logger.isEnabledFor(logging.ERROR):
+            self.logger.error(LogMessage(msg, self.base, **kwargs))
 
     def info(self, msg, **kwargs):
-        self.logger.info(LogMessage(msg, self.base, **kwargs))
+        if self.logger.isEnabledFor(logging.INFO):
+            self.logger.info(LogMessage(msg, self.base, **kwargs))
 
     def exception(self, msg, **kwargs):
-        exception = traceback.format_exc()
-        self.error(msg, exception=exception, **kwargs)
+        if self.logger.isEnabledFor(logging.ERROR):
+            exception = traceback.format_exc()
+            self.error(msg, exception=exception, **kwargs)
 
 
 class DebugLogFormatter(logging.Formatter):
@@ -156,9 +191,114 @@ class DebugLogFormatter(logging.Formatter):
         return json.dumps(obj, cls=CustomEncoder)
 
 
+class PooledStatsSink(object):
+    """Sends each value to statsd at once, using a client from pool"""
+    def __init__(self, pool):
+        self.pool = pool
+
+    def timing(self, name, value):
+        with self.pool.item() as client:
+            client.timing(name, value)
+
+    def incr(self, name, count=1):
+        with self.pool.item() as client:
+            client.incr(name, count)
+
+    def gauge(self, name, value):
+        with self.pool.item() as client:
+            client.gauge(name, value)
+
+
+class BufferedStatsSink(object):
+    """Collects values in process and sends them to statsd from a
+    background thread, as pipelined packets. Counters are summed and
+    gauges keep their last value until sent. Values are sent every
+    interval seconds, or sooner when max_pending are waiting."""
+    def __init__(self, client, interval, max_pending):
+        self.log = LogWrapper('coreapis.BufferedStatsSink')
+        self.client = client
+        self.interval = interval
+        self.max_pending = max_pending
+        self.lock = Lock()
+        self.wakeup = threading.Event()
+        self._reset()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _reset(self):
+        self.timings = []
+        self.counters = {}
+        self.gauges = {}
+        self.pending = 0
+
+    def _added(self):
+        self.pending += 1
+        if self.pending == self.max_pending:
+            self.wakeup.set()
+
+    def timing(self, name, value):
+        with self.lock:
+            self.timings.append((name, value))
+            self._added()
+
+    def incr(self, name, count=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + count
+            self._added()
+
+    def gauge(self, name, value):
+        with self.lock:
+            self.gauges[name] = value
+            self._added()
+
+    def flush(self):
+        with self.lock:
+            timings, counters, gauges = self.timings, self.counters, self.gauges
+            self._reset()
+        if not (timings or counters or gauges):
+            return
+        pipe = self.client.pipeline()
+        for name, value in timings:
+            pipe.timing(name, value)
+        for name, count in counters.items():
+            pipe.incr(name, count)
+        for name, value in gauges.items():
+            pipe.gauge(name, value)
+        pipe.send()
+
+    def _run(self):
+        while True:
+            self.wakeup.wait(self.interval)
+            self.wakeup.clear()
+            try:
+                self.flush()
+            except Exception as ex:  # pylint: disable=broad-except
+                self.log.warn('Failed to send statistics', exception=str(ex))
+
+
+STATS_SINKS = {}
+STATS_SINKS_LOCK = Lock()
+
+
+def get_buffered_stats_sink(server, port, prefix, interval, max_pending):
+    """Returns the process' BufferedStatsSink for server, port and prefix"""
+    key = (server, port, prefix)
+    with STATS_SINKS_LOCK:
+        if key not in STATS_SINKS:
+            client = statsd.StatsClient(server, port, prefix=prefix)
+            STATS_SINKS[key] = BufferedStatsSink(client, interval, max_pending)
+        return STATS_SINKS[key]
+
+
 class Timer(object):
-    def __init__(self, server, port, prefix, log_results, pool):
-        self.pool = pool(create=lambda: statsd.StatsClient(server, port, prefix=prefix))
+    def __init__(self, server, port, prefix, log_results, pool, flush_interval=0,
+                 max_pending=1000):
+        if flush_interval > 0:
+            self.sink = get_buffered_stats_sink(server, port, prefix, flush_interval,
+                                                max_pending)
+        else:
+            self.sink = PooledStatsSink(
+                pool(create=lambda: statsd.StatsClient(server, port, prefix=prefix)))
         self.log_results = log_results
         if self.log_results:
             self.log = LogWrapper('coreapis.Timer')
@@ -184,60 +324,13 @@ class Timer(object):
         if self.log_results:
             self.log.debug('Timed {} to {} ms'.format(name, duration),
                            counter=name, timing_ms=duration)
-        with self.pool.item() as client:
-            client.timing(name, duration)
-
-
-class RateLimiter(object):
-    # Requests are let through if client is not among last 1/maxshare
-    # clients served, or if there is still room in the client's token bucket.
-    def __init__(self, maxshare, capacity, rate):
-        self.log = LogWrapper('coreapis.RateLimiter')
-        self.nwatched = int(1./maxshare + 0.5)
-        self.recents = deque([None] * self.nwatched)
-        self.counts = defaultdict(lambda: 0)
-        self.buckets = defaultdict(lambda: LeakyBucket(capacity, rate))
-
-    def check_rate(self, remote_addr):
-        client = remote_addr
-        accepted = not self.buckets[client].full()
-        self.log.debug("check_rate", src_ip=client, accepted=accepted)
-        if accepted:
-            self.buckets[client].add()
-            oldclient = self.recents.popleft()
-            if oldclient:
-                self.counts[oldclient] -= 1
-                if self.counts[oldclient] <= 0:
-                    self.log.debug("bucket deleted",
-                                   src_ip=oldclient,
-                                   contents=self.buckets[oldclient].contents)
-                    del self.buckets[oldclient]
-                    del self.counts[oldclient]
-            self.recents.append(client)
-            self.counts[client] += 1
-        return accepted
-
-
-class LeakyBucket(object):
-    def __init__(self, capacity, leak_rate):
-        self.capacity = capacity
-        self.leak_rate = leak_rate
-        self.contents = 0
-        self.ts = now()
-
-    def add(self):
-        self.contents += 1
-
-    def full(self):
-        self._update()
-        return self.contents >= self.capacity
-
-    def _update(self):
-        newts = now()
-        gap = newts - self.ts
-        leakage = self.leak_rate * gap.total_seconds()
-        self.ts = newts
-        self.contents = max(0, self.contents - leakage)
+        self.sink.timing(name, duration)
+
+    def incr(self, name, count=1):
+        self.sink.incr(name, count)
+
+    def gauge(self, name, value):
+        self.sink.gauge(name, value)
 
 
 class RequestTimingTween(object):
@@ -511,6 +604,8 @@ def translation(func):
 
         def chooser(data):
             return accept_language_matcher(request, data)
+        if isinstance(data, types.GeneratorType):
+            return (pick_lang(chooser, item) for item in data)
         return pick_lang(chooser, data)
     return wrapper
 
@@ -537,9 +632,12 @@ class LogoRenderer(object):
         content_type = 'image/png'
         if len(value) > 3:
             content_type = value[3]
+        etag = None
         if logo is None:
-            with open(fallback_file, 'rb') as fh:
-                logo = fh.read()
+            fallback = request.registry.settings['default_assets'].get(fallback_file)
+            logo, etag, updated = fallback.data, fallback.etag, fallback.last_modified
+            if request.if_none_match and etag in request.if_none_match:
+                raise HTTPNotModified
         updated = updated.replace(microsecond=0)
         if request.if_modified_since and request.if_modified_since >= updated:
             raise HTTPNotModified
@@ -548,9 +646,38 @@ class LogoRenderer(object):
         response.content_type = content_type
         response.cache_control = 'public, max-age=3600'
         response.last_modified = updated
+        if etag:
+            response.etag = etag
         return logo
 
 
+class NDJSONRenderer(object):
+    """Renders an iterable as newline delimited JSON, one item per line.
+    Items are rendered while the response is written, so a view can
+    return a generator to stream results as they become available."""
+    content_type = 'application/x-ndjson'
+
+    def __init__(self, json_renderer):
+        self.render_item = json_renderer(None)
+
+    def __call__(self, info):
+        return self.render
+
+    def _lines(self, value):
+        for item in value:
+            yield '{}\n'.format(self.render_item(item, {})).encode('UTF-8')
+
+    def render(self, value, system):
+        response = system['request'].response
+        response.content_type = self.content_type
+        response.app_iter = self._lines(value)
+
+
+def wants_ndjson(request):
+    offers = ['application/json', NDJSONRenderer.content_type]
+    return request.accept.best_match(offers) == NDJSONRenderer.content_type
+
+
 class EmailNotifier(object):
     def __init__(self, settings):
         self.sender = settings.get('sender', None)
@@ -673,3 +800,33 @@ def get_cassandra_cluster_args(contact_points, connection_class, authz):
             auth_provider=PlainTextAuthProvider(username=username, password=password)
         )
     return cluster_args
+
+
+def run_warm_up(warm_up_methods, mode, status_data=None):
+    """Runs the warm_up_methods (name -> callable) according to mode.
+    'blocking' runs them before returning, so a worker does not serve
+    requests until it is warm, 'background' runs them in a separate
+    thread, and 'none' skips them."""
+    if mode not in ('blocking', 'background', 'none'):
+        raise ValueError('Bad warm_up mode: {}'.format(mode))
+    if mode == 'none':
+        return
+    log = LogWrapper('coreapis.warm_up')
+    if status_data is None:
+        status_data = {}
+
+    def run():
+        status_data['warm_up'] = 'running'
+        t0 = time.time()
+        for name, method in list(warm_up_methods.items()):
+            try:
+                method()
+            except Exception as ex:  # pylint: disable=broad-except
+                log.warn('Warm up failed', component=name, exception=str(ex))
+        status_data['warm_up'] = 'done'
+        log.info('Warm up done', duration=time.time() - t0)
+
+    if mode == 'blocking':
+        run()
+    else:
+        threading.Thread(target=run, daemon=True).start()